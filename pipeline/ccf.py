@@ -1,4 +1,7 @@
+import os
 import logging
+import tempfile
+from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
@@ -8,8 +11,12 @@ import scipy.io as scio
 
 import nrrd
 
-from . import InsertBuffer
-from . import get_schema_name
+try:
+    import fcntl
+except ImportError:  # e.g. Windows
+    fcntl = None
+
+from . import get_schema_name, dict_to_hash
 
 schema = dj.schema(get_schema_name('ccf'))
 
@@ -88,7 +95,7 @@ class CCFAnnotation(dj.Manual):
     """
 
     @classmethod
-    def load_ccf_annotation(cls):
+    def load_ccf_annotation(cls, chunksz=100000):
         """
         Load the CCF r3 10 uM NRRD Dataset scaled to 20um.
 
@@ -107,6 +114,8 @@ class CCFAnnotation(dj.Manual):
 
         http://download.alleninstitute.org/informatics-archive/current-release/mouse_ccf/annotation/ccf_2017
 
+        Each region is loaded in its own transaction, in inserts of "chunksz" rows -
+        an interrupted load resumes from the regions not yet loaded.
         """
 
         ccf_vol_res = CCFLabel.CCF_R3_20UM_RESOLUTION
@@ -129,21 +138,29 @@ class CCFAnnotation(dj.Manual):
         log.info('.. loaded stack of shape {} from {}'
                  .format(stack.shape, stack_path))
 
-        # iterate over ccf ontology region id/name records,
+        # group the voxels by region in a single pass over the volume
         regions = get_ontology_regions()
-        chunksz, ib_args = 50000, {'skip_duplicates': True,
-                                   'allow_direct_insert': True}
+        ib_args = {'skip_duplicates': True, 'allow_direct_insert': True}
+
+        # resume: regions are loaded one transaction each - skip the ones already loaded
+        loaded = set((dj.U('annotation') & (cls & {'annotation_version': version_name})).fetch('annotation'))
+        if loaded:
+            log.info('.. {} regions already loaded - resuming'.format(len(loaded)))
 
-        for idx, (region_id, r) in enumerate(regions.iterrows()):
+        for idx, ((region_id, r), (_, vol)) in enumerate(zip(
+                regions.iterrows(), region_voxels(stack, regions.index.values))):
 
             region_id = int(region_id)
 
+            if r.region_name in loaded:
+                log.debug('.. region {} ({}) already loaded - skipping'.format(region_id, r.region_name))
+                continue
+
             log.info('.. loading region {} ({}/{}) ({})'
                      .format(region_id, idx, len(regions), r.region_name))
 
-            # extracting filled volumes from stack in scaled [[x,y,z]] shape,
-            vol = (np.array(np.where(stack == region_id)).T[:, [2, 1, 0]]
-                   * scale_factor)
+            # filled volume in scaled [[x,y,z]] shape,
+            vol = vol * scale_factor
 
             if not vol.shape[0]:
                 log.info('.. region {} volume: shape {} - skipping'
@@ -153,17 +170,16 @@ class CCFAnnotation(dj.Manual):
             log.info('.. region {} volume: shape {}'.format(
                 region_id, vol.shape))
 
+            vol = vol.tolist()
             with dj.conn().transaction:
-                with InsertBuffer(CCF, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1((CCFLabel.CCF_R3_20UM_ID, *vox))
+                for i in range(0, len(vol), chunksz):
+                    CCF.insert([(CCFLabel.CCF_R3_20UM_ID, *vox) for vox in vol[i:i + chunksz]], **ib_args)
 
-                with InsertBuffer(cls, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1({'ccf_label_id': CCFLabel.CCF_R3_20UM_ID,
-                                     'ccf_x': vox[0], 'ccf_y': vox[1], 'ccf_z': vox[2],
-                                     'annotation_version': version_name,
-                                     'annotation': r.region_name})
+                for i in range(0, len(vol), chunksz):
+                    cls.insert([{'ccf_label_id': CCFLabel.CCF_R3_20UM_ID,
+                                 'ccf_x': x, 'ccf_y': y, 'ccf_z': z,
+                                 'annotation_version': version_name,
+                                 'annotation': r.region_name} for x, y, z in vol[i:i + chunksz]], **ib_args)
 
         log.info('.. done.')
 
@@ -202,6 +218,31 @@ def get_ontology_regions():
     return pd.concat([regions, hexcode], axis=1)
 
 
+def region_voxels(stack, region_ids):
+    """
+    Voxels of each region of a labeled volume, grouped in a single pass over the volume
+    (a stable argsort of the labeled voxels) rather than one np.where(stack == region_id) per region
+    :param stack: labeled volume (AP, DV, ML)
+    :param region_ids: region ids (labels) to retrieve
+    :return: generator of (region_id, [[x, y, z], ...] voxel indices) in the order of "region_ids",
+             with the voxels ordered as in np.where(stack == region_id)
+    """
+    region_ids = np.asarray(region_ids)
+    labels = stack.ravel()
+
+    # background (0) voxels are only needed if 0 is a requested region
+    voxels = np.arange(labels.size) if (region_ids == 0).any() else np.flatnonzero(labels)
+    order = np.argsort(labels[voxels], kind='stable')
+    voxels = voxels[order]
+    sorted_labels = labels[voxels]
+
+    starts = np.searchsorted(sorted_labels, region_ids, side='left')
+    ends = np.searchsorted(sorted_labels, region_ids, side='right')
+
+    for region_id, start, end in zip(region_ids, starts, ends):
+        yield region_id, np.array(np.unravel_index(voxels[start:end], stack.shape)).T[:, [2, 1, 0]]
+
+
 def get_ccf_xyz_max():
     global _ccf_xyz_max
     if _ccf_xyz_max is None:
@@ -209,3 +250,263 @@ def get_ccf_xyz_max():
                                      ymax='max(ccf_y)',
                                      zmax='max(ccf_z)').fetch1('xmax', 'ymax', 'zmax')
     return _ccf_xyz_max
+
+
+# ========= LOCAL ANNOTATION VOLUME ======
+_annotation_volumes = {}
+
+
+def get_annotation_cache_dir():
+    """
+    retrieve the directory of the local annotation volume cache from dj.config
+    (default: <XDG_CACHE_HOME, or ~/.cache>/map_ccf_annotation - persistent across sessions)
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'ccf_annotation_cache': '/path/to/cache'
+        }
+        ...
+      }
+    """
+    cache_dir = dj.config.get('custom', {}).get('ccf_annotation_cache', None)
+    if cache_dir is None:
+        cache_dir = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'),
+                                 'map_ccf_annotation')
+
+    return pathlib.Path(cache_dir)
+
+
+def get_annotation_volume(annotation_version=None, refresh=False):
+    """
+    The AnnotationVolume of "annotation_version" (default: the configured ccf_data_paths
+    version_name, or CCF_2017) - loaded once per process from the local cache, if its fingerprint
+    matches the database (see AnnotationVolume.get_fingerprint()).
+    A missing or outdated cache is (re)built on first use - by a single process at a time
+    (see AnnotationVolume.load()), or beforehand with 'mapshell.py build-ccf-volume'.
+    """
+    if annotation_version is None:
+        annotation_version = dj.config.get('custom', {}).get(
+            'ccf_data_paths', {}).get('version_name', 'CCF_2017')
+
+    if refresh or annotation_version not in _annotation_volumes:
+        _annotation_volumes[annotation_version] = AnnotationVolume.load(
+            annotation_version, get_annotation_cache_dir(),
+            AnnotationVolume.get_fingerprint(annotation_version), refresh=refresh)
+
+    return _annotation_volumes[annotation_version]
+
+
+@contextmanager
+def cache_lock(lock_path):
+    """
+    Exclusive lock on the "lock_path" file, held by a single process at a time (e.g. to build a
+    local cache once) - a no-op where file locking (fcntl) is not available
+    """
+    lock_path = pathlib.Path(lock_path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class AnnotationVolume:
+    """
+    Local copy of the CCFAnnotation of an annotation version, as a (memory-mapped) volume of
+    region indices (-1: not annotated) indexed by CCF voxel (ccf_x, ccf_y, ccf_z) / voxel_res,
+    and the corresponding CCFBrainRegion attributes - to resolve CCF coordinates to brain
+    regions without querying the (multi-million rows) CCFAnnotation table.
+
+        >>> volume = get_annotation_volume('CCF_2017')
+        >>> volume.lookup([[5700, 3000, 8000]])
+        array(['Primary motor area Layer 5'], dtype=object)
+    """
+
+    voxel_res = CCFLabel.CCF_R3_20UM_RESOLUTION
+    region_fields = ('region_name', 'region_id', 'color_code')
+
+    def __init__(self, labels, regions, annotation_version=None, fingerprint=None):
+        """
+        :param labels: volume of region indices (into "regions"), -1 for voxels not annotated
+        :param regions: {field: array} of the CCFBrainRegion attributes (see region_fields)
+        :param fingerprint: fingerprint of the database content it was built from (see get_fingerprint())
+        """
+        self.labels = labels
+        self.annotation_version = annotation_version
+        self.fingerprint = fingerprint
+
+        # the attributes of the (-1) non-annotated voxels are appended at the end
+        self.regions = {'region_name': np.append(np.asarray(regions['region_name'], dtype=object), None),
+                        'region_id': np.append(np.asarray(regions['region_id'], dtype=int), -1),
+                        'color_code': np.append(np.asarray(regions['color_code'], dtype=object), None)}
+
+    @classmethod
+    def from_annotations(cls, ccf_x, ccf_y, ccf_z, annotation, regions, annotation_version=None,
+                         fingerprint=None):
+        """
+        Build the volume from CCFAnnotation rows
+        :param ccf_x, ccf_y, ccf_z, annotation: CCFAnnotation attributes of the annotated voxels
+        :param regions: {field: array} of the CCFBrainRegion attributes (see region_fields)
+        """
+        region_names = np.asarray(regions['region_name'], dtype=object)
+        order = np.argsort(region_names)
+        region_names = region_names[order]
+        regions = {f: np.asarray(regions[f])[order] for f in cls.region_fields}
+
+        voxels = np.array([ccf_x, ccf_y, ccf_z], dtype=int) // cls.voxel_res
+        labels = np.full(voxels.max(axis=1) + 1 if voxels.size else (0, 0, 0), -1, dtype=np.int16)
+
+        region_idx = np.searchsorted(region_names, np.asarray(annotation, dtype=object))
+        labels[tuple(voxels)] = region_idx
+
+        return cls(labels, regions, annotation_version, fingerprint)
+
+    @staticmethod
+    def get_fingerprint(annotation_version):
+        """
+        hash of the database content of "annotation_version": the CCFBrainRegion rows, and per annotated
+        region the number and a checksum (xor of the crc32) of the coordinates of its CCFAnnotation voxels -
+        aggregated in the database
+        """
+        version_key = {'annotation_version': annotation_version}
+        regions = (CCFBrainRegion & version_key).fetch(
+            'region_name', 'region_id', 'color_code', order_by='region_name', as_dict=True)
+        annotations = dj.U('annotation').aggr(
+            CCFAnnotation & version_key & {'ccf_label_id': CCFLabel.CCF_R3_20UM_ID},
+            voxels='count(*)', checksum='bit_xor(crc32(concat_ws(",", ccf_x, ccf_y, ccf_z)))').fetch(
+            order_by='annotation', as_dict=True)
+        return dict_to_hash({'annotation_version': annotation_version,
+                             'regions': regions,
+                             'annotations': annotations})
+
+    @classmethod
+    def fetch(cls, annotation_version, fingerprint=None):
+        """ Build the volume of "annotation_version" from the CCFAnnotation/CCFBrainRegion tables """
+        log.info('AnnotationVolume.fetch(): fetching {} annotation'.format(annotation_version))
+        version_key = {'annotation_version': annotation_version}
+        regions = dict(zip(cls.region_fields, (CCFBrainRegion & version_key).fetch(*cls.region_fields)))
+        ccf_x, ccf_y, ccf_z, annotation = (
+            CCFAnnotation & version_key & {'ccf_label_id': CCFLabel.CCF_R3_20UM_ID}).fetch(
+            'ccf_x', 'ccf_y', 'ccf_z', 'annotation')
+        return cls.from_annotations(ccf_x, ccf_y, ccf_z, annotation, regions, annotation_version, fingerprint)
+
+    @classmethod
+    def get_cache_paths(cls, annotation_version, cache_dir):
+        """ (.npy labels path, .npz regions path) of the volume of "annotation_version" in "cache_dir" """
+        cache_dir = pathlib.Path(cache_dir)
+        return (cache_dir / '{}_{}um_annotation.npy'.format(annotation_version, cls.voxel_res),
+                cache_dir / '{}_{}um_regions.npz'.format(annotation_version, cls.voxel_res))
+
+    @classmethod
+    def load_cached(cls, annotation_version, cache_dir, fingerprint=None):
+        """
+        Load the volume of "annotation_version" from "cache_dir", memory-mapped - None if
+        not cached, or cached with another "fingerprint" (see get_fingerprint())
+        """
+        labels_path, regions_path = cls.get_cache_paths(annotation_version, cache_dir)
+        if not (labels_path.exists() and regions_path.exists()):
+            return None
+
+        with np.load(regions_path) as regions:
+            cached_fingerprint = str(regions['fingerprint']) if 'fingerprint' in regions else None
+            if fingerprint is not None and cached_fingerprint != fingerprint:
+                return None
+            regions = {f: regions[f] for f in cls.region_fields}
+
+        return cls(np.load(labels_path, mmap_mode='r'), regions, annotation_version, cached_fingerprint)
+
+    @classmethod
+    def load(cls, annotation_version, cache_dir, fingerprint=None, refresh=False):
+        """
+        Load the volume of "annotation_version" from "cache_dir", memory-mapped - fetching it from
+        the database and caching it first if needed: not cached, cached with another "fingerprint"
+        (see get_fingerprint()), or "refresh".
+        Concurrent processes wait for the one building the cache, then load it.
+        """
+        if not refresh:
+            volume = cls.load_cached(annotation_version, cache_dir, fingerprint)
+            if volume is not None:
+                return volume
+
+        labels_path, regions_path = cls.get_cache_paths(annotation_version, cache_dir)
+        with cache_lock(labels_path.with_suffix('.lock')):
+            if not refresh:
+                # built by another process in the meantime
+                volume = cls.load_cached(annotation_version, cache_dir, fingerprint)
+                if volume is not None:
+                    return volume
+
+            volume = cls.fetch(annotation_version, fingerprint)
+            volume.save(labels_path, regions_path)
+
+        return cls.load_cached(annotation_version, cache_dir)
+
+    def save(self, labels_path, regions_path):
+        """ Save the volume to the "labels_path" .npy and the regions to the "regions_path" .npz """
+        labels_path, regions_path = pathlib.Path(labels_path), pathlib.Path(regions_path)
+        labels_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to (uniquely named) temporary files first - concurrent readers only ever see complete files
+        with tempfile.NamedTemporaryFile(dir=labels_path.parent, suffix='.tmp', delete=False) as f:
+            np.save(f, np.asarray(self.labels))
+        os.replace(f.name, labels_path)
+
+        with tempfile.NamedTemporaryFile(dir=regions_path.parent, suffix='.tmp', delete=False) as f:
+            np.savez(f, fingerprint=str(self.fingerprint),
+                     **{field: np.asarray(v[:-1], dtype=str if field != 'region_id' else int)
+                        for field, v in self.regions.items()})
+        os.replace(f.name, regions_path)
+
+    def region_index(self, xyz, snap=False):
+        """
+        Region index (into self.regions, -1: not annotated) of the CCF coordinates "xyz"
+        :param xyz: (N x 3) array of (ccf_x, ccf_y, ccf_z) coordinates (um)
+        :param snap: whether coordinates not on the voxel grid are snapped to the nearest voxel -
+                     if not (default), they are not annotated, as in a join with CCFAnnotation
+        """
+        xyz = np.asarray(xyz).reshape(-1, 3)
+        if snap:
+            voxels = np.round(xyz / self.voxel_res).astype(int)
+            valid = np.ones(len(xyz), dtype=bool)
+        else:
+            voxels = (xyz // self.voxel_res).astype(int)
+            valid = (xyz % self.voxel_res == 0).all(axis=1)
+
+        valid &= ((voxels >= 0) & (voxels < self.labels.shape)).all(axis=1)
+
+        region_idx = np.full(len(xyz), -1, dtype=int)
+        region_idx[valid] = self.labels[tuple(voxels[valid].T)]
+        return region_idx
+
+    def lookup(self, xyz, field='region_name', snap=False):
+        """
+        CCFBrainRegion "field" (region_name, region_id or color_code) of the CCF coordinates "xyz"
+        - None (region_id: -1) for the coordinates not annotated (see region_index())
+        """
+        return self.regions[field][self.region_index(xyz, snap=snap)]
+
+    def slice(self, ccf_x=None, ccf_y=None, ccf_z=None, field='region_name'):
+        """
+        CCFBrainRegion "field" of the voxels of the plane at one of ccf_x, ccf_y or ccf_z (um),
+        e.g. slice(ccf_z=8000) for a coronal slice
+        :return: 2D array indexed by the voxels of the 2 other axes, in (x, y, z) order
+        """
+        plane = [ccf_x, ccf_y, ccf_z]
+        axes = [i for i, c in enumerate(plane) if c is not None]
+        if len(axes) != 1:
+            raise ValueError('slice() requires exactly one of ccf_x, ccf_y or ccf_z')
+
+        axis = axes[0]
+        index = [slice(None)] * 3
+        index[axis] = plane[axis] // self.voxel_res
+        if not 0 <= index[axis] < self.labels.shape[axis]:
+            return self.regions[field][np.full(
+                [s for i, s in enumerate(self.labels.shape) if i != axis], -1)]
+
+        return self.regions[field][self.labels[tuple(index)]]
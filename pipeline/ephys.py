@@ -300,24 +300,47 @@ class UnitCellType(dj.Computed):
     -> CellType
     """
 
-    @property
-    def key_source(self):
-        return super().key_source & 'unit_quality != "all"'
+    # NOTE - this key_source logic relies on ALL Units of an insertion ingested all at once in a transaction
+    key_source = ProbeInsertion & ProbeInsertion.RecordingSystemSetup & (Unit & 'unit_quality != "all"')
+
+    upsample_factor = 100
+    fs_width_threshold = 0.4  # (ms) trough-to-peak width below which a unit is fast-spiking
 
     def make(self, key):
-        upsample_factor = 100
+        """
+        Classify and insert the cell type of all the units (but "all" quality ones) of the
+        probe insertion of "key" - from their waveforms, fetched at once
+        """
+        keys, waveforms, sampling_rates = (ProbeInsertion.RecordingSystemSetup * Unit & key
+                                           & 'unit_quality != "all"').fetch('KEY', 'waveform', 'sampling_rate')
+        cell_types = self.classify_waveforms(waveforms, sampling_rates)
 
-        ave_waveform, fs = (ProbeInsertion.RecordingSystemSetup * Unit & key).fetch1('waveform', 'sampling_rate')
-        cs = CubicSpline(range(len(ave_waveform)), ave_waveform)
-        ave_waveform = cs(np.linspace(0, len(ave_waveform) - 1, (len(ave_waveform))*upsample_factor))
+        self.insert([{**{k: unit_key[k] for k in Unit.primary_key}, 'cell_type': cell_type}
+                     for unit_key, cell_type in zip(keys, cell_types)])
+
+    @classmethod
+    def classify_waveforms(cls, waveforms, sampling_rates):
+        """
+        Cell type (FS or Pyr) of each unit, from the trough-to-peak width of its average waveform,
+        upsampled by CubicSpline interpolation - all waveforms of the same length at once
+        :param waveforms: average waveform of each unit
+        :param sampling_rates: sampling rate (Hz) of each unit
+        :return: array of the cell types
+        """
+        sampling_rates = np.asarray(sampling_rates) * cls.upsample_factor
+        waveform_widths = np.full(len(waveforms), np.nan)
 
-        fs = fs * upsample_factor
-        x_min = np.argmin(ave_waveform) / fs
-        x_max = np.argmax(ave_waveform) / fs
-        waveform_width = abs(x_max-x_min) * 1000  # convert to ms
+        lengths = np.array([len(w) for w in waveforms], dtype=int)
+        for length in np.unique(lengths):
+            units = np.flatnonzero(lengths == length)
+            cs = CubicSpline(range(length), np.array([waveforms[u] for u in units], dtype=float), axis=1)
+            ave_waveforms = cs(np.linspace(0, length - 1, length * cls.upsample_factor))
 
-        self.insert1(dict(key,
-                          cell_type='FS' if waveform_width < 0.4 else 'Pyr'))
+            x_min = np.argmin(ave_waveforms, axis=1) / sampling_rates[units]
+            x_max = np.argmax(ave_waveforms, axis=1) / sampling_rates[units]
+            waveform_widths[units] = abs(x_max - x_min) * 1000  # convert to ms
+
+        return np.where(waveform_widths < cls.fs_width_threshold, 'FS', 'Pyr').astype(object)
 
 
 @schema
@@ -338,34 +361,69 @@ class UnitStat(dj.Computed):
     def make(self, key):
         # Following isi_violations() function
         # Ref: https://github.com/AllenInstitute/ecephys_spike_sorting/blob/master/ecephys_spike_sorting/modules/quality_metrics/metrics.py
-        def make_insert():
-            for unit in (Unit & key).fetch('KEY'):
-                trial_spikes, tr_start, tr_stop = (Unit.TrialSpikes * experiment.SessionTrial & unit).fetch(
-                    'spike_times', 'start_time', 'stop_time')
+        units = (Unit & key).fetch('KEY', order_by='KEY')
+        unit_idx = {(u['clustering_method'], u['unit']): i for i, u in enumerate(units)}
+
+        # all TrialSpikes of the insertion at once
+        methods, unit_nos, trial_spikes, tr_start, tr_stop = (Unit.TrialSpikes * experiment.SessionTrial & key).fetch(
+            'clustering_method', 'unit', 'spike_times', 'start_time', 'stop_time')
+        row_units = np.array([unit_idx[u] for u in zip(methods, unit_nos)], dtype=int)
+
+        isi_violations, avg_firing_rates = self.compute_unit_stats(
+            trial_spikes, row_units, tr_stop - tr_start, len(units))
+
+        self.insert([{**unit, 'isi_violation': None, 'avg_firing_rate': None} if np.isnan(isi_violation)
+                     else {**unit, 'isi_violation': isi_violation, 'avg_firing_rate': avg_firing_rate}
+                     for unit, isi_violation, avg_firing_rate in zip(units, isi_violations, avg_firing_rates)])
+
+    @classmethod
+    def compute_unit_stats(cls, trial_spikes, row_units, trial_durations, n_units):
+        """
+        isi_violation and avg_firing_rate of every unit, from the TrialSpikes rows of all units -
+        with the spikes of all rows concatenated (grouped by unit), and segmented counts per unit
+        :param trial_spikes: spike times of each (unit, trial) TrialSpikes row
+        :param row_units: unit (index) of each row
+        :param trial_durations: duration (stop_time - start_time) of the trial of each row
+        :param n_units: number of units
+        :return: (unit,) isi_violation and avg_firing_rate arrays - NaN for the units without any ISI
+        """
+        row_units = np.asarray(row_units, dtype=int)
+        order = np.argsort(row_units, kind='stable')
+        row_units, trial_spikes = row_units[order], [trial_spikes[i] for i in order]
+        trial_durations = np.asarray(trial_durations)[order]
 
-                isis = np.hstack(np.diff(spks) for spks in trial_spikes)
+        row_lengths = np.array([len(s) for s in trial_spikes], dtype=int)
+        spikes = np.concatenate([np.asarray(s, dtype=float).ravel() for s in trial_spikes] + [np.empty(0)])
+        spike_units = np.repeat(row_units, row_lengths)
 
-                if isis.size > 0:
-                    # remove duplicated spikes
-                    processed_trial_spikes = []
-                    for spike_train in trial_spikes:
-                        duplicate_spikes = np.where(np.diff(spike_train) <= self.min_isi)[0]
-                        processed_trial_spikes.append(np.delete(spike_train, duplicate_spikes + 1))
+        # ISIs within each trial - not across the trials of a unit
+        row_starts = np.cumsum(row_lengths) - row_lengths
+        within_row = np.ones(len(spikes), dtype=bool)
+        within_row[row_starts[row_lengths > 0]] = False  # the first spike of each row has no ISI
+        isis, isi_units = np.diff(spikes)[within_row[1:]], spike_units[1:][within_row[1:]]
 
-                    num_spikes = len(np.hstack(processed_trial_spikes))
-                    avg_firing_rate = num_spikes / float(sum(tr_stop - tr_start))
+        n_isis = np.bincount(isi_units, minlength=n_units)
+        n_violations = np.bincount(isi_units[isis < cls.isi_threshold], minlength=n_units)
 
-                    num_violations = sum(isis < self.isi_threshold)
-                    violation_time = 2 * num_spikes * (self.isi_threshold - self.min_isi)
-                    violation_rate = num_violations / violation_time
-                    fpRate = violation_rate / avg_firing_rate
+        # duplicated spikes (ISI <= min_isi) removed
+        n_spikes = (np.bincount(spike_units, minlength=n_units)
+                    - np.bincount(isi_units[isis <= cls.min_isi], minlength=n_units))
 
-                    yield {**unit, 'isi_violation': fpRate, 'avg_firing_rate': avg_firing_rate}
+        # recording duration of each unit - summed as fetched (decimal), then converted
+        durations = np.full(n_units, np.nan)
+        units, unit_starts = np.unique(row_units, return_index=True)
+        if len(units):
+            durations[units] = [float(d) for d in np.add.reduceat(trial_durations.astype(object), unit_starts)]
 
-                else:
-                    yield {**unit, 'isi_violation': None, 'avg_firing_rate': None}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg_firing_rate = n_spikes / durations
+            violation_time = 2 * n_spikes * (cls.isi_threshold - cls.min_isi)
+            violation_rate = n_violations / violation_time
+            fp_rate = violation_rate / avg_firing_rate
 
-        self.insert(make_insert())
+        no_isi = n_isis == 0
+        fp_rate[no_isi], avg_firing_rate[no_isi] = np.nan, np.nan
+        return fp_rate, avg_firing_rate
 
 
 @schema
@@ -419,31 +477,77 @@ class MAPClusterMetric(dj.Computed):
         drift_metric: float
         """
 
-    key_source = Unit & UnitStat
+    # NOTE - this key_source logic relies on the UnitStat of ALL Units of an insertion computed at once
+    key_source = ProbeInsertion & UnitStat
+
+    window_size = 6  # moving-average window (sample)
+    ds_factor = 6  # down-sampling factor
 
     def make(self, key):
+        """
+        Compute and insert the drift metric of all the units (with UnitStat) of the probe insertion
+        of "key" - from the trial spike counts of all units, fetched at once
+        """
+        keys = (Unit & UnitStat & key).fetch('KEY', order_by='KEY')
+        unit_idx = {(k['clustering_method'], k['unit']): i for i, k in enumerate(keys)}
+
         # -- get trial-spikes
-        trial_spikes, trial_durations = (
+        methods, unit_nos, trial_spikes, trial_durations = (
                 Unit.TrialSpikes
                 * (experiment.TrialEvent & 'trial_event_type = "trialend"')
-                & key).fetch('spike_times', 'trial_event_time', order_by='trial')
-        # -- compute trial spike-rates
-        trial_spike_rates = [len(s) for s in trial_spikes] / trial_durations.astype(float)  # spikes/sec
-        # mean_spike_rate = (UnitStat & key).fetch1('avg_firing_rate')
-        mean_spike_rate = np.mean(trial_spike_rates)
-        # -- moving-average
-        window_size = 6  # sample
-        kernel = np.ones(window_size) / window_size
-        processed_trial_spike_rates = np.convolve(trial_spike_rates, kernel, 'same')
-        # -- down-sample
-        ds_factor = 6
-        processed_trial_spike_rates = processed_trial_spike_rates[::ds_factor]
-        # -- compute drift_qc from poisson distribution
-        poisson_cdf = poisson.cdf(processed_trial_spike_rates, mean_spike_rate)
-        instability = np.logical_or(poisson_cdf > 0.95, poisson_cdf < 0.05).sum() / len(poisson_cdf)
-        # -- insert
-        self.insert1(key)
-        self.DriftMetric.insert1({**key, 'drift_metric': instability})
+                & (Unit & UnitStat & key).proj()).fetch(
+            'clustering_method', 'unit', 'spike_times', 'trial_event_time', order_by='clustering_method, unit, trial')
+        row_units = np.array([unit_idx[u] for u in zip(methods, unit_nos)], dtype=int)
+
+        drift_metrics = self.compute_drift_metrics(
+            [len(s) for s in trial_spikes], trial_durations.astype(float), row_units, len(keys))
+
+        # -- insert - units without trial-spikes have no drift metric
+        self.insert(keys)
+        self.DriftMetric.insert([{**key, 'drift_metric': drift_metric}
+                                 for key, drift_metric in zip(keys, drift_metrics) if not np.isnan(drift_metric)])
+
+    @classmethod
+    def compute_drift_metrics(cls, trial_spike_counts, trial_durations, row_units, n_units):
+        """
+        Drift metric of every unit - the fraction of its (moving-averaged, down-sampled) trial spike rates
+        out of the [0.05, 0.95] interval of the Poisson distribution of its mean spike rate - computed
+        on the unit x trial spike rates matrix of all units with the same number of trials at once
+        :param trial_spike_counts: spike count of each (unit, trial) row
+        :param trial_durations: trial duration (s) of each row
+        :param row_units: unit (index) of each row - the rows of each unit ordered by trial
+        :param n_units: number of units
+        :return: (unit,) drift metrics - NaN for the units without rows
+        """
+        row_units = np.asarray(row_units, dtype=int)
+        order = np.argsort(row_units, kind='stable')
+        row_units = row_units[order]
+        trial_spike_rates = (np.asarray(trial_spike_counts) / np.asarray(trial_durations, dtype=float))[order]
+
+        units, unit_starts, n_trials = np.unique(row_units, return_index=True, return_counts=True)
+        kernel = np.ones(cls.window_size) / cls.window_size
+
+        drift_metrics = np.full(n_units, np.nan)
+        for n in np.unique(n_trials):
+            # -- unit x trial spike-rates (spikes/sec) of the units with n trials
+            group = n_trials == n
+            spike_rates = trial_spike_rates[unit_starts[group][:, None] + np.arange(n)]
+            mean_spike_rates = np.mean(spike_rates, axis=1)
+            # -- moving-average - as np.convolve(rates, kernel, 'same') on each unit
+            padded = np.pad(spike_rates, ((0, 0), (cls.window_size - 1, cls.window_size - 1)))
+            full = np.lib.stride_tricks.sliding_window_view(padded, cls.window_size, axis=1) @ kernel[::-1]
+            same_size = max(n, cls.window_size)
+            start = (n + cls.window_size - 1 - same_size) // 2
+            processed_trial_spike_rates = full[:, start:start + same_size]
+            # -- down-sample
+            processed_trial_spike_rates = processed_trial_spike_rates[:, ::cls.ds_factor]
+            # -- compute drift_qc from poisson distribution
+            poisson_cdf = poisson.cdf(processed_trial_spike_rates, mean_spike_rates[:, None])
+            instability = (np.logical_or(poisson_cdf > 0.95, poisson_cdf < 0.05).sum(axis=1)
+                           / poisson_cdf.shape[1])
+            drift_metrics[units[group]] = instability
+
+        return drift_metrics
 
 
 #TODO: confirm the logic/need for this table
@@ -453,10 +453,10 @@ def _export_recording(insert_key, output_dir='./', filename=None, overwrite=Fals
     print('... histology:', end='')
     unit_ccfs = []
     for ccf_tbl in (histology.ElectrodeCCFPosition.ElectrodePosition, histology.ElectrodeCCFPosition.ElectrodePositionError):
-        unit_ccf = (ephys.Unit * ccf_tbl & insert_key & {'clustering_method': clustering_method}).aggr(
-            ccf.CCFAnnotation, ..., annotation='IFNULL(annotation, "")', keep_all_rows=True).fetch(
-            'unit', 'ccf_x', 'ccf_y', 'ccf_z', 'annotation', order_by='unit')
-        unit_ccfs.extend(list(zip(*unit_ccf)))
+        unit, ccf_x, ccf_y, ccf_z = (ephys.Unit * ccf_tbl & insert_key & {'clustering_method': clustering_method}).fetch(
+            'unit', 'ccf_x', 'ccf_y', 'ccf_z', order_by='unit')
+        anno = [a or '' for a in ccf.get_annotation_volume().lookup(np.column_stack([ccf_x, ccf_y, ccf_z]))]
+        unit_ccfs.extend(list(zip(unit, ccf_x, ccf_y, ccf_z, anno)))
 
     if unit_ccfs:
         unit_id, ccf_x, ccf_y, ccf_z, anno = zip(*sorted(unit_ccfs, key=lambda x: x[0]))
@@ -261,44 +261,45 @@ def retrieve_pseudocoronal_slice(probe_insertion, shank_no=1):
         'ccf_z', 'ccf_y', 'ccf_x', order_by='ccf_y'))))
     coords = np.vstack([electrode_coords, probe_track_coords])
 
-    # ---- linear fit of probe in DV-AP axis ----
-    X = np.asmatrix(np.hstack((np.ones((coords.shape[0], 1)), coords[:, 1][:, np.newaxis])))  # DV
+    _, dv_max, _ = ccf.get_ccf_xyz_max()
 
-    y = np.asmatrix(coords[:, 0]).T  # AP
-    XtX = X.T * X
-    Xty = X.T * y
-    ap_fit = np.linalg.solve(XtX, Xty)
+    return sample_pseudocoronal_slice(coords, ccf.get_annotation_volume(), dv_max)
 
-    y = np.asmatrix(coords[:, 2]).T  # ML
-    XtX = X.T * X
-    Xty = X.T * y
-    ml_fit = np.linalg.solve(XtX, Xty)
 
-    # ---- predict x coordinates ----
-    voxel_res = ccf.CCFLabel.CCF_R3_20UM_RESOLUTION
-    lr_max, dv_max, _ = ccf.get_ccf_xyz_max()
-
-    dv_coords = np.arange(0, dv_max, voxel_res)
-
-    X2 = np.asmatrix(np.hstack((np.ones((len(dv_coords), 1)), dv_coords[:, np.newaxis])))
-
-    ap_coords = np.array(X2 * ap_fit).flatten().astype(np.int)
-    ml_coords = np.array(X2 * ml_fit).flatten().astype(np.int)
-
-    # round to the nearest voxel resolution
-    ap_coords = (voxel_res * np.round(ap_coords / voxel_res)).astype(np.int)
-    ml_coords = (voxel_res * np.round(ml_coords / voxel_res)).astype(np.int)
+def sample_pseudocoronal_slice(coords, volume, dv_max):
+    """
+    Sample the pseudocoronal slice through the (AP, DV, ML) "coords" of a shank from the
+    annotation volume "volume" (ccf.AnnotationVolume): the AP and ML of the slice are
+    linear fits in DV of "coords", at each voxel DV from 0 to "dv_max"
+    :return: see retrieve_pseudocoronal_slice()
+    """
+    voxel_res = volume.voxel_res
 
-    # ---- extract pseudoconoral plane from DB ----
-    q_ccf = ccf.CCFAnnotation * ccf.CCFBrainRegion.proj(..., annotation='region_name')
-    dv_pts, lr_pts, ap_pts, color_codes = (
-            q_ccf & [{'ccf_y': dv, 'ccf_z': ap} for ap, dv in zip(ap_coords, dv_coords)]).fetch(
-        'ccf_y', 'ccf_x', 'ccf_z', 'color_code', order_by='ccf_y')
+    # ---- linear fit of probe in DV-AP and DV-ML axes ----
+    X = np.column_stack([np.ones(len(coords)), coords[:, 1]])  # DV
+    ap_fit, ml_fit = np.linalg.solve(X.T @ X, X.T @ coords[:, [0, 2]]).T
 
-    # ---- CCF coords for voxels on the interpolated probe/shank track ----
-    coronal_point_cloud = set(zip(lr_pts, dv_pts, ap_pts))  # ML, DV, AP
-    shank_ccfs = np.vstack([(ml, dv, ap)
-                            for dv, ap, ml in zip(dv_coords, ap_coords, ml_coords)
-                            if (ml, dv, ap) in coronal_point_cloud])
+    # ---- predict AP and ML coordinates, rounded to the nearest voxel ----
+    dv_coords = np.arange(0, dv_max, voxel_res)
+    X2 = np.column_stack([np.ones(len(dv_coords)), dv_coords])
+
+    ap_coords = (voxel_res * np.round((X2 @ ap_fit).astype(int) / voxel_res)).astype(int)
+    ml_coords = (voxel_res * np.round((X2 @ ml_fit).astype(int) / voxel_res)).astype(int)
+
+    # ---- sample the pseudocoronal plane (all ML voxels at each DV, AP) from the volume ----
+    dv_idx, ap_idx = dv_coords // voxel_res, ap_coords // voxel_res
+    in_volume = ((dv_idx >= 0) & (dv_idx < volume.labels.shape[1])
+                 & (ap_idx >= 0) & (ap_idx < volume.labels.shape[2]))
+    plane = np.asarray(volume.labels[:, dv_idx[in_volume], ap_idx[in_volume]]).T  # (DV, ML)
+
+    dv_i, lr_i = np.nonzero(plane >= 0)  # annotated voxels, by DV then ML
+    dv_pts = dv_coords[in_volume][dv_i]
+    ap_pts = ap_coords[in_volume][dv_i]
+    lr_pts = lr_i * voxel_res
+    color_codes = volume.regions['color_code'][plane[dv_i, lr_i]]
+
+    # ---- CCF coords for (annotated) voxels on the interpolated probe/shank track ----
+    shank_ccfs = np.column_stack([ml_coords, dv_coords, ap_coords])  # ML, DV, AP
+    shank_ccfs = shank_ccfs[volume.region_index(shank_ccfs) >= 0]
 
     return np.vstack([dv_pts, lr_pts, ap_pts, color_codes]).T, shank_ccfs
@@ -4,10 +4,13 @@ import os
 import logging
 import re
 import pathlib
+import tempfile
+import pickle
 
 from datetime import date, datetime
 from collections import namedtuple
 import time as timer
+from concurrent.futures import ProcessPoolExecutor
 
 import scipy.io as spio
 import numpy as np
@@ -18,6 +21,7 @@ import datajoint as dj
 
 from pybpodgui_api.models.project import Project as BPodProject
 from . import util, InvalidBehaviorTrialError
+from .file_index import FileIndex
 
 from pipeline import lab, experiment
 from pipeline import get_schema_name, dict_to_hash
@@ -78,6 +82,35 @@ def get_behavior_paths():
     return sorted(paths, key=lambda x: x[-1])
 
 
+def get_behavior_file_index_path():
+    '''
+    retrieve the location of the local behavior file index (see file_index.FileIndex),
+    from dj.config['custom']['behavior_file_index'] - defaults to a file in the system temp directory
+    '''
+    index_path = dj.config.get('custom', {}).get('behavior_file_index', None)
+    if index_path is None:
+        index_path = pathlib.Path(tempfile.gettempdir(), 'map_behavior_file_index.sqlite')
+
+    return pathlib.Path(index_path)
+
+
+def get_behavior_ingest_workers():
+    '''
+    retrieve the number of worker processes used to parse the behavior files
+    in BehaviorIngest.populate() from dj.config (default: 1, parsing serially)
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'behavior_ingest_workers': 4
+        }
+        ...
+      }
+    '''
+    return int(dj.config.get('custom', {}).get('behavior_ingest_workers', 1))
+
+
 def get_session_user():
     '''
     Determine desired 'session user' for a session.
@@ -135,17 +168,12 @@ class BehaviorIngest(dj.Imported):
         h2os = {k: v for k, v in zip(*lab.WaterRestriction().fetch(
             'water_restriction_number', 'subject_id'))}
 
-        def buildrec(rig, rigpath, root, f):
+        def buildrec(rig, rigpath, subpath):
 
-            if not re.match(rexp, f):
-                log.debug("{f} skipped - didn't match rexp".format(f=f))
-                return
+            f = subpath.name
 
             log.debug('found file {f}'.format(f=f))
 
-            fullpath = pathlib.Path(root, f)
-            subpath = fullpath.relative_to(rigpath)
-
             fsplit = subpath.stem.split('_')
             h2o = fsplit[0]
             ymd = fsplit[-2:-1][0]
@@ -173,41 +201,75 @@ class BehaviorIngest(dj.Imported):
         known = set(BehaviorIngest.BehaviorFile().fetch('behavior_file'))
         rigs = get_behavior_paths()
 
+        # only the rig directories modified since the last scan are re-listed
+        file_index = FileIndex(get_behavior_file_index_path(), rexp)
+
         for (rig, rigpath, _) in rigs:
             rigpath = pathlib.Path(rigpath)
 
-            log.info('RigDataFile.make(): traversing {}'.format(rigpath))
-            for root, dirs, files in os.walk(rigpath):
-                log.debug('RigDataFile.make(): entering {}'.format(root))
-                for f in files:
-                    log.debug('RigDataFile.make(): visiting {}'.format(f))
-                    r = buildrec(rig, rigpath, root, f)
-                    if not r:
-                        continue
-                    if f in set.union(known, found):
-                        log.info('skipping already ingested file {}'.format(
-                            r['subpath']))
-                    else:
-                        found.add(f)  # block duplicate path conf
-                        recs.append(r)
+            log.info('RigDataFile.make(): indexing {}'.format(rigpath))
+            for subpath, _, _ in file_index.refresh(rigpath):
+                f = subpath.name
+                if f in known or f in found:
+                    log.debug('skipping already ingested file {}'.format(
+                        subpath.as_posix()))
+                    continue
+                r = buildrec(rig, rigpath, subpath)
+                if r:
+                    found.add(f)  # block duplicate path conf
+                    recs.append(r)
 
         return recs
 
     def populate(self, *args, **kwargs):
         # 'populate' which won't require upstream tables
         # 'reserve_jobs' not parallel, overloaded to mean "don't exit on error"
-        for k in self.key_source:
+        # with get_behavior_ingest_workers() > 1, the behavior files are parsed in a process pool,
+        # while the parsed sessions are inserted here, each in its own transaction
+        n_workers = get_behavior_ingest_workers()
+        keys = self.key_source
+
+        if n_workers <= 1 or len(keys) <= 1:
+            for k in keys:
+                try:
+                    with dj.conn().transaction:
+                        self.make(k)
+                except Exception as e:
+                    log.warning('session key {} error: {}'.format(k, repr(e)))
+                    if not kwargs.get('reserve_jobs', False):
+                        raise
+            return
+
+        for k, parsed in self._parse_behavior_files(keys, n_workers):
             try:
                 with dj.conn().transaction:
-                    self.make(k)
+                    self._insert(k, *parsed.result())
             except Exception as e:
                 log.warning('session key {} error: {}'.format(k, repr(e)))
                 if not kwargs.get('reserve_jobs', False):
                     raise
 
-    def make(self, key):
-        log.info('BehaviorIngest.make(): key: {key}'.format(key=key))
+    @classmethod
+    def _parse_behavior_files(cls, keys, n_workers):
+        """
+        Parse the behavior files of the specified keys in a local pool of "n_workers" processes,
+        with at most 2 * n_workers files parsed ahead of the insertion
+        :return: generator of (key, future of parse_behavior_file()), in the order of "keys"
+        """
+        log.info('BehaviorIngest.populate(): parsing {} behavior files - {} workers'.format(
+            len(keys), n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pending = []
+            for k in keys:
+                pending.append((k, executor.submit(
+                    parse_behavior_file, cls._session_key(k),
+                    pathlib.Path(k['rig_data_path'], k['subpath']))))
+                if len(pending) >= 2 * n_workers:
+                    yield pending.pop(0)
+            while pending:
+                yield pending.pop(0)
 
+    def make(self, key):
         # File paths conform to the pattern:
         # dl7/TW_autoTrain/Session Data/dl7_TW_autoTrain_20180104_132813.mat
         # which is, more generally:
@@ -215,18 +277,27 @@ class BehaviorIngest(dj.Imported):
 
         path = pathlib.Path(key['rig_data_path'], key['subpath'])
 
-        # distinguishing "delay-response" task or "multi-target-licking" task
-        task_type = detect_task_type(path)
-
-        # skip too small behavior file (only for 'delay-response' task)
-        if task_type == 'delay-response' and os.stat(path).st_size / 1024 < 1000:
-            log.info('skipping file {} - too small'.format(path))
-            return
-
         log.debug('loading file {}'.format(path))
 
         # Read from behavior file and parse all trial info (the heavy lifting here)
-        skey, rows = BehaviorIngest._load(key, path, task_type)
+        self._insert(key, *parse_behavior_file(self._session_key(key), path))
+
+    def _insert(self, key, task_type, skey, rows):
+        """
+        Insert a session parsed by parse_behavior_file() - synthesizing its session ID
+        """
+        log.info('BehaviorIngest.make(): key: {key}'.format(key=key))
+
+        # skipped behavior file (see parse_behavior_file())
+        if rows is None:
+            log.info('skipping file {} - too small or without valid trials'.format(
+                pathlib.Path(key['rig_data_path'], key['subpath'])))
+            return
+
+        skey['session'] = self._synthesize_session_id(skey)
+        for table_rows in rows.values():
+            for r in table_rows:
+                r['session'] = skey['session']
 
         # Session Insertion
 
@@ -340,6 +411,23 @@ class BehaviorIngest(dj.Imported):
         """
         path = pathlib.Path(path)
 
+        skey = cls._session_key(key)
+        skey['session'] = cls._synthesize_session_id(skey)
+
+        if task_type == 'multi-target-licking':
+            rows = load_multi_target_licking_matfile(skey, path)
+        elif task_type == 'delay-response':
+            rows = load_delay_response_matfile(skey, path)
+        else:
+            raise ValueError('Unknown task-type: {}'.format(task_type))
+
+        return skey, rows
+
+    @staticmethod
+    def _session_key(key):
+        """
+        Session key of a behavior file (without session ID) - as expected by parse_behavior_file()
+        """
         h2o = (lab.WaterRestriction() & {'subject_id': key['subject_id']}).fetch1(
             'water_restriction_number')
 
@@ -354,22 +442,106 @@ class BehaviorIngest(dj.Imported):
         skey['username'] = get_session_user()
         skey['rig'] = key['rig']
         skey['h2o'] = h2o
-        # synthesizing session ID
+
+        return skey
+
+    @staticmethod
+    def _synthesize_session_id(skey):
         log.debug('synthesizing session ID')
         session = (dj.U().aggr(experiment.Session()
                                & {'subject_id': skey['subject_id']},
                                n='max(session)').fetch1('n') or 0) + 1
         log.info('generated session id: {session}'.format(session=session))
-        skey['session'] = session
+        return session
 
-        if task_type == 'multi-target-licking':
-            rows = load_multi_target_licking_matfile(skey, path)
-        elif task_type == 'delay-response':
-            rows = load_delay_response_matfile(skey, path)
-        else:
-            raise ValueError('Unknown task-type: {}'.format(task_type))
 
-        return skey, rows
+# BPod session, as listed in a BPodSessionCatalog
+BPodSession = namedtuple('BPodSession', ('path', 'name', 'subjects', 'started',
+                                         'setup_name', 'experiment_name'))
+
+
+def load_bpod_project_sessions(project_path):
+    """
+    Load the sessions of a BPod project
+    :return: list of BPodSession
+    """
+    project = BPodProject()
+    project.load(project_path)
+    return [BPodSession(session.path, session.name, list(session.subjects), session.started,
+                        session.setup_name, exp.name)
+            for exp in project.experiments for stp in exp.setups for session in stp.sessions]
+
+
+class BPodSessionCatalog:
+    """
+    Sessions of BPod projects, indexed by date.
+
+    The catalog is kept in a snapshot file, along with the mtimes of the directories of each project
+    down to the session directories - only the projects with a modified directory
+    (e.g. with a new session) are reloaded from their project directory.
+    """
+
+    def __init__(self, project_paths, snapshot_path, load_project=load_bpod_project_sessions):
+        self.project_paths = [pathlib.Path(p).as_posix() for p in project_paths]
+        self.snapshot_path = pathlib.Path(snapshot_path)
+        self.load_project = load_project
+
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            snapshot = {}
+
+        updated = False
+        self.projects = {}
+        for project_path in self.project_paths:
+            mtimes = self._project_mtimes(project_path)
+            if project_path in snapshot and snapshot[project_path]['mtimes'] == mtimes:
+                self.projects[project_path] = snapshot[project_path]
+            else:
+                log.info('BPodSessionCatalog: loading BPod project {}'.format(project_path))
+                self.projects[project_path] = {'mtimes': mtimes,
+                                               'sessions': self.load_project(project_path)}
+                updated = True
+
+        if updated:
+            self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.snapshot_path, 'wb') as f:
+                pickle.dump(self.projects, f)
+
+        # {date (YYYYMMDD): [BPodSession]}
+        self._index = {}
+        for project_path in self.project_paths:
+            for session in self.projects[project_path]['sessions']:
+                if session.subjects:
+                    self._index.setdefault(session.name[:8], []).append(session)
+
+    @staticmethod
+    def _project_mtimes(project_path):
+        """ mtimes of the directories of a BPod project, down to the session directories """
+        mtimes = {}
+        pending = [(pathlib.Path(project_path), 0)]
+        while pending:
+            d, depth = pending.pop()
+            try:
+                mtimes[d.as_posix()] = os.stat(d).st_mtime
+            except FileNotFoundError:
+                continue
+            # project/experiments/<experiment>/setups/<setup>/sessions/<session>
+            if depth < 6:
+                with os.scandir(d) as entries:
+                    pending.extend((pathlib.Path(e.path), depth + 1) for e in entries
+                                   if e.is_dir() and (depth % 2 or e.name in ('experiments', 'setups', 'sessions')))
+        return mtimes
+
+    def sessions(self, subject, date_str):
+        """
+        BPod sessions of a subject (water restriction number) at a date
+        :param date_str: date (YYYYMMDD)
+        :return: list of BPodSession - in project, experiment and setup order
+        """
+        return [session for session in self._index.get(date_str, [])
+                if session.subjects[0].find(subject) > -1 and session.name.startswith(date_str)]
 
 
 @schema
@@ -388,14 +560,17 @@ class BehaviorBpodIngest(dj.Imported):
     water_port_name_mapper = {'left': 'L', 'right': 'R', 'middle': 'M'}
 
     @staticmethod
-    def get_bpod_projects():
-        projectdirs = dj.config.get('custom', {}).get('behavior_bpod', []).get('project_paths')
-        # construct a list of BPod Projects
-        projects = []
-        for projectdir in projectdirs:
-            projects.append(BPodProject())
-            projects[-1].load(projectdir)
-        return projects
+    def get_bpod_catalog():
+        """
+        BPodSessionCatalog of the BPod projects in dj.config['custom']['behavior_bpod']['project_paths'],
+        snapshot in dj.config['custom']['behavior_bpod']['catalog_path']
+        (defaults to a file in the system temp directory)
+        """
+        bpod_config = dj.config.get('custom', {}).get('behavior_bpod', {})
+        catalog_path = bpod_config.get('catalog_path', None)
+        if catalog_path is None:
+            catalog_path = pathlib.Path(tempfile.gettempdir(), 'map_bpod_session_catalog.pickle')
+        return BPodSessionCatalog(bpod_config.get('project_paths'), catalog_path)
 
     @property
     def key_source(self):
@@ -447,7 +622,7 @@ class BehaviorBpodIngest(dj.Imported):
 
     def populate(self, *args, **kwargs):
         # Load project info (just once)
-        self.projects = self.get_bpod_projects()
+        self.catalog = self.get_bpod_catalog()
 
         # 'populate' which won't require upstream tables
         # 'reserve_jobs' not parallel, overloaded to mean "don't exit on error"                          
@@ -471,18 +646,11 @@ class BehaviorBpodIngest(dj.Imported):
         log.info('h2o: {h2o}, date: {d}'.format(h2o=subject_now, d=date_now_str))
 
         # ---- Ingest information for BPod projects ----
-        sessions_now, session_start_times_now, experimentnames_now = [], [], []
-        for proj in self.projects:  #
-            exps = proj.experiments
-            for exp in exps:
-                stps = exp.setups
-                for stp in stps:
-                    for session in stp.sessions:
-                        if (session.subjects and session.subjects[0].find(subject_now) > -1
-                                and session.name.startswith(date_now_str)):
-                            sessions_now.append(session)
-                            session_start_times_now.append(session.started)
-                            experimentnames_now.append(exp.name)
+        if not hasattr(self, 'catalog'):
+            self.catalog = self.get_bpod_catalog()
+        sessions_now = self.catalog.sessions(subject_now, date_now_str)
+        session_start_times_now = [session.started for session in sessions_now]
+        experimentnames_now = [session.experiment_name for session in sessions_now]
         bpodsess_order = np.argsort(session_start_times_now)
 
         # --- Handle missing BPod session ---
@@ -491,17 +659,13 @@ class BehaviorBpodIngest(dj.Imported):
             return
 
         # ---- Concatenate bpod sessions (and corresponding trials) into one datajoint session ----
-        tbls_2_insert = ('sess_trial', 'behavior_trial', 'trial_note',
-                         'sess_block', 'sess_block_trial',
-                         'trial_choice', 'trial_event', 'action_event',
-                         'photostim', 'photostim_location', 'photostim_trial',
-                         'photostim_trial_event',
-                         'valve_setting', 'valve_open_dur', 'available_reward')
+        tbls_2_insert = bpod_tbls_2_insert
 
         # getting started
         concat_rows = {k: list() for k in tbls_2_insert}
         sess_key = None
         trial_num = 0  # trial numbering starts at 1
+        trial_uid_start = len(experiment.SessionTrial & {'subject_id': subject_id_now}) + 1
 
         for s_idx, session_idx in enumerate(bpodsess_order):
             session = sessions_now[session_idx]
@@ -584,227 +748,13 @@ class BehaviorBpodIngest(dj.Imported):
                 water_port_channels[lick_port] = df_behavior_session[chn_varname][0]
 
             # ---- Ingestion of trials ----
-
-            # extracting trial data
-            session_start_time = datetime.combine(sess_key['session_date'],
-                                                  sess_key['session_time'])
-            trial_start_idxs = df_behavior_session[(df_behavior_session['TYPE'] == 'TRIAL') & (
-                        df_behavior_session['MSG'] == 'New trial')].index
-            trial_start_idxs = pd.Index([0]).append(
-                trial_start_idxs[1:])  # so the random seed will be present
-            trial_end_idxs = trial_start_idxs[1:].append(
-                pd.Index([(max(df_behavior_session.index))]))
-            # trial_end_idxs = df_behavior_session[(df_behavior_session['TYPE'] == 'END-TRIAL')].index
-            prevtrialstarttime = np.nan
-            blocknum_local_prev = np.nan
-
-            # getting ready
-            rows = {k: list() for k in
-                    tbls_2_insert}  # lists of various records for batch-insert
-
-            for trial_start_idx, trial_end_idx in zip(trial_start_idxs, trial_end_idxs):
-                df_behavior_trial = df_behavior_session[trial_start_idx:trial_end_idx + 1]
-
-                # Trials without GoCue are skipped
-                if not len(
-                        df_behavior_trial['PC-TIME'][(df_behavior_trial['MSG'] == 'GoCue') & (
-                                df_behavior_trial['TYPE'] == 'TRANSITION')]):
-                    continue
-
-                # ---- session trial ----
-                trial_num += 1  # increment trial number
-                trial_uid = len(experiment.SessionTrial & {'subject_id': subject_id_now}) + 1
-                trial_start_time = df_behavior_session['PC-TIME'][
-                                       trial_start_idx].to_pydatetime() - session_start_time
-                trial_stop_time = df_behavior_session['PC-TIME'][
-                                      trial_end_idx].to_pydatetime() - session_start_time
-
-                sess_trial_key = {**sess_key,
-                                  'trial': trial_num,
-                                  'trial_uid': trial_uid,
-                                  'start_time': trial_start_time.total_seconds(),
-                                  'stop_time': trial_stop_time.total_seconds()}
-                rows['sess_trial'].append(sess_trial_key)
-
-                # ---- session block ----
-                if 'Block_number' in df_behavior_session:
-                    if np.isnan(df_behavior_trial['Block_number'].to_list()[0]):
-                        blocknum_local = 0 if np.isnan(
-                            blocknum_local_prev) else blocknum_local_prev
-                    else:
-                        blocknum_local = int(
-                            df_behavior_trial['Block_number'].to_list()[0]) - 1
-                        blocknum_local_prev = blocknum_local
-
-                    reward_probability = {}
-                    for lick_port in lick_ports:
-                        p_reward_varname = 'var:reward_probabilities_{}'.format(
-                            self.water_port_name_mapper[lick_port])
-                        reward_probability[lick_port] = decimal.Decimal(
-                            df_behavior_session[p_reward_varname][0][blocknum_local]).quantize(
-                            decimal.Decimal(
-                                '.001'))  # Note: Reward probabilities never changes during a **bpod** session
-
-                    # determine if this is a new block: compare reward probability with the previous block
-                    if rows['sess_block']:
-                        itsanewblock = dict_to_hash(reward_probability) != dict_to_hash(
-                            rows['sess_block'][-1]['reward_probability'])
-                    else:
-                        itsanewblock = True
-
-                    if itsanewblock:
-                        all_blocks = [b['block'] for b in
-                                      rows['sess_block'] + concat_rows['sess_block']]
-                        block_num = (np.max(all_blocks) + 1 if all_blocks else 1)
-                        rows['sess_block'].append({**sess_key,
-                                                   'block': block_num,
-                                                   'block_start_time': trial_start_time.total_seconds(),
-                                                   'reward_probability': reward_probability})
-                    else:
-                        block_num = rows['sess_block'][-1]['block']
-
-                    rows['sess_block_trial'].append({**sess_trial_key, 'block': block_num})
-
-                # ---- WaterPort Choice ----
-                trial_choice = {'water_port': None}
-                for lick_port in lick_ports:
-                    if any((df_behavior_trial['MSG'] == 'Choice_{}'.format(
-                            self.water_port_name_mapper[lick_port]))
-                           & (df_behavior_trial['TYPE'] == 'TRANSITION')):
-                        trial_choice['water_port'] = lick_port
-                        break
-
-                rows['trial_choice'].append({**sess_trial_key, **trial_choice})
-
-                # ---- Trial events ----
-                time_TrialStart = df_behavior_session['PC-TIME'][trial_start_idx].to_numpy()
-                time_GoCue = df_behavior_trial['PC-TIME'][
-                    (df_behavior_trial['MSG'] == 'GoCue') & (
-                                df_behavior_trial['TYPE'] == 'TRANSITION')].to_numpy()
-
-                lick_times = {}
-                for lick_port in lick_ports:
-                    lick_times[lick_port] = df_behavior_trial['PC-TIME'][(
-                                df_behavior_trial['+INFO'] == water_port_channels[
-                            lick_port])].to_numpy()
-
-                # early lick
-                early_lick = 'no early'
-                for lick_port in lick_ports:
-                    if any(lick_times[lick_port] - time_GoCue < np.timedelta64(0)):
-                        early_lick = 'early'
-                        break
-                # outcome
-                outcome = 'miss' if trial_choice['water_port'] else 'ignore'
-                for lick_port in lick_ports:
-                    if any((df_behavior_trial['MSG'] == 'Reward_{}'.format(
-                            self.water_port_name_mapper[lick_port]))
-                           & (df_behavior_trial['TYPE'] == 'TRANSITION')):
-                        outcome = 'hit'
-                        break
-
-                # ---- accumulated reward ----
-                for lick_port in lick_ports:
-                    reward_var_name = 'reward_{}_accumulated'.format(
-                        self.water_port_name_mapper[lick_port])
-                    if reward_var_name not in df_behavior_trial:
-                        log.error('Bpod CSV KeyError: {} - Available columns: {}'.format(
-                            reward_var_name, df_behavior_trial.columns))
-                        return
-
-                    reward = df_behavior_trial[reward_var_name].values[0]
-                    rows['available_reward'].append({
-                        **sess_trial_key, 'water_port': lick_port,
-                        'reward_available': False if np.isnan(reward) else reward})
-
-                # ---- auto water and notes ----
-                auto_water = False
-                auto_water_times = {}
-                for lick_port in lick_ports:
-                    auto_water_varname = 'Auto_Water_{}'.format(
-                        self.water_port_name_mapper[lick_port])
-                    auto_water_ind = (df_behavior_trial['TYPE'] == 'STATE') & (
-                                df_behavior_trial['MSG'] == auto_water_varname)
-                    if any(auto_water_ind):
-                        auto_water = True
-                        auto_water_times[lick_port] = float(
-                            df_behavior_trial['+INFO'][auto_water_ind.idxmax()])
-
-                if auto_water_times:
-                    auto_water_ports = [k for k, v in auto_water_times.items() if v > 0.001]
-                    rows['trial_note'].append({**sess_trial_key,
-                                               'trial_note_type': 'autowater',
-                                               'trial_note': 'and '.join(auto_water_ports)})
-
-                # add random seed start note
-                if any(df_behavior_trial['MSG'] == 'Random seed:'):
-                    seedidx = (df_behavior_trial['MSG'] == 'Random seed:').idxmax() + 1
-                    rows['trial_note'].append({**sess_trial_key,
-                                               'trial_note_type': 'random_seed_start',
-                                               'trial_note': str(
-                                                   df_behavior_trial['MSG'][seedidx])})
-
-                # ---- Behavior Trial ----
-                rows['behavior_trial'].append({**sess_trial_key,
-                                               'task': task,
-                                               'task_protocol': task_protocol,
-                                               'trial_instruction': 'none',
-                                               'early_lick': early_lick,
-                                               'outcome': outcome,
-                                               'auto_water': auto_water,
-                                               'free_water': False})  # TODO: verify this
-
-                # ---- Water Valve Setting ----
-                valve_setting = {**sess_trial_key}
-
-                if 'var_motor:LickPort_Lateral_pos' in df_behavior_trial.keys():
-                    valve_setting['water_port_lateral_pos'] = \
-                        df_behavior_trial['var_motor:LickPort_Lateral_pos'].values[0]
-                if 'var_motor:LickPort_RostroCaudal_pos' in df_behavior_trial.keys():
-                    valve_setting['water_port_rostrocaudal_pos'] = \
-                        df_behavior_trial['var_motor:LickPort_RostroCaudal_pos'].values[0]
-                if 'var_motor:LickPort_DorsoVentral_pos' in df_behavior_trial.keys():
-                    valve_setting['water_port_dorsoventral_pos'] = \
-                        df_behavior_trial['var_motor:LickPort_DorsoVentral_pos'].values[0]
-
-                rows['valve_setting'].append(valve_setting)
-
-                for lick_port in lick_ports:
-                    valve_open_varname = 'var:ValveOpenTime_{}'.format(
-                        self.water_port_name_mapper[lick_port])
-                    if valve_open_varname in df_behavior_trial:
-                        rows['valve_open_dur'].append({
-                            **sess_trial_key, 'water_port': lick_port,
-                            'open_duration': df_behavior_trial[valve_open_varname].values[0]})
-
-                # ---- Trial Event and Action Event ----
-
-                # -- add Go Cue
-                GoCueTimes = (time_GoCue - time_TrialStart) / np.timedelta64(1, 's')
-                GoCueTimes[
-                    GoCueTimes > 9999] = 9999  # Wordaround for bug #9: BPod protocol was paused and then
-                # resumed after an impossible long period of time (> decimal(8, 4)).
-
-                rows['trial_event'].extend(
-                    [{**sess_trial_key, 'trial_event_id': idx, 'trial_event_type': 'go',
-                      'trial_event_time': t, 'duration': 0} for idx, t in
-                     enumerate(GoCueTimes)])
-
-                # -- add licks
-                all_lick_types = np.concatenate(
-                    [[ltype] * len(ltimes) for ltype, ltimes in lick_times.items()])
-                all_lick_times = np.concatenate(
-                    [(ltimes - time_TrialStart) / np.timedelta64(1, 's') for ltimes in
-                     lick_times.values()])
-
-                # sort by lick times
-                sorted_licks = sorted(zip(all_lick_types, all_lick_times), key=lambda x: x[-1])
-
-                rows['action_event'].extend([{**sess_trial_key, 'action_event_id': idx,
-                                              'action_event_type': '{} lick'.format(ltype),
-                                              'action_event_time': ltime} for
-                                             idx, (ltype, ltime)
-                                             in enumerate(sorted_licks)])
+            rows = parse_bpod_session_trials(
+                df_behavior_session, sess_key, lick_ports, water_port_channels, task, task_protocol,
+                first_trial=trial_num + 1, first_block=len(concat_rows['sess_block']) + 1,
+                trial_uid_start=trial_uid_start)
+            if rows is None:
+                return
+            trial_num += len(rows['sess_trial'])
 
             # add to the session-concat
             for tbl in tbls_2_insert:
@@ -870,15 +820,302 @@ class BehaviorBpodIngest(dj.Imported):
 
 # --------------------- HELPER LOADER FUNCTIONS -----------------
 
-def detect_task_type(path):
+bpod_tbls_2_insert = ('sess_trial', 'behavior_trial', 'trial_note',
+                      'sess_block', 'sess_block_trial',
+                      'trial_choice', 'trial_event', 'action_event',
+                      'photostim', 'photostim_location', 'photostim_trial',
+                      'photostim_trial_event',
+                      'valve_setting', 'valve_open_dur', 'available_reward')
+
+
+def _bpod_trial_rows(mask, trial_starts):
+    """
+    Rows (sorted by trial, then row) of a pybpod session dataframe selected by "mask", with their trial index -
+    a trial spans from its 'New trial' row up to (and including) the 'New trial' row of the next trial,
+    so that the rows at a trial boundary belong to both trials
+    """
+    rows = np.flatnonzero(mask)
+    trials = np.searchsorted(trial_starts, rows, side='right') - 1
+    boundary = np.isin(rows, trial_starts[1:])
+    rows = np.concatenate([rows, rows[boundary]])
+    trials = np.concatenate([trials, trials[boundary] - 1])
+    order = np.lexsort((rows, trials))
+    return rows[order], trials[order]
+
+
+def parse_bpod_session_trials(df_behavior_session, sess_key, lick_ports, water_port_channels,
+                              task, task_protocol, first_trial=1, first_block=1, trial_uid_start=1):
+    """
+    Parse the trials of one pybpod session (as loaded by util.load_and_parse_a_csv_file())
+    - the trial events, licks, water-port choices and blocks are derived for all trials at once,
+    trials without GoCue are skipped
+    :param sess_key: session key of the datajoint session
+    :param lick_ports: list of the lick ports of the task (see BehaviorBpodIngest.water_port_name_mapper)
+    :param water_port_channels: {lick_port: '+INFO' of the lick events of this port}
+    :param first_trial: number of the first trial of this pybpod session (in the datajoint session)
+    :param first_block: number of the first block of this pybpod session (in the datajoint session)
+    :param trial_uid_start: trial_uid of the trial number 1 of the datajoint session
+    :return: rows - dictionary of the rows to be inserted, for each of "bpod_tbls_2_insert"
+             (None if a required column is missing)
+    """
+    water_port_name_mapper = BehaviorBpodIngest.water_port_name_mapper
+
+    df = df_behavior_session
+    msgs = df['MSG'].to_numpy()
+    is_transition = (df['TYPE'] == 'TRANSITION').to_numpy()
+    pc_time = df['PC-TIME'].to_numpy().astype('datetime64[us]')
+    infos = df['+INFO'].to_numpy()
+
+    def to_seconds(timedelta):
+        return timedelta.astype('timedelta64[us]').astype(np.int64) / 1e6
+
+    # ---- segment trials ----
+    trial_starts = np.flatnonzero((df['TYPE'] == 'TRIAL') & (df['MSG'] == 'New trial'))
+    trial_starts = np.concatenate([[0], trial_starts[1:]])  # so the random seed will be present
+    trial_ends = np.append(trial_starts[1:], len(df) - 1)
+    n_trials = len(trial_starts)
+
+    def any_per_trial(mask):
+        _, trials = _bpod_trial_rows(mask, trial_starts)
+        return np.bincount(trials, minlength=n_trials) > 0
+
+    def first_per_trial(mask):
+        rows, trials = _bpod_trial_rows(mask, trial_starts)
+        trials, first_idx = np.unique(trials, return_index=True)
+        first = np.full(n_trials, -1)
+        first[trials] = rows[first_idx]
+        return first
+
+    # Trials without GoCue are skipped
+    go_rows, go_trials = _bpod_trial_rows((msgs == 'GoCue') & is_transition, trial_starts)
+    valid_trials = np.flatnonzero(np.bincount(go_trials, minlength=n_trials))
+    if not len(valid_trials):
+        return {k: list() for k in bpod_tbls_2_insert}
+
+    session_start_time = np.datetime64(datetime.combine(sess_key['session_date'],
+                                                        sess_key['session_time']), 'us')
+    trial_start_times = to_seconds(pc_time[trial_starts] - session_start_time)
+    trial_stop_times = to_seconds(pc_time[trial_ends] - session_start_time)
+
+    # ---- WaterPort Choice and outcome ----
+    trial_choices = np.full(n_trials, None, dtype=object)
+    for lick_port in lick_ports[::-1]:  # the first lick port with a choice
+        trial_choices[any_per_trial(
+            (msgs == 'Choice_{}'.format(water_port_name_mapper[lick_port])) & is_transition)] = lick_port
+
+    is_hit = np.zeros(n_trials, dtype=bool)
+    for lick_port in lick_ports:
+        is_hit |= any_per_trial(
+            (msgs == 'Reward_{}'.format(water_port_name_mapper[lick_port])) & is_transition)
+
+    # ---- licks ----
+    lick_rows, lick_trials, lick_port_idx = [], [], []
+    for port_idx, lick_port in enumerate(lick_ports):
+        rows, trials = _bpod_trial_rows(infos == water_port_channels[lick_port], trial_starts)
+        lick_rows.append(rows)
+        lick_trials.append(trials)
+        lick_port_idx.append(np.full(len(rows), port_idx))
+    lick_rows, lick_trials, lick_port_idx = (np.concatenate(x) for x in (lick_rows, lick_trials, lick_port_idx))
+
+    # sort by trial, then lick times
+    lick_times = to_seconds(pc_time[lick_rows] - pc_time[trial_starts[lick_trials]])
+    lick_order = np.lexsort((lick_rows, lick_port_idx, lick_times, lick_trials))
+    lick_rows, lick_trials, lick_port_idx, lick_times = (
+        x[lick_order] for x in (lick_rows, lick_trials, lick_port_idx, lick_times))
+
+    # early lick - any lick before the GoCue
+    first_go_rows = first_per_trial((msgs == 'GoCue') & is_transition)
+    is_early_lick = np.zeros(n_trials, dtype=bool)
+    is_early_lick[lick_trials[pc_time[lick_rows] < pc_time[first_go_rows[lick_trials]]]] = True
+
+    # GoCue times
+    go_times = to_seconds(pc_time[go_rows] - pc_time[trial_starts[go_trials]])
+    go_times[go_times > 9999] = 9999  # Wordaround for bug #9: BPod protocol was paused and then
+    # resumed after an impossible long period of time (> decimal(8, 4)).
+
+    # ---- accumulated reward ----
+    available_rewards = {}
+    for lick_port in lick_ports:
+        reward_var_name = 'reward_{}_accumulated'.format(water_port_name_mapper[lick_port])
+        if reward_var_name not in df:
+            log.error('Bpod CSV KeyError: {} - Available columns: {}'.format(
+                reward_var_name, df.columns))
+            return
+        available_rewards[lick_port] = df[reward_var_name].to_numpy()[trial_starts]
+
+    # ---- auto water and notes ----
+    auto_water_rows = {lick_port: first_per_trial(
+        (df['TYPE'] == 'STATE').to_numpy()
+        & (msgs == 'Auto_Water_{}'.format(water_port_name_mapper[lick_port])))
+        for lick_port in lick_ports}
+    random_seed_rows = first_per_trial(msgs == 'Random seed:')
+
+    # ---- session block ----
+    if 'Block_number' in df:
+        # block number of the trials, carried over from the last valid trial with a block number
+        block_numbers = pd.Series(df['Block_number'].to_numpy()[trial_starts[valid_trials]] - 1)
+        block_numbers = block_numbers.ffill().fillna(0).astype(int).to_numpy()
+
+        # Note: Reward probabilities never changes during a **bpod** session
+        reward_probabilities = {
+            lick_port: df['var:reward_probabilities_{}'.format(water_port_name_mapper[lick_port])][0]
+            for lick_port in lick_ports}
+        block_reward_probabilities = {
+            block_number: {lick_port: decimal.Decimal(reward_probabilities[lick_port][block_number]).quantize(
+                decimal.Decimal('.001')) for lick_port in lick_ports}
+            for block_number in np.unique(block_numbers)}
+
+        # new block: reward probability different from the previous block
+        is_new_block = np.ones(len(valid_trials), dtype=bool)
+        is_new_block[1:] = [dict_to_hash(block_reward_probabilities[b])
+                            != dict_to_hash(block_reward_probabilities[prev_b])
+                            for prev_b, b in zip(block_numbers[:-1], block_numbers[1:])]
+        trial_blocks = first_block - 1 + np.cumsum(is_new_block)
+
+    # ---- per-trial rows ----
+    rows = {k: list() for k in bpod_tbls_2_insert}
+
+    valve_settings = {name: df[column].to_numpy()[trial_starts] for name, column in (
+        ('water_port_lateral_pos', 'var_motor:LickPort_Lateral_pos'),
+        ('water_port_rostrocaudal_pos', 'var_motor:LickPort_RostroCaudal_pos'),
+        ('water_port_dorsoventral_pos', 'var_motor:LickPort_DorsoVentral_pos')) if column in df}
+    valve_open_durs = {lick_port: df[column].to_numpy()[trial_starts] for lick_port, column in (
+        (lick_port, 'var:ValveOpenTime_{}'.format(water_port_name_mapper[lick_port]))
+        for lick_port in lick_ports) if column in df}
+
+    go_bounds = np.searchsorted(go_trials, np.arange(n_trials + 1))
+    lick_bounds = np.searchsorted(lick_trials, np.arange(n_trials + 1))
+
+    for trial_idx, trial in enumerate(valid_trials):
+
+        # ---- session trial ----
+        trial_num = first_trial + trial_idx
+        sess_trial_key = {**sess_key,
+                          'trial': trial_num,
+                          'trial_uid': trial_uid_start + trial_num - 1,
+                          'start_time': trial_start_times[trial],
+                          'stop_time': trial_stop_times[trial]}
+        rows['sess_trial'].append(sess_trial_key)
+
+        # ---- session block ----
+        if 'Block_number' in df:
+            if is_new_block[trial_idx]:
+                rows['sess_block'].append({**sess_key,
+                                           'block': trial_blocks[trial_idx],
+                                           'block_start_time': trial_start_times[trial],
+                                           'reward_probability': block_reward_probabilities[
+                                               block_numbers[trial_idx]]})
+
+            rows['sess_block_trial'].append({**sess_trial_key, 'block': trial_blocks[trial_idx]})
+
+        # ---- WaterPort Choice ----
+        rows['trial_choice'].append({**sess_trial_key, 'water_port': trial_choices[trial]})
+
+        # ---- accumulated reward ----
+        for lick_port in lick_ports:
+            reward = available_rewards[lick_port][trial]
+            rows['available_reward'].append({
+                **sess_trial_key, 'water_port': lick_port,
+                'reward_available': False if np.isnan(reward) else reward})
+
+        # ---- auto water and notes ----
+        auto_water_times = {lick_port: float(infos[auto_water_rows[lick_port][trial]])
+                            for lick_port in lick_ports if auto_water_rows[lick_port][trial] >= 0}
+        if auto_water_times:
+            auto_water_ports = [k for k, v in auto_water_times.items() if v > 0.001]
+            rows['trial_note'].append({**sess_trial_key,
+                                       'trial_note_type': 'autowater',
+                                       'trial_note': 'and '.join(auto_water_ports)})
+
+        # add random seed start note
+        if random_seed_rows[trial] >= 0:
+            rows['trial_note'].append({**sess_trial_key,
+                                       'trial_note_type': 'random_seed_start',
+                                       'trial_note': str(msgs[random_seed_rows[trial] + 1])})
+
+        # ---- Behavior Trial ----
+        outcome = 'hit' if is_hit[trial] else 'miss' if trial_choices[trial] else 'ignore'
+        rows['behavior_trial'].append({**sess_trial_key,
+                                       'task': task,
+                                       'task_protocol': task_protocol,
+                                       'trial_instruction': 'none',
+                                       'early_lick': 'early' if is_early_lick[trial] else 'no early',
+                                       'outcome': outcome,
+                                       'auto_water': bool(auto_water_times),
+                                       'free_water': False})  # TODO: verify this
+
+        # ---- Water Valve Setting ----
+        rows['valve_setting'].append({**sess_trial_key, **{
+            k: v[trial] for k, v in valve_settings.items()}})
+
+        for lick_port, open_durs in valve_open_durs.items():
+            rows['valve_open_dur'].append({
+                **sess_trial_key, 'water_port': lick_port, 'open_duration': open_durs[trial]})
+
+        # ---- Trial Event and Action Event ----
+        rows['trial_event'].extend(
+            [{**sess_trial_key, 'trial_event_id': idx, 'trial_event_type': 'go',
+              'trial_event_time': t, 'duration': 0} for idx, t in
+             enumerate(go_times[go_bounds[trial]:go_bounds[trial + 1]])])
+
+        rows['action_event'].extend(
+            [{**sess_trial_key, 'action_event_id': idx,
+              'action_event_type': '{} lick'.format(lick_ports[port_idx]),
+              'action_event_time': ltime} for idx, (port_idx, ltime) in enumerate(zip(
+                lick_port_idx[lick_bounds[trial]:lick_bounds[trial + 1]],
+                lick_times[lick_bounds[trial]:lick_bounds[trial + 1]]))])
+
+    return rows
+
+
+def load_session_data(path):
+    """
+    Load the "SessionData" structure of a behavior file (.mat)
+    :param path: (str) filepath of the behavior file (.mat)
+    """
+    return spio.loadmat(pathlib.Path(path).as_posix(),
+                        squeeze_me=True, struct_as_record=False)['SessionData']
+
+
+def parse_behavior_file(skey, path):
+    """
+    Parse a behavior file (.mat) - loaded once - into the rows to be inserted.
+    No database access is performed, so that files can be parsed in worker processes.
+    :param skey: session key without session ID (see BehaviorIngest._session_key())
+    :param path: (str) filepath of the behavior file (.mat)
+    :return: task_type, skey, rows
+        + rows: as returned by load_delay_response_matfile() or load_multi_target_licking_matfile()
+                (without session ID) - None for a too small 'delay-response' behavior file
+    """
+    path = pathlib.Path(path)
+    SessionData = load_session_data(path)
+
+    # distinguishing "delay-response" task or "multi-target-licking" task
+    task_type = detect_task_type(path, SessionData)
+
+    # skip too small behavior file (only for 'delay-response' task)
+    if task_type == 'delay-response' and os.stat(path).st_size / 1024 < 1000:
+        return task_type, skey, None
+
+    if task_type == 'multi-target-licking':
+        rows = load_multi_target_licking_matfile(skey, path, SessionData)
+    else:
+        rows = load_delay_response_matfile(skey, path, SessionData)
+
+    return task_type, skey, rows
+
+
+def detect_task_type(path, SessionData=None):
     """
     Method to detect if a behavior matlab file is for "delay-response" or "multi-target-licking" task
     :param path: (str) filepath of the behavior file (.mat)
+    :param SessionData: the already loaded "SessionData" of the file (optional)
     :return task_type: (str) "delay-response" or "multi-target-licking"
     """
     # distinguishing "delay-response" task or "multi-target-licking" task
-    mat = spio.loadmat(path.as_posix(), squeeze_me=True, struct_as_record=False)
-    GUI_fields = set(mat['SessionData'].SettingsFile.GUI._fieldnames)
+    if SessionData is None:
+        SessionData = load_session_data(path)
+    GUI_fields = set(SessionData.SettingsFile.GUI._fieldnames)
 
     if ({'X_center', 'Y_center', 'Z_center'}.issubset(GUI_fields)
             and not {'SamplePeriod', 'DelayPeriod'}.issubset(GUI_fields)):
@@ -889,18 +1126,19 @@ def detect_task_type(path):
     return task_type
 
 
-def load_delay_response_matfile(skey, matlab_filepath):
+def load_delay_response_matfile(skey, matlab_filepath, SessionData=None):
     """
     Loading routine for delay-response task - from .mat behavior data
     :param skey: session_key
     :param matlab_filepath: full-path to the .mat file containing the delay-response behavior data
+    :param SessionData: the already loaded "SessionData" of the file (optional)
     :return: nested list of all rows to be inserted into the various experiment-related tables
     """
     matlab_filepath = pathlib.Path(matlab_filepath)
     h2o = skey.pop('h2o')
 
-    SessionData = spio.loadmat(matlab_filepath.as_posix(),
-                               squeeze_me=True, struct_as_record=False)['SessionData']
+    if SessionData is None:
+        SessionData = load_session_data(matlab_filepath)
 
     # parse session datetime
     session_datetime_str = str('').join((str(SessionData.Info.SessionDate), ' ',
@@ -1247,18 +1485,19 @@ def load_delay_response_matfile(skey, matlab_filepath):
     return rows
 
 
-def load_multi_target_licking_matfile(skey, matlab_filepath):
+def load_multi_target_licking_matfile(skey, matlab_filepath, SessionData=None):
     """
     Loading routine for delay-response task - from .mat behavior data
     :param skey: session_key
     :param matlab_filepath: full-path to the .mat file containing the delay-response behavior data
+    :param SessionData: the already loaded "SessionData" of the file (optional)
     :return: nested list of all rows to be inserted into the various experiment-related tables
     """
     matlab_filepath = pathlib.Path(matlab_filepath)
     h2o = skey.pop('h2o')
 
-    SessionData = spio.loadmat(matlab_filepath.as_posix(),
-                               squeeze_me=True, struct_as_record=False)['SessionData']
+    if SessionData is None:
+        SessionData = load_session_data(matlab_filepath)
 
     # parse session datetime
     session_datetime_str = str('').join((str(SessionData.Info.SessionDate), ' ',
@@ -7,6 +7,7 @@ from datetime import datetime
 from os import path
 
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import re
 from itertools import repeat
@@ -24,6 +25,8 @@ from pipeline import InsertBuffer, dict_value_to_hash
 
 from .. import get_schema_name
 from . import ProbeInsertionError, ClusterMetricError, BitCodeError, IdenticalClusterResultError
+from .ephys_util import (trialize_spikes, group_by_unit, group_by_unit_and_trial, ProbeGeometry,
+                         extract_waveforms, compute_spike_depths)
 
 schema = dj.schema(get_schema_name('ingest_ephys'))
 
@@ -50,6 +53,23 @@ def get_ephys_paths():
     return dj.config.get('custom', {}).get('ephys_data_paths', None)
 
 
+def get_ephys_ingest_workers():
+    """
+    retrieve the number of worker processes used to load the clustering results
+    of the probes of a session from dj.config (default: 1, loading serially)
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'ephys_ingest_workers': 4
+        }
+        ...
+      }
+    """
+    return int(dj.config.get('custom', {}).get('ephys_ingest_workers', 1))
+
+
 @schema
 class EphysIngest(dj.Imported):
     # subpaths like: \2017-10-21\tw5ap_imec3_opt3_jrc.mat
@@ -115,7 +135,7 @@ class EphysIngest(dj.Imported):
 
         try:
             insertion_key, e_config_key = _gen_probe_insert(sinfo, probe, npx_meta, probe_insertion_exists=probe_insertion_exists)
-        except (NotImplementedError, dj.DataJointError) as e:
+        except (NotImplementedError, ValueError, dj.DataJointError) as e:
             raise ProbeInsertionError(str(e))
 
         # account for the buffer period before trial_start
@@ -170,53 +190,30 @@ class EphysIngest(dj.Imported):
         assert len(trial_start) == len(trials), 'Unequal number of bitcode "trial_start" ({}) and ingested behavior trials ({})'.format(len(trial_start), len(trials))
 
         # trialize the spikes & subtract go cue
-        t, trial_spikes, trial_units = 0, [], []
-
-        spike_trial_num = np.full_like(spikes, np.nan)
-
-        while t < len(trial_start) - 1:
-
-            s0, s1 = trial_start[t], trial_start[t+1]
-
-            trial_idx = np.where((spikes > s0) & (spikes < s1))
-            spike_trial_num[trial_idx] = trials[t]
+        spike_trial_idx, spike_trial_times = trialize_spikes(spikes, trial_start, trial_go)
 
-            trial_spikes.append(spikes[trial_idx] - trial_go[t])
-            trial_units.append(units[trial_idx])
-
-            t += 1
-
-        # ... including the last trial
-        trial_idx = np.where((spikes > s1))
-        trial_spikes.append(spikes[trial_idx] - trial_go[t])
-        trial_units.append(units[trial_idx])
-
-        trial_spikes = np.array(trial_spikes)
-        trial_units = np.array(trial_units)
+        spike_trial_num = np.full(len(spikes), np.nan)
+        spike_trial_num[spike_trial_idx >= 0] = trials[spike_trial_idx[spike_trial_idx >= 0]]
 
         # convert spike data to seconds
         spikes = spikes / hz
         trial_start = trial_start / hz
-        trial_spikes = trial_spikes / hz
+        spike_trial_times = spike_trial_times / hz
 
-        # build spike arrays
-        unit_spikes = np.array([spikes[np.where(units == u)] for u in set(units)]) - trial_start[0]
+        site_electrodes = get_site_electrodes(npx_meta, e_config_key)
+        site2electrode_map = {recorded_site + 1: {**e_config_key, 'electrode_group': electrode_group,
+                                                  'electrode': electrode}
+                              for recorded_site, (electrode, electrode_group) in enumerate(site_electrodes)}
 
-        unit_trial_spikes = np.array(
-            [[trial_spikes[t][np.where(trial_units[t] == u)]
-              for t in range(len(trials))] for u in set(units)])
+        site_electrode_lut = np.zeros(len(site_electrodes) + 1, dtype=int)  # recorded sites are 1-indexed
+        site_electrode_lut[1:] = [electrode for electrode, _ in site_electrodes]
+        spike_sites = site_electrode_lut[np.asarray(spike_sites).astype(int)]
 
-        q_electrodes = lab.ProbeType.Electrode * lab.ElectrodeConfig.Electrode & e_config_key
-        site2electrode_map = {}
-        for recorded_site, (shank, shank_col, shank_row, _) in enumerate(npx_meta.shankmap['data']):
-            site2electrode_map[recorded_site + 1] = (q_electrodes
-                                                     & {'shank': shank + 1,  # this is a 1-indexed pipeline
-                                                        'shank_col': shank_col + 1,
-                                                        'shank_row': shank_row + 1}).fetch1('KEY')
+        # build spike arrays - grouped per unit (unit_ids sorted) in a single pass
+        unit_ids, unit_spikes, unit_spike_sites, unit_spike_depths, unit_spike_trial_num = group_by_unit(
+            units, spikes - trial_start[0], spike_sites, spike_depths, spike_trial_num)
 
-        spike_sites = np.array([site2electrode_map[s]['electrode'] for s in spike_sites])
-        unit_spike_sites = np.array([spike_sites[np.where(units == u)] for u in set(units)])
-        unit_spike_depths = np.array([spike_depths[np.where(units == u)] for u in set(units)])
+        _, unit_trial_spikes = group_by_unit_and_trial(units, spike_trial_idx, len(trials), spike_trial_times)
 
         if into_archive:
             log.info('.. inserting clustering timestamp and label')
@@ -234,12 +231,10 @@ class EphysIngest(dj.Imported):
                 'ephys_file': ef_path.relative_to(rigpath).as_posix()},
                 allow_direct_insert=True)
 
-            unit_spike_trial_num = np.array([spike_trial_num[np.where(units == u)] for u in set(units)])
-
             with InsertBuffer(ephys.ArchivedClustering.Unit, 10, skip_duplicates=True,
                               allow_direct_insert=True) as ib:
 
-                for i, u in enumerate(set(units)):
+                for i, u in enumerate(unit_ids):
                     if method in ['jrclust_v3', 'jrclust_v4']:
                         wf_chn_idx = 0
                     elif method in ['kilosort2']:
@@ -275,14 +270,14 @@ class EphysIngest(dj.Imported):
                 dj.conn().ping()
                 ephys.ArchivedClustering.ClusterMetric.insert(
                     [{**archive_key, 'unit': u, **metrics[u]}
-                     for u in set(units)], ignore_extra_fields=True, allow_direct_insert=True)
+                     for u in unit_ids], ignore_extra_fields=True, allow_direct_insert=True)
                 ephys.ArchivedClustering.WaveformMetric.insert(
                     [{**archive_key, 'unit': u, **metrics[u]}
-                     for u in set(units)], ignore_extra_fields=True, allow_direct_insert=True)
+                     for u in unit_ids], ignore_extra_fields=True, allow_direct_insert=True)
                 ephys.ArchivedClustering.UnitStat.insert(
                     [{**archive_key, 'unit': u, 'unit_amp': unit_amp[i], 'unit_snr': unit_snr[i],
                       'isi_violation': metrics[u]['isi_viol'], 'avg_firing_rate': metrics[u]['firing_rate']}
-                     for i, u in enumerate(set(units))], allow_direct_insert=True)
+                     for i, u in enumerate(unit_ids)], allow_direct_insert=True)
 
         else:
             # insert Unit
@@ -291,7 +286,7 @@ class EphysIngest(dj.Imported):
             with InsertBuffer(ephys.Unit, 10, skip_duplicates=True,
                               allow_direct_insert=True) as ib:
 
-                for i, u in enumerate(set(units)):
+                for i, u in enumerate(unit_ids):
                     if method in ['jrclust_v3', 'jrclust_v4']:
                         wf_chn_idx = 0
                     elif method in ['kilosort2']:
@@ -321,7 +316,7 @@ class EphysIngest(dj.Imported):
             with InsertBuffer(ephys.Unit.UnitTrial, 10000, skip_duplicates=True,
                               allow_direct_insert=True) as ib:
 
-                for i, u in enumerate(set(units)):
+                for i, u in enumerate(unit_ids):
                     for t in range(len(trials)):
                         if len(unit_trial_spikes[i][t]):
                             ib.insert1({**skey,
@@ -337,7 +332,7 @@ class EphysIngest(dj.Imported):
             dj.conn().ping()
             with InsertBuffer(ephys.Unit.TrialSpikes, 10000, skip_duplicates=True,
                               allow_direct_insert=True) as ib:
-                for i, u in enumerate(set(units)):
+                for i, u in enumerate(unit_ids):
                     for t in range(len(trials)):
                         ib.insert1({**skey,
                                     'insertion_number': probe,
@@ -364,16 +359,16 @@ class EphysIngest(dj.Imported):
                 dj.conn().ping()
                 ephys.ClusterMetric.insert([{**skey, 'insertion_number': probe,
                                              'clustering_method': method, 'unit': u, **metrics[u]}
-                                            for u in set(units)],
+                                            for u in unit_ids],
                                            ignore_extra_fields=True, allow_direct_insert=True)
                 ephys.WaveformMetric.insert([{**skey, 'insertion_number': probe,
                                               'clustering_method': method, 'unit': u, **metrics[u]}
-                                             for u in set(units)],
+                                             for u in unit_ids],
                                             ignore_extra_fields=True, allow_direct_insert=True)
                 ephys.UnitStat.insert([{**skey, 'insertion_number': probe,
                                         'clustering_method': method, 'unit': u,
                                         'isi_violation': metrics[u]['isi_viol'],
-                                        'avg_firing_rate': metrics[u]['firing_rate']} for u in set(units)],
+                                        'avg_firing_rate': metrics[u]['firing_rate']} for u in unit_ids],
                                       allow_direct_insert=True)
 
             dj.conn().ping()
@@ -383,7 +378,7 @@ class EphysIngest(dj.Imported):
                                            'clustering_method': method, 'unit': u,
                                            'clustering_time': creation_time,
                                            'quality_control': bool('qc' in clustering_label),
-                                           'manual_curation': bool('curated' in clustering_label)} for u in set(units)],
+                                           'manual_curation': bool('curated' in clustering_label)} for u in unit_ids],
                                          allow_direct_insert=True)
 
             log.info('.. inserting file load information')
@@ -396,11 +391,13 @@ class EphysIngest(dj.Imported):
             log.info('-- ephys ingest for {} - probe {} complete'.format(skey, probe))
 
 
-def do_ephys_ingest(session_key, replace=False, probe_insertion_exists=False, into_archive=False):
+def do_ephys_ingest(session_key, replace=False, probe_insertion_exists=False, into_archive=False, n_workers=None):
     """
     Perform ephys-ingestion for a particular session (defined by session_key) to either
         + fresh ingest of new probe insertion and clustering results
         + archive existing clustering results and replace with new one (set 'replace=True')
+    The clustering results of the probes are loaded in a pool of "n_workers" processes
+    (default: get_ephys_ingest_workers()) - the insertions are done serially, in probe order
     """
     # =========== Find Ephys Recording ============
     key = (experiment.Session & session_key).fetch1()
@@ -453,24 +450,22 @@ def do_ephys_ingest(session_key, replace=False, probe_insertion_exists=False, in
 
     def do_insert():
         # do the insertion per probe for all probes
+        probe_files = {}
         for probe_no, (f, cluster_method, npx_meta) in clustering_files.items():
             insertion_key = {'subject_id': sinfo['subject_id'], 'session': sinfo['session'], 'insertion_number': probe_no}
             if probe_insertion_exists and (ephys.Unit & insertion_key):
                 # if probe_insertion exists and there exists also units for this insertion_key, skip over it
                 continue
-            try:
-                log.info('------ Start loading clustering results for probe: {} ------'.format(probe_no))
-                loader = cluster_loader_map[cluster_method]
-                dj.conn().ping()
-                EphysIngest()._load(loader(sinfo, *f), probe_no, npx_meta, rigpath,
-                                    probe_insertion_exists=probe_insertion_exists, into_archive=into_archive)
-            except (ProbeInsertionError, ClusterMetricError, FileNotFoundError) as e:
-                dj.conn().cancel_transaction()  # either successful ingestion of all probes, or none at all
-                if isinstance(e, ProbeInsertionError):
-                    log.warning('Probe Insertion Error: \n{}. \nSkipping...'.format(str(e)))
-                else:
-                    log.warning('Error: {}'.format(str(e)))
-                return
+            probe_files[probe_no] = (f, cluster_method, npx_meta)
+
+        def insert_probe(data, probe_no, npx_meta):
+            dj.conn().ping()
+            EphysIngest()._load(data, probe_no, npx_meta, rigpath,
+                                probe_insertion_exists=probe_insertion_exists, into_archive=into_archive)
+
+        if not insert_clustering_results(load_clustering_results(sinfo, probe_files, n_workers=n_workers),
+                                         probe_files, insert_probe):
+            dj.conn().cancel_transaction()  # either successful ingestion of all probes, or none at all
 
     # the insert part
     if dj.conn().in_transaction:
@@ -528,12 +523,9 @@ def _gen_electrode_config(npx_meta):
     if re.search('(1.0|2.0)', npx_meta.probe_model):
         eg_members = []
         probe_type = {'probe_type': npx_meta.probe_model}
-        q_electrodes = lab.ProbeType.Electrode & probe_type
-        for shank, shank_col, shank_row, is_used in npx_meta.shankmap['data']:
-            electrode = (q_electrodes & {'shank': shank + 1,  # shank is 1-indexed in this pipeline
-                                         'shank_col': shank_col + 1,
-                                         'shank_row': shank_row + 1}).fetch1('KEY')
-            eg_members.append({**electrode, 'is_used': is_used, 'electrode_group': 0})
+        electrodes = get_probe_geometry(npx_meta.probe_model).resolve(npx_meta.shankmap['data'])
+        for electrode, (_, _, _, is_used) in zip(electrodes.tolist(), npx_meta.shankmap['data']):
+            eg_members.append({**probe_type, 'electrode': electrode, 'is_used': is_used, 'electrode_group': 0})
     else:
         raise NotImplementedError('Processing for neuropixels probe model {} not yet implemented'.format(
             npx_meta.probe_model))
@@ -561,6 +553,45 @@ def _gen_electrode_config(npx_meta):
     return e_config
 
 
+# ======== Electrode lookup ========
+_probe_geometries = {}
+_electrode_config_groups = {}
+
+
+def get_probe_geometry(probe_type):
+    """
+    Return the ProbeGeometry of the specified probe type - lab.ProbeType.Electrode is fetched
+    once per probe type and cached for the remainder of the process
+    """
+    if probe_type not in _probe_geometries:
+        electrode, shank, shank_col, shank_row = (lab.ProbeType.Electrode & {'probe_type': probe_type}).fetch(
+            'electrode', 'shank', 'shank_col', 'shank_row')
+        _probe_geometries[probe_type] = ProbeGeometry(electrode, shank, shank_col, shank_row)
+    return _probe_geometries[probe_type]
+
+
+def get_site_electrodes(npx_meta, e_config_key):
+    """
+    Resolve the (electrode, electrode_group) of each recorded site (in recording order)
+    for the specified electrode configuration - lab.ElectrodeConfig.Electrode is fetched
+    once per electrode configuration and cached for the remainder of the process
+    """
+    config = (e_config_key['probe_type'], e_config_key['electrode_config_name'])
+    if config not in _electrode_config_groups:
+        electrode, electrode_group = (lab.ElectrodeConfig.Electrode & e_config_key).fetch(
+            'electrode', 'electrode_group')
+        _electrode_config_groups[config] = dict(zip(electrode.tolist(), electrode_group.tolist()))
+    electrode_groups = _electrode_config_groups[config]
+
+    electrodes = get_probe_geometry(e_config_key['probe_type']).resolve(npx_meta.shankmap['data']).tolist()
+
+    missing = [e for e in electrodes if e not in electrode_groups]
+    if missing:
+        raise ValueError('Electrode(s) {} not in electrode config: {}'.format(missing, e_config_key))
+
+    return [(e, electrode_groups[e]) for e in electrodes]
+
+
 # ======== Loaders for clustering results ========
 def _decode_notes(fh, notes):
     '''
@@ -577,7 +608,7 @@ def _decode_notes(fh, notes):
     return decoded_notes
 
 
-def _load_jrclust_v3(sinfo, fpath):
+def _load_jrclust_v3(sinfo, fpath, bitcode=None):
     '''
     Ephys data loader for JRClust v4 files.
 
@@ -587,6 +618,7 @@ def _load_jrclust_v3(sinfo, fpath):
       - rigpath: rig path root
       - dpath: expanded rig data path (rigpath/h2o/YYYY-MM-DD)
       - fpath: file path under dpath
+      - bitcode: pre-loaded output of read_bitcode() (optional)
 
     Returns:
       - tbd
@@ -606,10 +638,9 @@ def _load_jrclust_v3(sinfo, fpath):
     ef = h5py.File(str(ef_path), mode='r')  # ephys file
 
     # -- trial-info from bitcode --
-    try:
-        sync_behav, sync_ephys, trial_fix, trial_go, trial_start = read_bitcode(fpath.parent, h2o, skey)
-    except FileNotFoundError as e:
-        raise e
+    if bitcode is None:
+        bitcode = read_bitcode(fpath.parent, h2o, skey)
+    sync_behav, sync_ephys, trial_fix, trial_go, trial_start = bitcode
 
     # extract unit data
 
@@ -668,7 +699,7 @@ def _load_jrclust_v3(sinfo, fpath):
     return data
 
 
-def _load_jrclust_v4(sinfo, fpath):
+def _load_jrclust_v4(sinfo, fpath, bitcode=None):
     '''
     Ephys data loader for JRClust v4 files.
     Arguments:
@@ -676,6 +707,7 @@ def _load_jrclust_v4(sinfo, fpath):
       - rigpath: rig path root
       - dpath: expanded rig data path (rigpath/h2o/YYYY-MM-DD)
       - fpath: file path under dpath
+      - bitcode: pre-loaded output of read_bitcode() (optional)
     '''
 
     h2o = sinfo['water_restriction_number']
@@ -692,10 +724,9 @@ def _load_jrclust_v4(sinfo, fpath):
     ef = h5py.File(str(ef_path), mode='r')  # ephys file
 
     # -- trial-info from bitcode --
-    try:
-        sync_behav, sync_ephys, trial_fix, trial_go, trial_start = read_bitcode(fpath.parent, h2o, skey)
-    except FileNotFoundError as e:
-        raise e
+    if bitcode is None:
+        bitcode = read_bitcode(fpath.parent, h2o, skey)
+    sync_behav, sync_ephys, trial_fix, trial_go, trial_start = bitcode
 
     # extract unit data
     hz = None                                       # sampling rate  (N/A from jrclustv4, use from npx_meta)
@@ -753,7 +784,7 @@ def _load_jrclust_v4(sinfo, fpath):
     return data
 
 
-def _load_kilosort2(sinfo, ks_dir, npx_dir):
+def _load_kilosort2(sinfo, ks_dir, npx_dir, bitcode=None):
 
     h2o = sinfo['water_restriction_number']
     skey = {k: v for k, v in sinfo.items()
@@ -763,10 +794,9 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
     log.info('.... sinfo: {}'.format(sinfo))
 
     # -- trial-info from bitcode --
-    try:
-        sync_behav, sync_ephys, trial_fix, trial_go, trial_start = read_bitcode(npx_dir, h2o, skey)
-    except FileNotFoundError as e:
-        raise e
+    if bitcode is None:
+        bitcode = read_bitcode(npx_dir, h2o, skey)
+    sync_behav, sync_ephys, trial_fix, trial_go, trial_start = bitcode
 
     # ---- Read Kilosort results ----
     log.info('.... loading kilosort - ks_dir: {}'.format(str(ks_dir)))
@@ -784,7 +814,8 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
 
     # ---- Unit-level results ----
     # -- Remove 0-spike units
-    withspike_idx = [i for i, u in enumerate(ks.data['cluster_ids']) if (ks.data['spike_clusters'] == u).any()]
+    spike_units, unit_spike_idx = group_by_unit(ks.data['spike_clusters'], np.arange(len(ks.data['spike_clusters'])))
+    withspike_idx = np.where(np.isin(ks.data['cluster_ids'], spike_units))[0]
 
     valid_units = ks.data['cluster_ids'][withspike_idx]
     valid_unit_labels = ks.data['cluster_groups'][withspike_idx]
@@ -814,8 +845,9 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
         unit_wav = unit_wav[np.ix_(metrics.index, ks.data['channel_map'], range(unit_wav.shape[-1]))]  # unit x channel x sample
     else:
         vmax_unit_site, unit_xpos, unit_ypos, unit_amp = [], [], [], []
+        unit_spike_idx = dict(zip(spike_units, unit_spike_idx))
         for unit in valid_units:
-            template_idx = ks.data['spike_templates'][np.where(ks.data['spike_clusters'] == unit)[0][0]]
+            template_idx = ks.data['spike_templates'][unit_spike_idx[unit][0]]
             chn_templates = ks.data['templates'][template_idx, :, :]
             site_idx = np.abs(np.abs(chn_templates).max(axis=0)).argmax()
             vmax_unit_site.append(ks.data['channel_map'][site_idx])
@@ -823,14 +855,13 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
             unit_xpos.append(ks.data['channel_positions'][site_idx, 0])
             unit_ypos.append(ks.data['channel_positions'][site_idx, 1])
             # unit amp
-            amps = ks.data['amplitudes'][ks.data['spike_clusters'] == unit]
+            amps = ks.data['amplitudes'][unit_spike_idx[unit]]
             scaled_templates = np.matmul(chn_templates, ks.data['whitening_mat_inv'])
             best_chn_wf = scaled_templates[:, site_idx] * amps.mean()
             unit_amp.append(best_chn_wf.max() - best_chn_wf.min())
 
         # waveforms and SNR
         log.info('.... extracting waveforms - data dir: {}'.format(str(ks_dir)))
-        dj.conn().ping()
 
         unit_wfs = extract_ks_waveforms(npx_dir, ks, wf_win=[-int(ks.data['templates'].shape[1]/2),
                                                              int(ks.data['templates'].shape[1]/2)])
@@ -890,6 +921,76 @@ cluster_loader_map = {'jrclust_v3': _load_jrclust_v3,
                       'kilosort2': _load_kilosort2}
 
 
+def _load_probe(cluster_method, sinfo, f, bitcode):
+    '''
+    Process pool worker - run the clustering loader for one probe.
+    Lazily loaded datasets (h5py, memmap) are read into memory for transfer back to the parent process.
+    '''
+    data = cluster_loader_map[cluster_method](sinfo, *f, bitcode=bitcode)
+    return {k: np.array(v) if isinstance(v, (h5py.Dataset, np.memmap)) else v for k, v in data.items()}
+
+
+def load_clustering_results(sinfo, clustering_files, n_workers=None):
+    """
+    Load the clustering results of the specified probes, in a local pool of "n_workers" processes
+    (default: get_ephys_ingest_workers()).
+    Bitcode files (requiring database access) are read in this process,
+    the workers only perform file loading and numeric preprocessing (e.g. extract_ks_waveforms).
+
+    :param clustering_files: {probe_no: (f, cluster_method, npx_meta)} - see _match_probe_to_ephys()
+    :return: generator of the loaded data for each probe, in the order of "clustering_files"
+    """
+    n_workers = get_ephys_ingest_workers() if n_workers is None else n_workers
+
+    if n_workers <= 1 or len(clustering_files) <= 1:
+        for f, cluster_method, _ in clustering_files.values():
+            yield cluster_loader_map[cluster_method](sinfo, *f)
+        return
+
+    h2o = sinfo['water_restriction_number']
+    skey = {k: v for k, v in sinfo.items() if k in experiment.Session.primary_key}
+
+    bitcodes = [read_bitcode(f[1] if cluster_method == 'kilosort2' else f[0].parent, h2o, skey)
+                for f, cluster_method, _ in clustering_files.values()]
+
+    log.info('.. loading clustering results of {} probes - {} workers'.format(len(clustering_files), n_workers))
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(clustering_files))) as executor:
+        futures = [executor.submit(_load_probe, cluster_method, sinfo, f, bitcode)
+                   for (f, cluster_method, _), bitcode in zip(clustering_files.values(), bitcodes)]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # on close() (e.g. after a probe error) - don't load the remaining probes
+            for future in futures:
+                future.cancel()
+
+
+def insert_clustering_results(probe_data, probe_files, insert_probe):
+    """
+    Insert the loaded clustering results of each probe of "probe_files" with "insert_probe(data, probe_no, npx_meta)"
+    - stopping at the first probe error.
+    The "probe_data" generator (see load_clustering_results()) is closed on return, not loading the remaining probes.
+
+    :param probe_files: {probe_no: (f, cluster_method, npx_meta)} - see _match_probe_to_ephys()
+    :return: True if all the probes were inserted
+    """
+    try:
+        for probe_no, (f, cluster_method, npx_meta) in probe_files.items():
+            try:
+                log.info('------ Start loading clustering results for probe: {} ------'.format(probe_no))
+                insert_probe(next(probe_data), probe_no, npx_meta)
+            except (ProbeInsertionError, ClusterMetricError, FileNotFoundError) as e:
+                if isinstance(e, ProbeInsertionError):
+                    log.warning('Probe Insertion Error: \n{}. \nSkipping...'.format(str(e)))
+                else:
+                    log.warning('Error: {}'.format(str(e)))
+                return False
+        return True
+    finally:
+        probe_data.close()
+
+
 # ======== Helpers for directory navigation ========
 def _get_sess_dir(rigpath, h2o, sess_datetime):
     dpath, dglob = None, None
@@ -1268,18 +1369,10 @@ class Kilosort:
 
     def extract_spike_depths(self):
         """ Reimplemented from https://github.com/cortex-lab/spikes/blob/master/analysis/ksDriftmap.m """
-        ycoords = self.data['channel_positions'][:, 1]
-        pc_features = self.data['pc_features'][:, 0, :]  # 1st PC only
-        pc_features = np.where(pc_features < 0, 0, pc_features)
-
         # ---- compute center of mass of these features (spike depths) ----
-
-        # which channels for each spike?
-        spk_feature_ind = self.data['pc_feature_ind'][self.data['spike_templates'], :]
-        # ycoords of those channels?
-        spk_feature_ycoord = ycoords[spk_feature_ind]
-        # center of mass is sum(coords.*features)/sum(features)
-        self._data['spike_depths'] = np.sum(spk_feature_ycoord * pc_features**2, axis=1) / np.sum(pc_features**2, axis=1)
+        self._data['spike_depths'] = compute_spike_depths(
+            self.data['pc_features'], self.data['pc_feature_ind'], self.data['spike_templates'],
+            ycoords=self.data['channel_positions'][:, 1])
 
         # ---- extract spike sites ----
         max_site_ind = np.argmax(np.abs(self.data['templates']).max(axis=1), axis=1)
@@ -1287,14 +1380,16 @@ class Kilosort:
         self._data['spike_sites'] = self.data['channel_map'][spike_site_ind]
 
 
-def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None):
+def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None, chunk_size=1000, n_workers=1):
     """
     :param npx_dir: directory to the ap.bin and ap.meta
     :param ks: instance of Kilosort
     :param n_wf: number of spikes per unit to extract the waveforms
     :param wf_win: number of sample pre and post a spike
     :param bit_volts: scalar required to convert int16 values into microvolts
-    :return: dictionary of the clusters' waveform (sample x channel x spike) and snr per channel for each cluster
+    :param chunk_size: number of spikes read from the ap.bin at a time (see ephys_util.extract_waveforms)
+    :param n_workers: number of processes reading the ap.bin
+    :return: dictionary of the clusters' mean waveform (sample x channel) and snr per channel for each cluster
     """
     bin_fp = next(pathlib.Path(npx_dir).glob('*.ap.bin'))
     meta_fp = next(pathlib.Path(npx_dir).glob('*.ap.meta'))
@@ -1305,32 +1400,9 @@ def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None
     if bit_volts is None:
         bit_volts = npx_bit_volts[re.match('neuropixels (\d.0)', meta.probe_model).group()]
 
-    raw_data = np.memmap(bin_fp, dtype='int16', mode='r')
-    data = np.reshape(raw_data, (int(raw_data.size / channel_num), channel_num))
-
-    chan_map = ks.data['channel_map']
-
-    unit_wfs = {}
-    for unit in tqdm(ks.data['cluster_ids']):
-        spikes = ks.data['spike_times'][ks.data['spike_clusters'] == unit]
-        np.random.shuffle(spikes)
-        spikes = spikes[:n_wf]
-        # ignore spikes at the beginning or end of raw data
-        spikes = spikes[np.logical_and(spikes > wf_win[0], spikes < data.shape[0] - wf_win[-1])]
-
-        unit_wfs[unit] = {}
-        if len(spikes) > 0:
-            # waveform at each spike: (sample x channel x spike)
-            spike_wfs = np.dstack([data[int(spk+wf_win[0]):int(spk+wf_win[-1]), chan_map] for spk in spikes])
-            spike_wfs = spike_wfs * bit_volts
-            unit_wfs[unit]['snr'] = [calculate_wf_snr(chn_wfs)
-                                     for chn_wfs in spike_wfs.transpose((1, 2, 0))]  # (channel x spike x sample)
-            unit_wfs[unit]['mean_wf'] = np.nanmean(spike_wfs, axis=2)
-        else:  # if no spike found, return NaN of size (sample x channel x 1)
-            unit_wfs[unit]['snr'] = np.full((1, len(chan_map)), np.nan)
-            unit_wfs[unit]['mean_wf'] = np.full((len(range(*wf_win)), len(chan_map)), np.nan)
-
-    return unit_wfs
+    return extract_waveforms(bin_fp, channel_num, ks.data['spike_times'], ks.data['spike_clusters'],
+                             ks.data['cluster_ids'], ks.data['channel_map'], n_wf=n_wf, wf_win=wf_win,
+                             bit_volts=bit_volts, chunk_size=chunk_size, n_workers=n_workers)
 
 
 def calculate_wf_snr(W):
@@ -0,0 +1,265 @@
+"""
+Numeric helpers for ephys ingestion - trialization and per-unit grouping of spike trains,
+electrode lookup and waveform extraction
+
+These are kept free of any database access so that they can be shared by all
+of the clustering loaders (see ephys.cluster_loader_map) and tested in isolation.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def trialize_spikes(spikes, trial_start, trial_go):
+    """
+    Assign every spike to a trial in a single sorted pass over the trial boundaries.
+
+    A spike belongs to trial t if trial_start[t] < spike < trial_start[t+1];
+    spikes after the last trial_start belong to the last trial. Spikes at or before
+    the first trial_start, or falling exactly on a trial boundary, belong to no trial.
+
+    :param spikes: spike times (sample), shape (n_spikes,)
+    :param trial_start: trial start times (sample), monotonically increasing, shape (n_trials,)
+    :param trial_go: go-cue times (sample) per trial, shape (n_trials,) - NaN for trials without go-cue
+    :return: spike_trial_idx - 0-based trial index of each spike (-1 if not in any trial)
+             trial_spikes - spike times relative to the go-cue of their trial (NaN if not in any trial)
+    """
+    spikes = np.asarray(spikes)
+    trial_start = np.asarray(trial_start)
+    trial_go = np.asarray(trial_go)
+
+    insert_idx = np.searchsorted(trial_start, spikes, side='left')
+    spike_trial_idx = insert_idx - 1
+
+    # exclude spikes falling exactly on the start of a trial
+    on_boundary = np.zeros(len(spikes), dtype=bool)
+    is_inner = insert_idx < len(trial_start)
+    on_boundary[is_inner] = trial_start[insert_idx[is_inner]] == spikes[is_inner]
+    spike_trial_idx[on_boundary] = -1
+
+    in_trial = spike_trial_idx >= 0
+    trial_spikes = np.full(len(spikes), np.nan)
+    trial_spikes[in_trial] = spikes[in_trial] - trial_go[spike_trial_idx[in_trial]]
+
+    return spike_trial_idx, trial_spikes
+
+
+def _split_by_label(labels, n_labels, arrays):
+    """
+    Split per-spike arrays by an integer label in [0, n_labels) using a stable argsort
+    and split offsets - spikes with a negative label are dropped
+    """
+    labels = np.asarray(labels)
+    labeled = np.where(labels >= 0)[0]
+    order = labeled[np.argsort(labels[labeled], kind='stable')]
+    offsets = np.cumsum(np.bincount(labels[labeled], minlength=n_labels))[:-1]
+
+    return tuple(np.split(np.asarray(a)[order], offsets) for a in arrays)
+
+
+def split_by_trial(spike_trial_idx, n_trials, *arrays):
+    """
+    Split per-spike arrays into per-trial lists, keeping the original spike order within each trial
+
+    :param spike_trial_idx: 0-based trial index of each spike (-1 if not in any trial) - see trialize_spikes()
+    :param n_trials: number of trials
+    :param arrays: per-spike arrays to split
+    :return: one list of n_trials arrays for each of the provided arrays
+    """
+    return _split_by_label(spike_trial_idx, n_trials, arrays)
+
+
+def group_by_unit(units, *arrays):
+    """
+    Group per-spike arrays by unit in one pass, keeping the original spike order within each unit
+
+    :param units: unit id of each spike
+    :param arrays: per-spike arrays to group
+    :return: unit_ids - sorted unique unit ids
+             one list of len(unit_ids) arrays (one per unit) for each of the provided arrays
+    """
+    unit_ids, unit_idx = np.unique(units, return_inverse=True)
+    return (unit_ids, *_split_by_label(unit_idx.ravel(), len(unit_ids), arrays))
+
+
+def group_by_unit_and_trial(units, spike_trial_idx, n_trials, *arrays):
+    """
+    Group per-spike arrays by unit and trial in one pass, keeping the original spike order
+
+    :param units: unit id of each spike
+    :param spike_trial_idx: 0-based trial index of each spike (-1 if not in any trial) - see trialize_spikes()
+    :param n_trials: number of trials
+    :param arrays: per-spike arrays to group
+    :return: unit_ids - sorted unique unit ids (including units with no spike in any trial)
+             one nested list (unit x trial) of arrays for each of the provided arrays
+    """
+    unit_ids, unit_idx = np.unique(units, return_inverse=True)
+    spike_trial_idx = np.asarray(spike_trial_idx)
+    labels = np.where(spike_trial_idx >= 0, unit_idx.ravel() * n_trials + spike_trial_idx, -1)
+
+    grouped = _split_by_label(labels, len(unit_ids) * n_trials, arrays)
+
+    return (unit_ids, *([g[i * n_trials:(i + 1) * n_trials] for i in range(len(unit_ids))]
+                        for g in grouped))
+
+
+class ProbeGeometry:
+    """
+    In-memory resolution of electrode position (shank, shank_col, shank_row) to electrode
+    for one probe type - built once from the fetched lab.ProbeType.Electrode table,
+    in place of one database query per recording site.
+    """
+
+    def __init__(self, electrode, shank, shank_col, shank_row):
+        """
+        :param electrode, shank, shank_col, shank_row: columns of lab.ProbeType.Electrode (1-indexed)
+        """
+        self._electrode_map = {(int(s), int(c), int(r)): int(e)
+                               for e, s, c, r in zip(electrode, shank, shank_col, shank_row)}
+
+    def resolve(self, shankmap_data):
+        """
+        Resolve the electrode of each recorded site
+
+        :param shankmap_data: rows of (shank, shank_col, shank_row, ...) - 0-indexed,
+                              as in NeuropixelsMeta.shankmap['data']
+        :return: array of electrodes (1-indexed), one per recorded site
+        """
+        try:
+            return np.array([self._electrode_map[(s + 1, c + 1, r + 1)]  # this is a 1-indexed pipeline
+                             for s, c, r, *_ in shankmap_data], dtype=int)
+        except KeyError as e:
+            raise ValueError('No electrode found at (shank, shank_col, shank_row): {}'.format(e.args[0]))
+
+
+def _accumulate_waveforms(bin_fp, channel_num, chan_map, spikes, spike_unit_idx, n_units, wf_win, chunk_size):
+    """
+    Accumulate per unit the sum of the spike waveforms (unit x sample x channel) and the sum of
+    their squares (unit x channel) on the "chan_map" channels, reading the (time-sorted) spikes
+    from the raw data in chunks. Sums are accumulated as int64, hence exact.
+    """
+    raw_data = np.memmap(bin_fp, dtype='int16', mode='r')
+    data = np.reshape(raw_data, (int(raw_data.size / channel_num), channel_num))
+
+    wf_samples = np.arange(*wf_win)
+    wf_sum = np.zeros((n_units, len(wf_samples), len(chan_map)), dtype=np.int64)
+    wf_sq_sum = np.zeros((n_units, len(chan_map)), dtype=np.int64)
+
+    for start in range(0, len(spikes), chunk_size):
+        chunk_units = spike_unit_idx[start:start + chunk_size]
+        # waveform at each spike: (spike x sample x channel)
+        chunk_wfs = data[(spikes[start:start + chunk_size, None] + wf_samples)[..., None], chan_map]
+
+        # scatter into the per-unit accumulators
+        order = np.argsort(chunk_units, kind='stable')
+        units, unit_starts = np.unique(chunk_units[order], return_index=True)
+        chunk_wfs = chunk_wfs[order]
+        for unit, unit_wfs in zip(units, np.split(chunk_wfs, unit_starts[1:])):
+            wf_sum[unit] += unit_wfs.sum(axis=0, dtype=np.int64)
+            unit_wfs = unit_wfs.astype(np.int32)
+            wf_sq_sum[unit] += (unit_wfs * unit_wfs).sum(axis=(0, 1), dtype=np.int64)
+
+    return wf_sum, wf_sq_sum
+
+
+def extract_waveforms(bin_fp, channel_num, spike_times, spike_units, unit_ids, chan_map,
+                      n_wf=500, wf_win=(-41, 41), bit_volts=1, chunk_size=1000, n_workers=1):
+    """
+    Extract the mean waveform and per-channel SNR of each unit from the raw data (e.g. .ap.bin)
+
+    Up to "n_wf" randomly sampled spikes per unit are read in time-sorted order, in chunks of
+    "chunk_size" spikes, and accumulated per unit - memory use is bounded by the chunk size and the
+    per-unit accumulators, not by the number of spikes. With n_workers > 1, the spikes are split in
+    contiguous time blocks, each accumulated in a separate process.
+
+    :param bin_fp: filepath to the int16 raw data (sample x channel)
+    :param channel_num: number of saved channels in the raw data
+    :param spike_times: spike times (sample)
+    :param spike_units: unit id of each spike
+    :param unit_ids: units to extract the waveforms for
+    :param chan_map: channels of the raw data to extract
+    :param n_wf: number of spikes per unit to extract the waveforms
+    :param wf_win: number of sample pre and post a spike
+    :param bit_volts: scalar required to convert int16 values into microvolts
+    :return: dictionary of the units' mean waveform (sample x channel) and snr per channel
+    """
+    sample_count = int(np.memmap(bin_fp, dtype='int16', mode='r').size / channel_num)
+
+    # ---- sample the spikes of each unit ----
+    unit_spikes = dict(zip(*group_by_unit(spike_units, np.asarray(spike_times).astype(np.int64))))
+
+    sampled_spikes, sampled_unit_idx = [], []
+    for unit_idx, unit in enumerate(unit_ids):
+        spikes = unit_spikes.get(unit, np.array([], dtype=np.int64))
+        np.random.shuffle(spikes)
+        spikes = spikes[:n_wf]
+        # ignore spikes at the beginning or end of raw data
+        spikes = spikes[np.logical_and(spikes + wf_win[0] >= 0, spikes < sample_count - wf_win[-1])]
+        sampled_spikes.append(spikes)
+        sampled_unit_idx.append(np.full(len(spikes), unit_idx))
+
+    sampled_spikes = np.concatenate(sampled_spikes)
+    sampled_unit_idx = np.concatenate(sampled_unit_idx)
+
+    order = np.argsort(sampled_spikes, kind='stable')
+    sampled_spikes, sampled_unit_idx = sampled_spikes[order], sampled_unit_idx[order]
+
+    # ---- accumulate the waveforms ----
+    args = (bin_fp, channel_num, np.asarray(chan_map))
+    kwargs = dict(n_units=len(unit_ids), wf_win=wf_win, chunk_size=chunk_size)
+    if n_workers > 1 and len(sampled_spikes) > chunk_size:
+        blocks = np.array_split(np.arange(len(sampled_spikes)), n_workers)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_accumulate_waveforms, *args, sampled_spikes[b], sampled_unit_idx[b], **kwargs)
+                       for b in blocks]
+            wf_sum, wf_sq_sum = (np.sum(r, axis=0) for r in zip(*(f.result() for f in futures)))
+    else:
+        wf_sum, wf_sq_sum = _accumulate_waveforms(*args, sampled_spikes, sampled_unit_idx, **kwargs)
+
+    wf_count = np.bincount(sampled_unit_idx, minlength=len(unit_ids))
+
+    # ---- mean waveforms and SNR (see ephys.calculate_wf_snr), vectorized across channels ----
+    unit_wfs = {}
+    for unit_idx, unit in enumerate(unit_ids):
+        n = wf_count[unit_idx]
+        unit_wfs[unit] = {}
+        if n > 0:
+            mean_wf = wf_sum[unit_idx] / n
+            amp = mean_wf.max(axis=0) - mean_wf.min(axis=0)
+            err_var = wf_sq_sum[unit_idx] / (n * len(mean_wf)) - (mean_wf ** 2).mean(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                snr = amp / (2 * np.sqrt(np.maximum(err_var, 0)))
+            unit_wfs[unit]['snr'] = np.where(np.isinf(snr), 0, snr)
+            unit_wfs[unit]['mean_wf'] = mean_wf * bit_volts
+        else:  # if no spike found, return NaN of size (sample x channel x 1)
+            unit_wfs[unit]['snr'] = np.full((1, len(chan_map)), np.nan)
+            unit_wfs[unit]['mean_wf'] = np.full((len(range(*wf_win)), len(chan_map)), np.nan)
+
+    return unit_wfs
+
+
+def compute_spike_depths(pc_features, pc_feature_ind, spike_templates, ycoords, chunk_size=100000):
+    """
+    Compute the depth of each spike as the center of mass of its 1st PC features
+    (see ephys.Kilosort.extract_spike_depths), walking the (memory-mapped) pc_features in
+    chunks of "chunk_size" spikes and writing into a preallocated output -
+    memory use is bounded by the chunk size regardless of the number of spikes.
+
+    :param pc_features: (spike x PC x channel) pc features (e.g. mmap'ed pc_features.npy)
+    :param pc_feature_ind: (template x channel) channel indices of the pc features
+    :param spike_templates: template of each spike
+    :param ycoords: y coordinate of each channel
+    :return: spike depths
+    """
+    spike_depths = np.empty(len(spike_templates))
+
+    for start in range(0, len(spike_templates), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        pc_sq = np.where(pc_features[chunk, 0, :] < 0, 0, pc_features[chunk, 0, :]) ** 2  # 1st PC only
+        # ycoords of the channels of each spike
+        spk_feature_ycoord = ycoords[pc_feature_ind[spike_templates[chunk], :]]
+        # center of mass is sum(coords.*features)/sum(features)
+        spike_depths[chunk] = np.sum(spk_feature_ycoord * pc_sq, axis=1) / np.sum(pc_sq, axis=1)
+
+    return spike_depths
@@ -0,0 +1,124 @@
+"""
+Persistent, incrementally refreshed index of the files under a data directory (e.g. a rig data path)
+
+The index is a local sqlite database recording, for each indexed root directory, the
+mtime of every sub-directory and the (name, mtime, size) of every file matching the
+index's filename pattern. A refresh only lists the directories whose mtime changed since
+the last refresh (a directory's mtime changes when entries are added, removed or renamed),
+so a rescan of an unchanged tree costs one stat() per directory instead of a full os.walk.
+"""
+
+import os
+import re
+import logging
+import pathlib
+import sqlite3
+import time
+
+
+log = logging.getLogger(__name__)
+
+# directories modified less than this many seconds before a refresh are re-listed on the next
+# refresh, as entries added within the mtime resolution would otherwise be missed
+_mtime_settle_time = 2
+
+
+class FileIndex:
+    """
+    Index of the files (with name matching "pattern") under one or more root directories
+
+        >>> index = FileIndex('/tmp/behavior_file_index.sqlite', '^.*\\.mat$')
+        >>> for subpath, mtime, size in index.refresh('/path/to/rig'):
+        ...     pass
+    """
+
+    def __init__(self, index_path, pattern='.*'):
+        self.index_path = pathlib.Path(index_path)
+        self.pattern = pattern
+        self._rexp = re.compile(pattern)
+
+    def _connect(self):
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.index_path.as_posix())
+        conn.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                     'root TEXT, pattern TEXT, path TEXT, parent TEXT, mtime REAL, '
+                     'PRIMARY KEY (root, pattern, path))')
+        conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                     'root TEXT, pattern TEXT, dir TEXT, name TEXT, mtime REAL, size INTEGER, '
+                     'PRIMARY KEY (root, pattern, dir, name))')
+        return conn
+
+    def refresh(self, root):
+        """
+        Incrementally refresh the index of the specified root directory
+
+        :param root: root directory
+        :return: list of (subpath, mtime, size) of the indexed files, sorted by subpath -
+                 with subpath a pathlib.Path relative to root
+        """
+        root = pathlib.Path(root)
+        root_key = root.as_posix()
+        key = (root_key, self.pattern)
+
+        start_time = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                cached_mtimes = dict(conn.execute(
+                    'SELECT path, mtime FROM dirs WHERE root=? AND pattern=?', key))
+                cached_subdirs = {}
+                for path, parent in conn.execute(
+                        'SELECT path, parent FROM dirs WHERE root=? AND pattern=?', key):
+                    cached_subdirs.setdefault(parent, []).append(path)
+
+                visited, listed = set(), 0
+                pending = ['.']
+                while pending:
+                    d = pending.pop()
+                    try:
+                        mtime = os.stat(root / d).st_mtime
+                    except (FileNotFoundError, NotADirectoryError):
+                        continue
+
+                    visited.add(d)
+
+                    if d in cached_mtimes and cached_mtimes[d] == mtime:
+                        pending.extend(cached_subdirs.get(d, []))
+                        continue
+
+                    # new or modified directory - (re)list it
+                    listed += 1
+                    subdirs, files = [], []
+                    with os.scandir(root / d) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name if d == '.' else '{}/{}'.format(d, entry.name))
+                            elif entry.is_file() and self._rexp.match(entry.name):
+                                stat = entry.stat()
+                                files.append((*key, d, entry.name, stat.st_mtime, stat.st_size))
+
+                    # a directory modified too recently may still change within the same mtime
+                    dir_mtime = None if start_time - mtime < _mtime_settle_time else mtime
+
+                    conn.execute('DELETE FROM files WHERE root=? AND pattern=? AND dir=?', (*key, d))
+                    conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', files)
+                    conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                                 (*key, d, None if d == '.' else os.path.dirname(d) or '.', dir_mtime))
+                    conn.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                                     [(*key, s, d, None) for s in subdirs])
+                    pending.extend(subdirs)
+
+                # drop the directories (and their files) removed since the last refresh
+                removed = [(*key, d) for d in set(cached_mtimes) - visited]
+                conn.executemany('DELETE FROM dirs WHERE root=? AND pattern=? AND path=?', removed)
+                conn.executemany('DELETE FROM files WHERE root=? AND pattern=? AND dir=?', removed)
+
+                indexed = sorted((pathlib.Path(d, name), mtime, size) for d, name, mtime, size in conn.execute(
+                    'SELECT dir, name, mtime, size FROM files WHERE root=? AND pattern=?', key))
+        finally:
+            conn.close()
+
+        log.debug('FileIndex.refresh(): {} - {} directories visited, {} listed - {:.2f}s'.format(
+            root, len(visited), listed, time.time() - start_time))
+
+        return indexed
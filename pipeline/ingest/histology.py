@@ -151,21 +151,9 @@ class HistologyIngest(dj.Imported):
             log.info('... found probe {} histology file(s) {}'.format(
                 self.probe, probefiles))
 
+            recs = []
             for probepath, shank_no in zip(probefiles, shanks):
-                hist = scio.loadmat(probepath, struct_as_record=False, squeeze_me=True)['site']
-                px_res = int(hist.pos.mmPerPixel * 1000)
-
-                # probe CCF 3D positions
-                ccf_xyz = np.vstack([hist.pos.x, hist.pos.y, hist.pos.z]).T * px_res
-                # and quantizing to CCF voxel size;
-                ccf_xyz = ccf_res * np.around(ccf_xyz / ccf_res)
-
-                # bundle with MRI position
-                mri_xyz = np.vstack([hist.warp.x, hist.warp.y, hist.warp.z]).T * px_res
-                pos_xyz = np.hstack([ccf_xyz, mri_xyz])
-
-                # probe CCF regions
-                ont_ids = np.where(np.isnan(hist.ont.id), 0, hist.ont.id)
+                pos_xyz, ont_ids = load_site_positions(probepath, ccf_res)
 
                 probe_electrodes = (ephys.ProbeInsertion.proj() * lab.ProbeType.Electrode & self.egroup
                                     & {'shank': shank_no}).fetch(as_dict=True, order_by='electrode asc')
@@ -177,83 +165,36 @@ class HistologyIngest(dj.Imported):
                 ont_ids = ont_ids[:len(probe_electrodes)]
                 pos_xyz = pos_xyz[:len(probe_electrodes), :]
 
-                recording_electrodes = (ephys.ProbeInsertion.proj() * lab.ElectrodeConfig.Electrode.proj()
-                                        * lab.ProbeType.Electrode.proj('shank')
-                                        & self.egroup & {'shank': shank_no}).fetch(
-                    'electrode', order_by='electrode asc')
-
-                recs = ({**electrode, **self.egroup, 'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
-                         'ccf_x': int(ccf_x), 'ccf_y': int(ccf_y), 'ccf_z': int(ccf_z),
-                         'mri_x': mri_x, 'mri_y': mri_y, 'mri_z': mri_z}
-                        for electrode, (ccf_x, ccf_y, ccf_z, mri_x, mri_y, mri_z), ont_id in
-                        zip(probe_electrodes, pos_xyz, ont_ids)
-                        if ont_id > 0 and electrode['electrode'] in recording_electrodes)
-
-                # ideally ElectrodePosition.insert(...) but some are outside of CCF...
-                log.info('inserting channel ccf position')
-                histology.ElectrodeCCFPosition.insert1(self.egroup, ignore_extra_fields=True,
-                                                       skip_duplicates=True)
-
-                for r in recs:
-                    log.debug('... adding probe/position: {}'.format(r))
-                    try:
-                        histology.ElectrodeCCFPosition.ElectrodePosition.insert1(
-                            r, ignore_extra_fields=True, allow_direct_insert=True)
-                    except Exception as e:  # XXX: no way to be more precise in dj
-                        # log.warning('... ERROR!: {}'.format(repr(e)))
-                        histology.ElectrodeCCFPosition.ElectrodePositionError.insert1(
-                            r, ignore_extra_fields=True, allow_direct_insert=True)
-
-                log.info('... ok.')
+                recording_electrodes = set((ephys.ProbeInsertion.proj() * lab.ElectrodeConfig.Electrode.proj()
+                                            * lab.ProbeType.Electrode.proj('shank')
+                                            & self.egroup & {'shank': shank_no}).fetch('electrode'))
+
+                recs.extend({**electrode, **self.egroup, 'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
+                             'ccf_x': int(ccf_x), 'ccf_y': int(ccf_y), 'ccf_z': int(ccf_z),
+                             'mri_x': mri_x, 'mri_y': mri_y, 'mri_z': mri_z}
+                            for electrode, (ccf_x, ccf_y, ccf_z, mri_x, mri_y, mri_z), ont_id in
+                            zip(probe_electrodes, pos_xyz, ont_ids)
+                            if ont_id > 0 and electrode['electrode'] in recording_electrodes)
+
+            log.info('inserting channel ccf position')
+            histology.ElectrodeCCFPosition.insert1(self.egroup, ignore_extra_fields=True,
+                                                   skip_duplicates=True)
+            insert_electrode_positions(recs)
+
+            log.info('... ok.')
 
             return True
 
         if found['format'] == 2:
 
-            # load data,
-            cloc_data = {}
             cloc_file = found['channel_locations']
-
             log.debug('loading format 2 channels from {}'.format(cloc_file))
-            with open(cloc_file, 'r') as fh:
-                cloc_raw = json.loads(fh.read())
-
-            cloc_data['origin'] = cloc_raw['origin']
-
-            if len(cloc_data['origin'].keys()) > 1:
-                log.error('> 1 origin region found ({}). skipping.'.format(
-                    cloc_data['origin']))
 
+            channel_locations = load_channel_locations(cloc_file, ccf_res)
+            if channel_locations is None:
                 return
 
-            # ensuring channel data is sorted;
-            cloc_keymap = {int(k.split('_')[1]): k for k
-                           in cloc_raw.keys() if 'channel_' in k}
-
-            cloc_data['channels'] = np.array(
-                [tuple(cloc_raw[cloc_keymap[k]].values()) for k in sorted(
-                    cloc_keymap.keys())],
-                dtype=[
-                    ('x', np.float), ('y', np.float), ('z', np.float),
-                    ('axial', np.float), ('lateral', np.float),
-                    ('brain_region_id', np.int), ('brain_region', np.object)])
-
-            # get/scale xyz positions
-            pos_xyz_raw = np.array([cloc_data['channels'][i]
-                                    for i in ('x', 'y', 'z')]).T
-
-            pos_origin = cloc_data['origin'][
-                list(cloc_data['origin'].keys())[0]]
-
-            pos_xyz = np.copy(pos_xyz_raw)
-
-            # by adjusting xyz axes & offsetting from origin position
-            pos_xyz[:, 0] = pos_origin[0] + pos_xyz_raw[:, 0]
-            pos_xyz[:, 1] = pos_origin[2] - pos_xyz_raw[:, 2]
-            pos_xyz[:, 2] = pos_origin[1] - pos_xyz_raw[:, 1]
-
-            # and quantizing to CCF voxel size;
-            pos_xyz = ccf_res * np.around(pos_xyz / ccf_res)
+            pos_xyz, rec_electrodes = channel_locations
 
             # get recording geometry,
             probe_electrodes = (lab.ProbeType.Electrode
@@ -261,15 +202,6 @@ class HistologyIngest(dj.Imported):
                                    & self.egroup)).fetch(
                                        order_by='electrode asc')
 
-            rec_electrodes = np.array(
-                [cloc_data['channels']['lateral'],
-                 cloc_data['channels']['axial']]).T
-
-            # adjusting to boundaries, # FIXME: WHY, ISOK?
-            # also: example session was -= 11; this seems more robust.
-            rec_electrodes[:, 0] = (
-                16 * (np.around(rec_electrodes[:, 0] / 16) - 1))
-
             # to find corresponding electrodes,
             elec_coord = np.array(
                 [probe_electrodes['x_coord'], probe_electrodes['y_coord']]).T
@@ -284,31 +216,16 @@ class HistologyIngest(dj.Imported):
             log.debug('... adding ElectrodeCCFPosition: {}'.format(
                 self.egroup))
 
-            ElectrodeCCFPosition = histology.ElectrodeCCFPosition
-            ElectrodePosition = ElectrodeCCFPosition.ElectrodePosition
-            ElectrodePositionError = (
-                ElectrodeCCFPosition.ElectrodePositionError)
-
-            ElectrodeCCFPosition.insert1(
+            histology.ElectrodeCCFPosition.insert1(
                 self.egroup, ignore_extra_fields=True, skip_duplicates=True)
 
-            for z in zip(probe_electrodes[rec_to_elec_idx]['electrode'],
-                         pos_xyz[:, 0], pos_xyz[:, 1], pos_xyz[:, 2]):
-
-                z = [int(i) for i in z]  # integer CCF voxels, electrodes.
-                rec = {**self.egroup, 'electrode': z[0],
-                       'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
-                       'ccf_x': z[1], 'ccf_y': z[2], 'ccf_z': z[3]}
-                        # via nullable: 'mri_x': 0, 'mri_y': 0, 'mri_z': 0
-
-                log.debug('...... adding ElectrodePosition: {}'.format(rec))
-
-                try:
-                    ElectrodePosition.insert1(rec)
-                except Exception as e:  # XXX: no way to be more precise in dj
-                    log.warning('...... ElectrodePositionError: {}'.format(
-                        repr(e)))
-                    ElectrodePositionError.insert1(rec)
+            # integer CCF voxels, electrodes.
+            # via nullable: 'mri_x': 0, 'mri_y': 0, 'mri_z': 0
+            insert_electrode_positions([
+                {**self.egroup, 'electrode': int(electrode),
+                 'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
+                 'ccf_x': int(x), 'ccf_y': int(y), 'ccf_z': int(z)}
+                for electrode, (x, y, z) in zip(probe_electrodes[rec_to_elec_idx]['electrode'], pos_xyz)])
 
             return True
 
@@ -510,6 +427,141 @@ class HistologyIngest(dj.Imported):
 # ================== HELPER FUNCTIONS ====================
 
 
+def load_site_positions(probepath, ccf_res):
+    """
+    Load the electrode site positions of a format 1 histology file (..._siteInfo.mat)
+    :param ccf_res: CCF voxel size (um) the CCF positions are quantized to
+    :return: (pos_xyz, ont_ids) - (site x 6) CCF (x, y, z) and MRI (x, y, z) positions,
+             and the ontology id of each site (0: none)
+    """
+    hist = scio.loadmat(probepath, struct_as_record=False, squeeze_me=True)['site']
+    px_res = int(hist.pos.mmPerPixel * 1000)
+
+    # probe CCF 3D positions
+    ccf_xyz = np.vstack([hist.pos.x, hist.pos.y, hist.pos.z]).T * px_res
+    # and quantizing to CCF voxel size;
+    ccf_xyz = ccf_res * np.around(ccf_xyz / ccf_res)
+
+    # bundle with MRI position
+    mri_xyz = np.vstack([hist.warp.x, hist.warp.y, hist.warp.z]).T * px_res
+    pos_xyz = np.hstack([ccf_xyz, mri_xyz])
+
+    # probe CCF regions
+    ont_ids = np.where(np.isnan(hist.ont.id), 0, hist.ont.id)
+
+    return pos_xyz, ont_ids
+
+
+def load_channel_locations(cloc_file, ccf_res):
+    """
+    Load the channel positions of a format 2 histology file (channel_locations*.json)
+    :param ccf_res: CCF voxel size (um) the CCF positions are quantized to
+    :return: (pos_xyz, rec_electrodes) - (channel x 3) CCF (x, y, z) positions and the
+             (channel x 2) (x, y) probe coordinates of the channels, sorted by channel number
+             - None if more than one origin region is found
+    """
+    with open(cloc_file, 'r') as fh:
+        cloc_raw = json.loads(fh.read())
+
+    origin = cloc_raw['origin']
+
+    if len(origin.keys()) > 1:
+        log.error('> 1 origin region found ({}). skipping.'.format(origin))
+        return None
+
+    # ensuring channel data is sorted;
+    cloc_keymap = {int(k.split('_')[1]): k for k
+                   in cloc_raw.keys() if 'channel_' in k}
+
+    channels = np.array(
+        [tuple(cloc_raw[cloc_keymap[k]].values()) for k in sorted(
+            cloc_keymap.keys())],
+        dtype=[
+            ('x', float), ('y', float), ('z', float),
+            ('axial', float), ('lateral', float),
+            ('brain_region_id', int), ('brain_region', object)])
+
+    # get/scale xyz positions
+    pos_xyz_raw = np.array([channels[i] for i in ('x', 'y', 'z')]).T
+
+    pos_origin = origin[list(origin.keys())[0]]
+
+    pos_xyz = np.copy(pos_xyz_raw)
+
+    # by adjusting xyz axes & offsetting from origin position
+    pos_xyz[:, 0] = pos_origin[0] + pos_xyz_raw[:, 0]
+    pos_xyz[:, 1] = pos_origin[2] - pos_xyz_raw[:, 2]
+    pos_xyz[:, 2] = pos_origin[1] - pos_xyz_raw[:, 1]
+
+    # and quantizing to CCF voxel size;
+    pos_xyz = ccf_res * np.around(pos_xyz / ccf_res)
+
+    rec_electrodes = np.array([channels['lateral'], channels['axial']]).T
+
+    # adjusting to boundaries, # FIXME: WHY, ISOK?
+    # also: example session was -= 11; this seems more robust.
+    rec_electrodes[:, 0] = (
+        16 * (np.around(rec_electrodes[:, 0] / 16) - 1))
+
+    return pos_xyz, rec_electrodes
+
+
+def get_ccf_voxels(recs):
+    """
+    The ccf.CCF voxels (ccf_label_id, ccf_x, ccf_y, ccf_z) within the bounding box of the
+    ElectrodeCCFPosition.ElectrodePosition records "recs" - in one ccf.CCF query per ccf_label_id
+    :return: (n, 4) int array
+    """
+    ccf_attrs = ('ccf_label_id', 'ccf_x', 'ccf_y', 'ccf_z')
+    rec_voxels = np.array([[r[k] for k in ccf_attrs] for r in recs], dtype=int).reshape(-1, 4)
+
+    ccf_voxels = [np.empty((0, 4), dtype=int)]
+    for ccf_label_id in np.unique(rec_voxels[:, 0]):
+        xyz = rec_voxels[rec_voxels[:, 0] == ccf_label_id, 1:]
+        bounding_box = ' AND '.join('{} BETWEEN {} AND {}'.format(attr, lo, hi) for attr, lo, hi in zip(
+            ccf_attrs[1:], xyz.min(axis=0), xyz.max(axis=0)))
+        ccf_voxels.append(np.column_stack(
+            (ccf.CCF & {'ccf_label_id': int(ccf_label_id)} & bounding_box).fetch(*ccf_attrs)).astype(int))
+    return np.vstack(ccf_voxels)
+
+
+def partition_electrode_positions(recs, ccf_voxels):
+    """
+    Partition ElectrodeCCFPosition.ElectrodePosition records by whether their (ccf_label_id, ccf_x, ccf_y, ccf_z)
+    is one of "ccf_voxels" (see get_ccf_voxels()) - i.e. satisfies the foreign key to ccf.CCF
+    :return: (valid records, records for ElectrodePositionError)
+    """
+    rec_voxels = np.array([[r[k] for k in ('ccf_label_id', 'ccf_x', 'ccf_y', 'ccf_z')] for r in recs],
+                          dtype=int).reshape(-1, 4)
+    ccf_voxels = np.asarray(ccf_voxels, dtype=int).reshape(-1, 4)
+
+    # pack the voxels into single integers, to test their membership at once
+    voxels = np.vstack([rec_voxels, ccf_voxels])
+    voxels_min = voxels.min(axis=0, initial=0)
+    packed = np.ravel_multi_index((voxels - voxels_min).T, voxels.max(axis=0, initial=0) - voxels_min + 1)
+    is_ccf_voxel = np.isin(packed[:len(recs)], packed[len(recs):])
+
+    return ([r for r, v in zip(recs, is_ccf_voxel) if v],
+            [r for r, v in zip(recs, is_ccf_voxel) if not v])
+
+
+def insert_electrode_positions(recs):
+    """
+    Insert the ElectrodeCCFPosition.ElectrodePosition records "recs" - those outside of the CCF
+    (see partition_electrode_positions()) into ElectrodeCCFPosition.ElectrodePositionError
+    """
+    valid, errors = partition_electrode_positions(recs, get_ccf_voxels(recs))
+
+    if errors:
+        log.warning('...... {} electrode(s) outside of the CCF - ElectrodePositionError: {}'.format(
+            len(errors), [r['electrode'] for r in errors]))
+
+    histology.ElectrodeCCFPosition.ElectrodePosition.insert(
+        valid, ignore_extra_fields=True, allow_direct_insert=True)
+    histology.ElectrodeCCFPosition.ElectrodePositionError.insert(
+        errors, ignore_extra_fields=True, allow_direct_insert=True)
+
+
 def archive_electrode_histology(insertion_key, note='', delete=False):
     """
     For the specified "insertion_key" copy from histology.ElectrodeCCFPosition and histology.LabeledProbeTrack
@@ -1,20 +1,24 @@
 
 import os
+import re
 import logging
 import pathlib
 from glob import glob
 from datetime import datetime
 import uuid
+import itertools
 
 import numpy as np
+import pandas as pd
 import datajoint as dj
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from pipeline import lab
 from pipeline import tracking
 from pipeline import experiment
 from pipeline.ingest import behavior as behavior_ingest
-from collections import defaultdict
-from .. import get_schema_name
+from .. import get_schema_name, InsertBuffer
 
 schema = dj.schema(get_schema_name('ingest_tracking'))
 
@@ -42,6 +46,23 @@ def get_tracking_paths():
     return dj.config.get('custom', {}).get('tracking_data_paths', None)
 
 
+def get_tracking_ingest_workers():
+    """
+    retrieve the number of threads used to load the tracking files of a camera
+    from dj.config (default: 4)
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'tracking_ingest_workers': 8
+        }
+        ...
+      }
+    """
+    return int(dj.config.get('custom', {}).get('tracking_ingest_workers', 4))
+
+
 @schema
 class TrackingIngest(dj.Imported):
     definition = """
@@ -84,7 +105,7 @@ class TrackingIngest(dj.Imported):
                               if session_rig == 'RRig-MTL'
                               else 'tracking_device in ("Camera 0", "Camera 1", "Camera 2")')
 
-        tracking_files = []
+        tracking_files, file_indexes = [], {}
         for device in (tracking.TrackingDevice & camera_restriction).fetch(as_dict=True):
             tdev = device['tracking_device']
             cam_pos = device['tracking_position']
@@ -110,26 +131,30 @@ class TrackingIngest(dj.Imported):
                 log.warning('\tNo tracking directory found for {} ({}) - skipping...'.format(tdev, cam_pos))
                 continue
 
+            if tracking_sess_dir not in file_indexes:
+                file_indexes[tracking_sess_dir] = SessionTrackingFiles(tracking_sess_dir, h2o)
+            file_index = file_indexes[tracking_sess_dir]
+
             campath = None
             tpos = None
             for tpos_candidate in self.camera_position_mapper[cam_pos]:
                 camtrial_fn = '{}_{}_{}.txt'.format(h2o, sdate_sml, tpos_candidate)
                 log.info('Trying camera position trial map: {}'.format(tracking_sess_dir / camtrial_fn))
-                if (tracking_sess_dir / camtrial_fn).exists():
+                if camtrial_fn in file_index:
                     campath = tracking_sess_dir / camtrial_fn
                     tpos = tpos_candidate
                     log.info('Matched! Using "{}"'.format(tpos))
                     break
 
-            csv_file_ending = '' if session_rig == 'RRig-MTL' else '-*'  # csv filename containing '-0000' or not
+            csv_suffixed = session_rig != 'RRig-MTL'  # csv filename containing '-0000' or not
 
             if campath is None:
                 log.info('Video-Trial mapper file (.txt) not found - Using one-to-one trial mapping')
                 tmap = {tr - (1 if session_rig == 'RRig-MTL' else 0): tr for tr in trials}  # one-to-one map
                 for tpos_candidate in self.camera_position_mapper[cam_pos]:
-                    camtrial_fn = '{}*_{}_[0-9]*{}.csv'.format(h2o, tpos_candidate, csv_file_ending)
-                    log.info('Trying camera position trial map: {}'.format(tracking_sess_dir / camtrial_fn))
-                    if list(tracking_sess_dir.glob(camtrial_fn)):
+                    log.info('Trying camera position trial files: {} ({})'.format(
+                        tracking_sess_dir, tpos_candidate))
+                    if file_index.trial_files(tpos_candidate, csv_suffixed):
                         tpos = tpos_candidate
                         log.info('Matched! Using "{}"'.format(tpos))
                         break
@@ -147,22 +172,28 @@ class TrackingIngest(dj.Imported):
 
             log.info('loading tracking data for {} trials'.format(n_tmap))
 
-            i = 0
-            for t in tmap:  # load tracking for trial
-                if tmap[t] not in trials:
-                    log.warning('nonexistant trial {}.. skipping'.format(t))
-                    continue
+            nonexistent = [t for t in tmap if tmap[t] not in trials]
+            if nonexistent:
+                log.warning('nonexistant trials {}.. skipping'.format(nonexistent))
 
-                i += 1
+            # ex: dl59_side_1(-0000).csv
+            trial_paths = file_index.trial_files(tpos, csv_suffixed)
+            trial_files = [(t, trial_paths[t][0]) for t in tmap
+                           if tmap[t] in trials and len(trial_paths.get(t, [])) == 1]
 
-                # ex: dl59_side_1(-0000).csv
-                tracking_trial_filename = '{}*_{}_{}{}.csv'.format(h2o, tpos, t, csv_file_ending)
-                tracking_trial_filepath = list(tracking_sess_dir.glob(tracking_trial_filename))
+            missing = [t for t in tmap if tmap[t] in trials and t not in trial_paths]
+            duplicated = {t: trial_paths[t] for t in tmap if tmap[t] in trials and len(trial_paths.get(t, [])) > 1}
+            if missing:
+                log.warning('{} trials without tracking file - skipping: {}'.format(len(missing), missing))
+            if duplicated:
+                log.warning('{} trials with multiple tracking files - skipping: {}'.format(
+                    len(duplicated), duplicated))
 
-                if not tracking_trial_filepath or len(tracking_trial_filepath) > 1:
-                    log.debug('file mismatch: file: {} trial: {} ({})'.format(
-                        t, tmap[t], tracking_trial_filepath))
-                    continue
+            log.info('loading {} tracking files'.format(len(trial_files)))
+
+            device_rows = {tbl: [] for tbl in tracking_tables}
+            for i, ((t, tracking_trial_filepath), trk) in enumerate(zip(
+                    trial_files, self.load_tracking_files([f for _, f in trial_files])), 1):
 
                 if i % 50 == 0:
                     log.info('item {}/{}, trial #{} ({:.2f}%)'
@@ -171,84 +202,18 @@ class TrackingIngest(dj.Imported):
                     log.debug('item {}/{}, trial #{} ({:.2f}%)'
                               .format(i, n_tmap, t, (i/n_tmap)*100))
 
-                tracking_trial_filepath = tracking_trial_filepath[-1]
-                try:
-                    trk = self.load_tracking(tracking_trial_filepath)
-                except Exception as e:
-                    log.warning('Error loading .csv: {}\n{}'.format(
-                        tracking_trial_filepath, str(e)))
-                    raise e
-
-                recs = {}
                 rec_base = dict(key, trial=tmap[t], tracking_device=tdev)
+                for tbl, rows in tracking_rows(rec_base, trk).items():
+                    device_rows[tbl].extend(rows)
 
-                for k in trk:
-                    if k == 'samples':
-                        recs['tracking'] = {
-                            **rec_base,
-                            'tracking_samples': len(trk['samples']['ts']),
-                        }
-                    else:
-                        rec = dict(rec_base)
-
-                        for attr in trk[k]:
-                            rec_key = '{}_{}'.format(k, attr)
-                            rec[rec_key] = np.array(trk[k][attr])
-
-                        recs[k] = rec
-
-                tracking.Tracking.insert1(
-                    recs['tracking'], allow_direct_insert=True)
-
-                if 'nose' in recs:
-                    tracking.Tracking.NoseTracking.insert1(
-                        recs['nose'], allow_direct_insert=True)
-
-                if 'tongue' in recs:
-                    tracking.Tracking.TongueTracking.insert1(
-                        recs['tongue'], allow_direct_insert=True)
-
-                if 'jaw' in recs:
-                    tracking.Tracking.JawTracking.insert1(
-                        recs['jaw'], allow_direct_insert=True)
-
-                if 'paw_left' in recs:
-                    fmap = {'paw_left_x': 'left_paw_x',  # remap field names
-                            'paw_left_y': 'left_paw_y',
-                            'paw_left_likelihood': 'left_paw_likelihood'}
-
-                    tracking.Tracking.LeftPawTracking.insert1({
-                        **{k: v for k, v in recs['paw_left'].items()
-                           if k not in fmap},
-                        **{fmap[k]: v for k, v in recs['paw_left'].items()
-                           if k in fmap}}, allow_direct_insert=True)
-
-                if 'paw_right' in recs:
-                    fmap = {'paw_right_x': 'right_paw_x',  # remap field names
-                            'paw_right_y': 'right_paw_y',
-                            'paw_right_likelihood': 'right_paw_likelihood'}
-
-                    tracking.Tracking.RightPawTracking.insert1({
-                        **{k: v for k, v in recs['paw_right'].items()
-                           if k not in fmap},
-                        **{fmap[k]: v for k, v in recs['paw_right'].items()
-                           if k in fmap}}, allow_direct_insert=True)
-
-                if 'lickport' in recs:
-                    tracking.Tracking.LickPortTracking.insert1(
-                        recs['lickport'], allow_direct_insert=True)
-
-                # special handling for whisker(s)
-                whisker_keys = [k for k in recs if 'whisker' in k]
-                tracking.Tracking.WhiskerTracking.insert([
-                    {**recs[k], 'whisker_name': k} for k in whisker_keys],
-                    allow_direct_insert=True)
+            insert_tracking_rows(device_rows)
 
-                tracking_files.append({
-                    **key, 'trial': tmap[t], 'tracking_device': tdev,
-                    'tracking_file': tracking_trial_filepath.relative_to(tracking_root_dir).as_posix()})
+            tracking_files.extend({
+                **key, 'trial': tmap[t], 'tracking_device': tdev,
+                'tracking_file': tracking_trial_filepath.relative_to(tracking_root_dir).as_posix()}
+                for t, tracking_trial_filepath in trial_files)
 
-            log.info('... completed {}/{} items.'.format(i, n_tmap))
+            log.info('... completed {}/{} items.'.format(len(trial_files), n_tmap))
 
         log.info('\n---------------------')
         if tracking_files:
@@ -265,8 +230,8 @@ class TrackingIngest(dj.Imported):
             return {int(k): int(v) for i in f
                     for k, v in (i.strip().split('\t'),)}
 
-    def load_tracking(self, trkpath):
-        log.debug('load_tracking() {}'.format(trkpath))
+    @staticmethod
+    def load_tracking(trkpath):
         '''
         load actual tracking data.
 
@@ -279,14 +244,14 @@ class TrackingIngest(dj.Imported):
 
         results are of the form:
 
-          {'feature': {'attr': [val, ...]}}
+          {'feature': {'attr': np.array([val, ...], dtype=np.float32)}}
 
         where feature is e.g. 'nose', 'attr' is e.g. 'x'.
 
         the special 'feature'/'attr' pair "samples"/"ts" is used to store
         the first column/sample timestamp for each row in the input file.
         '''
-        res = defaultdict(lambda: defaultdict(list))
+        log.debug('load_tracking() {}'.format(trkpath))
 
         with open(trkpath, 'r') as f:
             f.readline()  # discard 1st line
@@ -294,18 +259,109 @@ class TrackingIngest(dj.Imported):
             parts = parts.rstrip().split(',')
             fields = fields.rstrip().split(',')
 
-            for l in f:
-                if l.strip():
-                    lv = l.rstrip().split(',')
-                    for i, v in enumerate(lv):
-                        v = float(v)
-                        if i == 0:
-                            res['samples']['ts'].append(v)
-                        else:
-                            res[parts[i]][fields[i]].append(v)
+            # (column x sample)
+            data = np.ascontiguousarray(pd.read_csv(
+                f, header=None, names=range(len(parts)), dtype=np.float64).to_numpy(dtype=np.float32).T)
+
+        res = {'samples': {'ts': data[0]}}
+        for part, field, values in zip(parts[1:], fields[1:], data[1:]):
+            res.setdefault(part, {})[field] = values
 
         return res
 
+    @classmethod
+    def load_tracking_files(cls, trkpaths, n_workers=None):
+        '''
+        load_tracking() of the specified files, in a pool of "n_workers" threads
+        (default: get_tracking_ingest_workers())
+        :return: generator of the loaded tracking data, in the order of "trkpaths"
+        '''
+        n_workers = get_tracking_ingest_workers() if n_workers is None else n_workers
+
+        n_workers = max(n_workers, 1)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pending = deque()
+            trkpaths = iter(trkpaths)
+            while True:
+                # keep at most 2 files per worker loaded ahead of the consumer
+                for trkpath in itertools.islice(trkpaths, 2 * n_workers - len(pending)):
+                    pending.append((trkpath, executor.submit(cls.load_tracking, trkpath)))
+                if not pending:
+                    break
+                trkpath, future = pending.popleft()
+                try:
+                    yield future.result()
+                except Exception as e:
+                    log.warning('Error loading .csv: {}\n{}'.format(trkpath, str(e)))
+                    raise e
+
+
+# ======== Tracking rows insertion ========
+
+# tracking.Tracking and its part tables, in insertion order
+tracking_tables = (tracking.Tracking,
+                   tracking.Tracking.NoseTracking,
+                   tracking.Tracking.TongueTracking,
+                   tracking.Tracking.JawTracking,
+                   tracking.Tracking.LeftPawTracking,
+                   tracking.Tracking.RightPawTracking,
+                   tracking.Tracking.LickPortTracking,
+                   tracking.Tracking.WhiskerTracking)
+
+# tracked feature: (part table, attribute prefix in the part table)
+_feature_tables = {'nose': (tracking.Tracking.NoseTracking, 'nose'),
+                   'tongue': (tracking.Tracking.TongueTracking, 'tongue'),
+                   'jaw': (tracking.Tracking.JawTracking, 'jaw'),
+                   'paw_left': (tracking.Tracking.LeftPawTracking, 'left_paw'),
+                   'paw_right': (tracking.Tracking.RightPawTracking, 'right_paw'),
+                   'lickport': (tracking.Tracking.LickPortTracking, 'lickport')}
+
+# bounds of a single insert statement - in rows, and in (approximate) bytes of tracking data
+_insert_chunk_rows = 500
+_insert_chunk_bytes = 16 * 1024 * 1024
+
+
+def tracking_rows(rec_base, trk):
+    """
+    tracking.Tracking and part table rows of the tracking data of one trial
+    :param rec_base: primary key of the tracking.Tracking row (session, trial, tracking_device)
+    :param trk: tracking data of the trial (see TrackingIngest.load_tracking())
+    :return: {table: [row, ...]}
+    """
+    rows = {tracking.Tracking: [{**rec_base, 'tracking_samples': len(trk['samples']['ts'])}]}
+
+    for feature, attrs in trk.items():
+        if feature in _feature_tables:
+            tbl, prefix = _feature_tables[feature]
+            rows.setdefault(tbl, []).append({
+                **rec_base, **{'{}_{}'.format(prefix, attr): v for attr, v in attrs.items()}})
+        elif 'whisker' in feature:  # special handling for whisker(s)
+            rows.setdefault(tracking.Tracking.WhiskerTracking, []).append({
+                **rec_base, 'whisker_name': feature,
+                **{'{}_{}'.format(feature, attr): v for attr, v in attrs.items()}})
+
+    return rows
+
+
+def insert_tracking_rows(rows):
+    """
+    Insert the tracking rows of "rows" ({table: [row, ...]}, master table first) in chunks
+    of at most _insert_chunk_rows rows / _insert_chunk_bytes bytes of tracking data
+    """
+    for tbl, tbl_rows in rows.items():
+        if not tbl_rows:
+            continue
+
+        row_bytes = max(sum(getattr(v, 'nbytes', 0) for v in r.values()) for r in tbl_rows)
+        chunksz = max(1, min(_insert_chunk_rows, _insert_chunk_bytes // max(row_bytes, 1)))
+
+        log.debug('inserting {} {} rows - {} rows per insert'.format(
+            len(tbl_rows), tbl.__name__, chunksz))
+        with InsertBuffer(tbl, chunksz, allow_direct_insert=True) as ib:
+            for r in tbl_rows:
+                ib.insert1(r)
+                ib.flush()
+
 
 # ======== Helpers for directory navigation ========
 
@@ -392,3 +448,44 @@ def _get_MTL_sess_tracking_dir(tracking_path, session, camera_position):
 
     raise FileNotFoundError(
         'Multi-target-licking tracking data dir ({}) not found'.format(dir.relative_to(tracking_path)))
+
+
+class SessionTrackingFiles:
+    """
+    Index of the files of a session tracking directory - listed once, instead of globbing
+    the directory for each trial of each camera
+    """
+
+    def __init__(self, sess_dir, h2o):
+        self.sess_dir = pathlib.Path(sess_dir)
+        self.h2o = h2o
+        with os.scandir(self.sess_dir) as entries:
+            self.filenames = sorted(e.name for e in entries)
+        self._names = set(self.filenames)
+        self._trial_files = {}
+
+    def __contains__(self, filename):
+        return filename in self._names
+
+    def trial_files(self, tpos, suffixed=True):
+        """
+        Tracking csv files of camera position "tpos", by trial number in the filename,
+        e.g. {1: [sess_dir / 'dl59_side_1-0000.csv'], ...}
+        :param tpos: camera position in the filename (e.g. 'side')
+        :param suffixed: whether the filenames have a '-*' suffix (e.g. '-0000')
+        :return: {trial: [filepath, ...]} - with several files for a duplicated trial
+        """
+        if (tpos, suffixed) not in self._trial_files:
+            # equivalent of the per-trial glob '<h2o>*_<tpos>_<trial>(-*).csv'
+            rexp = re.compile('{}.*_{}_([0-9]+){}\\.csv'.format(
+                re.escape(self.h2o), re.escape(tpos), '-.*' if suffixed else ''))
+
+            trial_files = {}
+            for fname in self.filenames:
+                match = rexp.fullmatch(fname)
+                if match and match.group(1) == str(int(match.group(1))):  # no zero-padded trial
+                    trial_files.setdefault(int(match.group(1)), []).append(self.sess_dir / fname)
+
+            self._trial_files[(tpos, suffixed)] = trial_files
+
+        return self._trial_files[(tpos, suffixed)]
@@ -399,13 +399,15 @@ def plot_driftmap(probe_insertion, clustering_method=None, shank_no=1):
              * lab.ProbeType.Electrode.proj('shank') & {'shank': shank_no})
 
     # ---- ccf region ----
-    annotated_electrodes = (lab.ElectrodeConfig.Electrode * lab.ProbeType.Electrode
-                            * ephys.ProbeInsertion
-                            * histology.ElectrodeCCFPosition.ElectrodePosition
-                            * ccf.CCFAnnotation * ccf.CCFBrainRegion.proj(..., annotation='region_name')
-                            & probe_insertion & {'shank': shank_no})
-    pos_y, ccf_y, color_code = annotated_electrodes.fetch(
-        'y_coord', 'ccf_y', 'color_code', order_by='y_coord DESC')
+    electrodes = (lab.ElectrodeConfig.Electrode * lab.ProbeType.Electrode
+                  * ephys.ProbeInsertion
+                  * histology.ElectrodeCCFPosition.ElectrodePosition
+                  & probe_insertion & {'shank': shank_no})
+    pos_y, ccf_x, ccf_y, ccf_z = electrodes.fetch(
+        'y_coord', 'ccf_x', 'ccf_y', 'ccf_z', order_by='y_coord DESC')
+    color_code = ccf.get_annotation_volume().lookup(np.column_stack([ccf_x, ccf_y, ccf_z]), 'color_code')
+    annotated = pd.notnull(color_code)  # annotated electrodes only
+    pos_y, ccf_y, color_code = pos_y[annotated], ccf_y[annotated], color_code[annotated]
 
     # CCF position of most ventral recording site
     last_electrode_site = np.array((histology.InterpolatedShankTrack.DeepestElectrodePoint
@@ -1,10 +1,17 @@
+import os
 import logging
 import hashlib
+import decimal
+import pathlib
+import tempfile
+import warnings
 
 from functools import partial
+from collections import OrderedDict
 from inspect import getmembers
 from itertools import repeat
 import numpy as np
+import pandas as pd
 import datajoint as dj
 import scipy.stats as sc_stats
 
@@ -17,6 +24,9 @@ from .util import _get_units_hemisphere
 schema = dj.schema(get_schema_name('psth'))
 log = logging.getLogger(__name__)
 
+_session_condition_trials = OrderedDict()  # {((subject_id, session), trial_condition_hash): trials} - LRU first
+_session_condition_trials_max = 256  # number of (session, condition) trials kept per process
+
 # NOW:
 # - rework Condition to TrialCondition funtion+arguments based schema
 
@@ -168,6 +178,62 @@ class TrialCondition(dj.Lookup):
     def get_trials(cls, trial_condition_name):
         return cls.get_func({'trial_condition_name': trial_condition_name})()
 
+    @classmethod
+    def get_session_condition_trials(cls, session_key, trial_condition_names):
+        """
+        Trials (sorted trial numbers) of the session "session_key" in each of the conditions "trial_condition_names"
+        - resolved at once, in memory, from the session's BehaviorTrial and photostim events (fetched once),
+        and kept for the next calls (for the "_session_condition_trials_max" most recently used
+        (session, trial_condition_hash))
+        :return: {trial_condition_name: trials}
+        """
+        conditions = (cls & [{'trial_condition_name': c} for c in trial_condition_names]).fetch(as_dict=True)
+        conditions = {c['trial_condition_name']: c for c in conditions}
+
+        session_key = {k: session_key[k] for k in experiment.Session.primary_key}
+        cache_keys = {name: (tuple(session_key.values()), conditions[name]['trial_condition_hash'])
+                      for name in trial_condition_names}
+        missing = [name for name in trial_condition_names if cache_keys[name] not in _session_condition_trials]
+
+        if missing:
+            behav_attrs, stim_attrs = cls._get_condition_attrs()
+            stim_q = experiment.PhotostimEvent * experiment.PhotostimBrainRegion * experiment.Photostim
+
+            # attributes used by the conditions only (e.g. not the photostim waveforms)
+            used_attrs = {k.lstrip('_') for name in missing for k in conditions[name]['trial_condition_arg']}
+            behav_trials = pd.DataFrame(
+                (experiment.BehaviorTrial & session_key).fetch(*sorted(behav_attrs & used_attrs | {'trial'}),
+                                                               as_dict=True),
+                columns=sorted(behav_attrs & used_attrs | {'trial'}))
+            stim_events = pd.DataFrame(
+                (stim_q & session_key).fetch(*sorted(stim_attrs & used_attrs | {'trial'}), as_dict=True),
+                columns=sorted(stim_attrs & used_attrs | {'trial'}))
+
+            for name in missing:
+                trials = resolve_condition_trials(conditions[name]['trial_condition_func'],
+                                                  conditions[name]['trial_condition_arg'],
+                                                  behav_trials, stim_events, behav_attrs, stim_attrs)
+                trials.setflags(write=False)  # shared by the callers
+                _session_condition_trials[cache_keys[name]] = trials
+
+        condition_trials = {}
+        for name in trial_condition_names:
+            _session_condition_trials.move_to_end(cache_keys[name])
+            condition_trials[name] = _session_condition_trials[cache_keys[name]]
+
+        while len(_session_condition_trials) > _session_condition_trials_max:
+            _session_condition_trials.popitem(last=False)
+
+        return condition_trials
+
+    @staticmethod
+    def _get_condition_attrs():
+        """ attributes of BehaviorTrial and of the photostim events restricted by the conditions """
+        stim_attrs = set((experiment.Photostim * experiment.PhotostimBrainRegion
+                          * experiment.PhotostimEvent).heading.names) - set(experiment.Session.heading.names)
+        behav_attrs = set(experiment.BehaviorTrial.heading.names)
+        return behav_attrs, stim_attrs
+
     @classmethod
     def get_cond_name_from_keywords(cls, keywords):
         matched_cond_names = []
@@ -246,6 +312,332 @@ class TrialCondition(dj.Lookup):
                  - [{k: v} for k, v in _stim_key.items()]).proj())
 
 
+# ---- in-memory trial conditions ----
+def resolve_condition_trials(condition_func, condition_arg, behav_trials, stim_events, behav_attrs, stim_attrs):
+    """
+    In-memory equivalent of the TrialCondition query "condition_func" (_get_trials_exclude_stim or
+    _get_trials_include_stim) with "condition_arg", over the rows of a session:
+    :param behav_trials: pandas.DataFrame of the session's BehaviorTrial rows
+    :param stim_events: pandas.DataFrame of the session's PhotostimEvent * PhotostimBrainRegion * Photostim rows
+    :param behav_attrs, stim_attrs: BehaviorTrial and photostim event attributes (see TrialCondition)
+    :return: sorted array of the trials in the condition
+    """
+    # Note: inclusion (attr) is AND - exclusion (_attr) is OR
+    restr, _restr = {}, {}
+    for k, v in condition_arg.items():
+        if k.startswith('_'):
+            _restr[k[1:]] = v
+        else:
+            restr[k] = v
+
+    def matched(rows, key, exclude_key):
+        match = np.ones(len(rows), dtype=bool)
+        for k, v in key.items():
+            match &= (rows[k] == v).to_numpy()
+        for k, v in exclude_key.items():  # as in SQL, NOT (attr = value) is not true for a NULL attr
+            match &= ~(rows[k] == v).to_numpy() & rows[k].notna().to_numpy()
+        return match
+
+    behav_match = matched(behav_trials, {k: v for k, v in restr.items() if k in behav_attrs},
+                          {k: v for k, v in _restr.items() if k in behav_attrs})
+    stim_match = matched(stim_events, {k: v for k, v in restr.items() if k in stim_attrs},
+                         {k: v for k, v in _restr.items() if k in stim_attrs})
+
+    trials = behav_trials['trial'].to_numpy()[behav_match]
+    stim_trials = stim_events['trial'].to_numpy()[stim_match]
+
+    if condition_func == '_get_trials_exclude_stim':
+        trials = trials[~np.isin(trials, stim_trials)]
+    elif condition_func == '_get_trials_include_stim':
+        trials = trials[np.isin(trials, stim_trials)]
+    else:
+        raise ValueError('Unknown trial condition function: {}'.format(condition_func))
+
+    return np.sort(trials).astype(int)
+
+
+# ---- binned spikes cache ----
+_binned_spikes = OrderedDict()  # {(subject_id, session, insertion_number): BinnedSpikes} - least recently used first
+_binned_spikes_max = 8  # number of insertions kept loaded per process
+
+
+def get_binned_spikes_cache_dir():
+    """
+    retrieve the directory of the local binned spikes cache from dj.config
+    (default: <XDG_CACHE_HOME, or ~/.cache>/map_binned_spikes - persistent across sessions)
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'binned_spikes_cache': '/path/to/cache'
+        }
+        ...
+      }
+    """
+    cache_dir = dj.config.get('custom', {}).get('binned_spikes_cache', None)
+    if cache_dir is None:
+        cache_dir = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'),
+                                 'map_binned_spikes')
+
+    return pathlib.Path(cache_dir)
+
+
+def get_binned_spikes(insertion_key):
+    """
+    BinnedSpikes of the probe insertion of "insertion_key" - loaded from the local cache (see BinnedSpikes.load())
+    and kept for the next calls (for the "_binned_spikes_max" most recently used insertions),
+    reloaded if the ephys.Unit content of the insertion changed
+    """
+    insertion_key = {k: insertion_key[k] for k in ephys.ProbeInsertion.primary_key}
+    cache_key = tuple(insertion_key.values())
+    fingerprint = BinnedSpikes.get_fingerprint(insertion_key)
+
+    binned = _binned_spikes.pop(cache_key, None)
+    if binned is None or binned.fingerprint != fingerprint:
+        binned = BinnedSpikes.load(insertion_key, get_binned_spikes_cache_dir(), fingerprint=fingerprint)
+
+    _binned_spikes[cache_key] = binned
+    while len(_binned_spikes) > _binned_spikes_max:
+        _binned_spikes.popitem(last=False)
+
+    return binned
+
+
+class BinnedSpikes:
+    """
+    Unit x trial x bin spike counts of the ephys.Unit.TrialSpikes of a probe insertion, binned as
+    UnitPsth (the base binning) - cached locally (memory-mapped) per insertion, to compute PSTHs
+    without fetching and binning the spike times again.
+
+        >>> binned = get_binned_spikes(insertion_key)
+        >>> unit_psth, edges = binned.psth(('jrclust_v4', 12), trials=[1, 2, 5])
+
+    Units are (clustering_method, unit) and "has_trial" (unit x trial) flags the TrialSpikes rows,
+    the (unit, trial) without TrialSpikes having no spike counts.
+    """
+
+    def __init__(self, counts, has_trial, units, trials, edges, binsize, fingerprint=None):
+        """
+        :param counts: (unit x trial x bin) spike counts
+        :param has_trial: (unit x trial) whether the unit has a TrialSpikes row for the trial
+        :param units: units (e.g. (clustering_method, unit)) of the rows of counts
+        :param trials: (sorted) trials of the columns of counts
+        :param edges: bin edges - as np.histogram bins (right-most bin closed)
+        :param binsize: bin size (s)
+        """
+        self.counts = counts
+        self.has_trial = np.asarray(has_trial, dtype=bool)
+        self.units = list(units)
+        self.trials = np.asarray(trials, dtype=int)
+        self.edges = np.asarray(edges, dtype=float)
+        self.binsize = binsize
+        self.fingerprint = fingerprint
+        self._unit_idx = {u: i for i, u in enumerate(self.units)}
+
+    @staticmethod
+    def bin_spikes(spikes, edges):
+        """
+        (row x bin) spike counts of the spike times of each row, binned as np.histogram(bins=edges)
+        """
+        n_bins = len(edges) - 1
+        if not len(spikes):
+            return np.zeros((0, n_bins), dtype=int)
+
+        n_row_spikes = np.array([len(s) for s in spikes])
+        all_spikes = np.concatenate(spikes)
+        in_range = (all_spikes >= edges[0]) & (all_spikes <= edges[-1])
+        spike_rows = np.repeat(np.arange(len(spikes)), n_row_spikes)[in_range]
+        all_spikes = all_spikes[in_range]
+
+        # bin by arithmetic, corrected against the bin edges for rounding errors
+        bin_idx = np.clip(((all_spikes - edges[0]) / (edges[1] - edges[0])).astype(int), 0, n_bins - 1)
+        bin_idx -= all_spikes < edges[bin_idx]
+        bin_idx += (bin_idx < n_bins - 1) & (all_spikes >= edges[np.minimum(bin_idx + 1, n_bins)])
+
+        return np.bincount(spike_rows * n_bins + bin_idx,
+                           minlength=len(spikes) * n_bins).reshape(len(spikes), n_bins)
+
+    @classmethod
+    def from_trial_spikes(cls, spikes, row_units, row_trials, fingerprint=None):
+        """
+        Build the spike counts from TrialSpikes rows, at the UnitPsth binning
+        :param spikes: spike times of each (unit, trial) TrialSpikes row
+        :param row_units: unit of each row
+        :param row_trials: trial of each row
+        """
+        xmin, xmax, binsize = UnitPsth.psth_params.values()
+        edges = np.arange(xmin, xmax, binsize)
+
+        units = sorted(set(row_units))
+        unit_idx = {u: i for i, u in enumerate(units)}
+        trials, trial_idx = np.unique(np.asarray(row_trials, dtype=int), return_inverse=True)
+        row_idx = np.array([unit_idx[u] for u in row_units], dtype=int)
+
+        row_counts = cls.bin_spikes(spikes, edges)
+        counts = np.zeros((len(units), len(trials), len(edges) - 1),
+                          dtype=np.uint16 if row_counts.max(initial=0) < 2 ** 16 else np.uint32)
+        counts[row_idx, trial_idx] = row_counts
+        has_trial = np.zeros((len(units), len(trials)), dtype=bool)
+        has_trial[row_idx, trial_idx] = True
+
+        return cls(counts, has_trial, units, trials, edges, binsize, fingerprint)
+
+    @staticmethod
+    def get_fingerprint(insertion_key):
+        """
+        hash of the ephys.Unit content of the insertion: the clustering time of its clustering results,
+        its units (with unit_uid) and their number of TrialSpikes rows - from the keys only, not the spike times
+        """
+        clustering_times = (dj.U('clustering_method', 'clustering_time')
+                            & (ephys.ClusteringLabel & insertion_key)).fetch(
+            'clustering_method', 'clustering_time', order_by='clustering_method, clustering_time')
+        units = (ephys.Unit & insertion_key).proj('unit_uid').aggr(
+            ephys.Unit.TrialSpikes & insertion_key, 'unit_uid', trial_spikes='count(trial)', keep_all_rows=True)
+        methods, unit_nos, unit_uids, trial_spikes = units.fetch(
+            'clustering_method', 'unit', 'unit_uid', 'trial_spikes', order_by='clustering_method, unit')
+        return dict_to_hash({'clustering_times': [(m, str(t)) for m, t in zip(*clustering_times)],
+                             'units': list(zip(methods, unit_nos.tolist(), unit_uids.tolist(),
+                                               trial_spikes.tolist())),
+                             'psth_params': UnitPsth.psth_params})
+
+    @classmethod
+    def fetch(cls, insertion_key, fingerprint=None):
+        """ Build the spike counts of "insertion_key" from the ephys.Unit.TrialSpikes table """
+        log.info('BinnedSpikes.fetch(): binning spikes of {}'.format(insertion_key))
+        methods, unit_nos, trials, spikes = (ephys.Unit.TrialSpikes & insertion_key).fetch(
+            'clustering_method', 'unit', 'trial', 'spike_times')
+        return cls.from_trial_spikes(spikes, list(zip(methods, unit_nos.tolist())), trials, fingerprint)
+
+    @classmethod
+    def load(cls, insertion_key, cache_dir, fingerprint=None, refresh=False):
+        """
+        Load the spike counts of "insertion_key" from "cache_dir", memory-mapped - binning and
+        caching them first if needed: not cached, cached with another "fingerprint" (see get_fingerprint()),
+        or "refresh"
+        """
+        cache_dir = pathlib.Path(cache_dir)
+        name = '_'.join(str(insertion_key[k]) for k in ephys.ProbeInsertion.primary_key)
+        counts_path = cache_dir / '{}_spike_counts.npy'.format(name)
+        index_path = cache_dir / '{}_spike_index.npz'.format(name)
+
+        if not refresh and counts_path.exists() and index_path.exists():
+            with np.load(index_path) as index:
+                index = dict(index)
+            if fingerprint is None or str(index['fingerprint']) == fingerprint:
+                return cls(np.load(counts_path, mmap_mode='r'), index['has_trial'],
+                           zip(index['clustering_method'], index['unit'].tolist()), index['trials'],
+                           index['edges'], float(index['binsize']), str(index['fingerprint']))
+
+        binned = cls.fetch(insertion_key, fingerprint)
+        binned.save(counts_path, index_path)
+        return binned
+
+    def save(self, counts_path, index_path):
+        """ Save the spike counts to the "counts_path" .npy and the units/trials/bins to the "index_path" .npz """
+        counts_path, index_path = pathlib.Path(counts_path), pathlib.Path(index_path)
+        counts_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to (uniquely named) temporary files first - concurrent readers only ever see complete files
+        with tempfile.NamedTemporaryFile(dir=counts_path.parent, suffix='.tmp', delete=False) as f:
+            np.save(f, np.asarray(self.counts))
+        os.replace(f.name, counts_path)
+
+        with tempfile.NamedTemporaryFile(dir=index_path.parent, suffix='.tmp', delete=False) as f:
+            np.savez(f, has_trial=self.has_trial, trials=self.trials, edges=self.edges, binsize=self.binsize,
+                     clustering_method=np.array([u[0] for u in self.units], dtype=str),
+                     unit=np.array([u[1] for u in self.units], dtype=int),
+                     fingerprint=str(self.fingerprint))
+        os.replace(f.name, index_path)
+
+    def select(self, units=None, trials=None):
+        """
+        BinnedSpikes of the "units" / "trials" subsets (default: all) - units and trials not in
+        the spike counts are ignored
+        """
+        unit_idx = (np.arange(len(self.units)) if units is None
+                    else np.array([self._unit_idx[u] for u in units if u in self._unit_idx], dtype=int))
+        trial_idx = (np.arange(len(self.trials)) if trials is None
+                     else np.flatnonzero(np.isin(self.trials, np.asarray(trials, dtype=int))))
+
+        return BinnedSpikes(self.counts[unit_idx][:, trial_idx], self.has_trial[np.ix_(unit_idx, trial_idx)],
+                            [self.units[i] for i in unit_idx], self.trials[trial_idx],
+                            self.edges, self.binsize, self.fingerprint)
+
+    def rebin(self, factor):
+        """
+        BinnedSpikes with bins of "factor" consecutive bins - the trailing bins not filling
+        a whole rebinned bin are dropped
+        """
+        n_bins = self.counts.shape[-1] // factor
+        if not n_bins:
+            raise ValueError('Cannot rebin {} bins by {}'.format(self.counts.shape[-1], factor))
+
+        counts = np.asarray(self.counts[..., :n_bins * factor]).reshape(
+            len(self.units), len(self.trials), n_bins, factor)
+        return BinnedSpikes(counts.sum(axis=-1), self.has_trial, self.units, self.trials,
+                            self.edges[:n_bins * factor + 1:factor], self.binsize * factor, self.fingerprint)
+
+    def psth(self, unit, trials=None, per_trial=False):
+        """
+        PSTH of "unit" over the "trials" (default: all) with TrialSpikes rows, as compute_unit_psth():
+        (psth, edges[1:]) or, if per_trial, ((trial x time) psths, edges[1:]) - None if there are no rows
+        """
+        if unit not in self._unit_idx:
+            return None
+
+        u = self._unit_idx[unit]
+        trial_idx = np.flatnonzero(self.has_trial[u] & (True if trials is None else np.isin(
+            self.trials, np.asarray(trials, dtype=int))))
+        if not len(trial_idx):
+            return None
+
+        counts = self.counts[u, trial_idx]
+        if per_trial:
+            return counts / self.binsize, self.edges[1:]
+        else:
+            return counts.sum(axis=0) / len(trial_idx) / self.binsize, self.edges[1:]
+
+    def common_trials(self, units):
+        """ (sorted) trials with TrialSpikes rows for all "units" - none if a unit has no spike counts """
+        if any(u not in self._unit_idx for u in units):
+            return np.array([], dtype=int)
+        unit_idx = [self._unit_idx[u] for u in units]
+        return self.trials[self.has_trial[unit_idx].all(axis=0)]
+
+    def trial_rates(self, units, trials):
+        """
+        (unit x trial x bin) firing rates of "units" in "trials" - every (unit, trial) must have
+        a TrialSpikes row (see common_trials())
+        """
+        trials = np.asarray(trials, dtype=int)
+        missing_units = [u for u in units if u not in self._unit_idx]
+        missing_trials = np.setdiff1d(trials, self.common_trials(units)) if not missing_units else []
+        if len(missing_units) or len(missing_trials):
+            raise ValueError('No TrialSpikes for units {} / trials {}'.format(missing_units, list(missing_trials)))
+
+        unit_idx = [self._unit_idx[u] for u in units]
+        trial_idx = np.searchsorted(self.trials, trials)
+        return self.counts[np.ix_(unit_idx, trial_idx)] / self.binsize
+
+    def psths(self, condition_trials):
+        """
+        UnitPsth.unit_psth of every unit x trial condition
+        :param condition_trials: {trial_condition_name: trials of the condition}
+        :return: {(unit, trial_condition_name): unit_psth} - for the unit/conditions with TrialSpikes rows
+        """
+        psths = {}
+        for condition, trials in condition_trials.items():
+            in_condition = np.isin(self.trials, np.asarray(trials, dtype=int))
+            n_rows = self.has_trial[:, in_condition].sum(axis=1)
+            unit_counts = np.asarray(self.counts[:, in_condition]).sum(axis=1)
+
+            for u in np.flatnonzero(n_rows):
+                psths[(self.units[u], condition)] = np.array([unit_counts[u] / n_rows[u] / self.binsize,
+                                                              self.edges[1:]])
+        return psths
+
+
 @schema
 class UnitPsth(dj.Computed):
     definition = """
@@ -256,9 +648,10 @@ class UnitPsth(dj.Computed):
     """
     psth_params = {'xmin': -3, 'xmax': 3, 'binsize': 0.04}
 
-    @property
-    def key_source(self):
+    @staticmethod
+    def get_unit_conditions():
         """
+        The (unit x trial condition) to compute, as (exclude stim, include stim) queries
         For those conditions that include stim, process those with PhotostimBrainRegion already computed only
         Only units not of type "all"
         """
@@ -266,27 +659,48 @@ class UnitPsth(dj.Computed):
                   & 'unit_quality != "all"')
         stim = ((ephys.Unit & (experiment.Session & experiment.PhotostimBrainRegion))
                 * (TrialCondition & 'trial_condition_func = "_get_trials_include_stim"') & 'unit_quality != "all"')
-        return nostim.proj() + stim.proj()
+        return nostim.proj(), stim.proj()
+
+    @property
+    def key_source(self):
+        """
+        Probe insertions with (unit x trial condition) not computed yet - e.g. of TrialConditions added, or of
+        include stim conditions whose PhotostimBrainRegion were ingested, after the insertion was computed
+        """
+        return ephys.ProbeInsertion & [unit_conditions - self for unit_conditions in self.get_unit_conditions()]
 
     def make(self, key):
+        """
+        Compute and insert the PSTHs of the (unit x trial condition) not computed yet of the probe insertion of "key"
+        - from the binned spikes of the insertion (see get_binned_spikes()), the trials of all conditions
+        being resolved at once
+        """
         log.debug('UnitPsth.make(): key: {}'.format(key))
 
-        # expand TrialCondition to trials,
-        trials = TrialCondition.get_trials(key['trial_condition_name'])
+        keys = [unit_condition for unit_conditions in self.get_unit_conditions()
+                for unit_condition in ((unit_conditions & key) - self).fetch('KEY', order_by='KEY')]
+        log.info('UnitPsth.make(): {} - {} units x conditions'.format(key, len(keys)))
 
-        # fetch related spike times
-        q = (ephys.Unit.TrialSpikes & key & trials.proj())
-        spikes = q.fetch('spike_times')
+        session_key = {k: key[k] for k in experiment.Session.primary_key}
+        conditions = sorted({k['trial_condition_name'] for k in keys})
+        condition_trials = TrialCondition.get_session_condition_trials(session_key, conditions)
 
-        if len(spikes) == 0:
-            log.warning('no spikes found for key {} - null psth'.format(key))
-            self.insert1(key)
-            return
+        # binned spikes of all units at once
+        unit_ids = sorted({(k['clustering_method'], k['unit']) for k in keys})
+        binned = get_binned_spikes(key).select(units=unit_ids)
 
-        # compute psth & store
-        unit_psth = self.compute_psth(spikes)
+        # compute psths & store
+        psths = binned.psths(condition_trials)
 
-        self.insert1({**key, 'unit_psth': unit_psth})
+        rows = []
+        for unit_condition in keys:
+            unit_psth = psths.get(((unit_condition['clustering_method'], unit_condition['unit']),
+                                   unit_condition['trial_condition_name']))
+            if unit_psth is None:
+                log.warning('no spikes found for key {} - null psth'.format(unit_condition))
+            rows.append({**unit_condition, 'unit_psth': unit_psth})
+
+        self.insert(rows)
 
     @staticmethod
     def compute_psth(session_unit_spikes):
@@ -298,6 +712,20 @@ class UnitPsth(dj.Computed):
 
         return np.array([psth, edges[1:]])
 
+    @staticmethod
+    def compute_psths(spikes, row_units, row_trials, condition_trials):
+        """
+        compute_psth() of every unit x trial condition, from the per-trial spikes of all units
+        - binning all spikes at once (see BinnedSpikes), then summing the per-trial counts of each unit/condition
+        :param spikes: spike times of each (unit, trial) TrialSpikes row
+        :param row_units: unit (index) of each row
+        :param row_trials: trial of each row
+        :param condition_trials: {trial_condition_name: trials of the condition}
+        :return: {(unit, trial_condition_name): unit_psth} - for the unit/conditions with spikes rows
+        """
+        binned = BinnedSpikes.from_trial_spikes(spikes, list(row_units), row_trials)
+        return binned.psths(condition_trials)
+
     @classmethod
     def get_plotting_data(cls, unit_key, condition_key):
         """
@@ -363,75 +791,160 @@ class PeriodSelectivity(dj.Computed):
 
     alpha = 0.05  # default alpha value
 
-    key_source = experiment.Period * (ephys.Unit & ephys.ProbeInsertion.InsertionLocation & 'unit_quality != "all"')
+    # the (unit x period) to compute
+    unit_periods = experiment.Period * (ephys.Unit & ephys.ProbeInsertion.InsertionLocation & 'unit_quality != "all"')
+
+    @property
+    def key_source(self):
+        """
+        Probe insertions with (unit x period) not computed yet - e.g. of Periods added after the insertion was computed
+        """
+        return ephys.ProbeInsertion & (self.unit_periods.proj() - self)
 
     def make(self, key):
         '''
-        Compute Period Selectivity for a given unit.
+        Compute and insert the Period Selectivity of the (unit x period) not computed yet of the probe insertion
+        of "key": the TrialSpikes of the insertion and the trial events of the session are fetched once,
+        and all units x periods are tested at once
         '''
         log.debug('PeriodSelectivity.make(): key: {}'.format(key))
 
-        hemi = _get_units_hemisphere(key)
+        keys = ((self.unit_periods & key).proj() - self).fetch('KEY', order_by='KEY')
 
-        # retrieving the spikes of interest,
-        spikes_q = ((ephys.Unit.TrialSpikes & key)
-                    * (experiment.BehaviorTrial
-                       & {'task': 'audio delay',
-                          'early_lick': 'no early',
-                          'outcome': 'hit',
-                          'free_water': 0,
-                          'auto_water': 0})
+        log.info('PeriodSelectivity.make(): {} - {} units x periods'.format(key, len(keys)))
+
+        hemi = _get_units_hemisphere(key)
+        session_key = {k: key[k] for k in experiment.Session.primary_key}
+
+        # trials of interest
+        trials_q = ((experiment.BehaviorTrial & session_key
+                     & {'task': 'audio delay',
+                        'early_lick': 'no early',
+                        'outcome': 'hit',
+                        'free_water': 0,
+                        'auto_water': 0})
                     & (experiment.TrialEvent & 'trial_event_type = "delay"' & 'duration = 1.2')
                     - experiment.PhotostimEvent)
-
-        if not spikes_q:  # no spikes found
-            self.insert1({**key, 'period_selectivity': 'non-selective'})
-            return
-
-        # retrieving event times
-        start_event, start_tshift, end_event, end_tshift = (experiment.Period & key).fetch1(
-            'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
-        start_event_q = {k['trial']: float(k['start_event_time'])
-                         for k in (experiment.TrialEvent & key & {'trial_event_type': start_event}).proj(
-            start_event_time=f'trial_event_time + {start_tshift}').fetch(as_dict=True)}
-        end_event_q = {k['trial']: float(k['end_event_time'])
-                       for k in (experiment.TrialEvent & key & {'trial_event_type': end_event}).proj(
-            end_event_time=f'trial_event_time + {end_tshift}').fetch(as_dict=True)}
-        cue_event_q = {k['trial']: float(k['trial_event_time'])
-                       for k in (experiment.TrialEvent & key & {'trial_event_type': 'go'}).fetch(as_dict=True)}
-
-        # compute spike rate during the period-of-interest for each trial
-        freq_i, freq_c = [], []
-        for trial, trial_instruct, spike_times in zip(*spikes_q.fetch('trial', 'trial_instruction', 'spike_times')):
-            start_time = start_event_q[trial] - cue_event_q[trial]
-            stop_time = end_event_q[trial] - cue_event_q[trial]
-            spk_rate = np.logical_and(spike_times >= start_time, spike_times < stop_time).sum() / (stop_time - start_time)
-            if hemi == trial_instruct:
-                freq_i.append(spk_rate)
+        trials, trial_instructs = trials_q.fetch('trial', 'trial_instruction', order_by='trial')
+
+        # period boundaries of each trial, relative to the go-cue
+        periods = sorted(set(k['period'] for k in keys))
+        period_events = (experiment.Period & [{'period': p} for p in periods]).fetch(
+            'period', 'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift', as_dict=True)
+        period_events = {p['period']: p for p in period_events}
+
+        event_times = {}  # {(trial, trial_event_type): trial_event_time} - the last event of each type
+        for trial, event_type, event_time in zip(*(experiment.TrialEvent & session_key).fetch(
+                'trial', 'trial_event_type', 'trial_event_time', order_by='trial, trial_event_id')):
+            event_times[(trial, event_type)] = event_time
+
+        period_starts = np.full((len(trials), len(periods)), np.nan)
+        period_stops = np.full((len(trials), len(periods)), np.nan)
+        for i, trial in enumerate(trials):
+            if (trial, 'go') not in event_times:
+                continue
+            cue_time = float(event_times[(trial, 'go')])
+            for j, period in enumerate(periods):
+                start_event, end_event = (period_events[period]['start_event_type'],
+                                          period_events[period]['end_event_type'])
+                if (trial, start_event) in event_times and (trial, end_event) in event_times:
+                    # shifted as the "trial_event_time + time_shift" (decimal) SQL projection
+                    period_starts[i, j] = float(event_times[(trial, start_event)] + decimal.Decimal(
+                        str(period_events[period]['start_time_shift']))) - cue_time
+                    period_stops[i, j] = float(event_times[(trial, end_event)] + decimal.Decimal(
+                        str(period_events[period]['end_time_shift']))) - cue_time
+
+        complete = ~np.isnan(period_starts).any(axis=1) & ~np.isnan(period_stops).any(axis=1)
+        if not complete.all():
+            log.warning('{} trial(s) without all the period events - skipped: {}'.format(
+                (~complete).sum(), trials[~complete]))
+        trials, trial_instructs = trials[complete], trial_instructs[complete]
+        period_starts, period_stops = period_starts[complete], period_stops[complete]
+
+        # fetch related spike times, of all units at once
+        unit_ids = sorted(set((k['clustering_method'], k['unit']) for k in keys))
+        unit_idx = {u: i for i, u in enumerate(unit_ids)}
+        trial_idx = {t: i for i, t in enumerate(trials)}
+
+        methods, unit_nos, spike_trials, spikes = (
+            ephys.Unit.TrialSpikes & (ephys.Unit & key & 'unit_quality != "all"')
+            & trials_q.proj()).fetch('clustering_method', 'unit', 'trial', 'spike_times')
+
+        rows = [i for i, u in enumerate(zip(methods, unit_nos)) if u in unit_idx and spike_trials[i] in trial_idx]
+        row_units = np.array([unit_idx[(methods[i], unit_nos[i])] for i in rows], dtype=int)
+        row_trials = np.array([trial_idx[spike_trials[i]] for i in rows], dtype=int)
+
+        # compute selectivity & store
+        p_values, ipsi_rates, contra_rates, selectivity = self.compute_selectivity(
+            spikes[rows], row_units, row_trials, period_starts, period_stops,
+            trial_instructs == hemi, len(unit_ids), self.alpha)
+        has_spikes = np.bincount(row_units, minlength=len(unit_ids)) > 0
+
+        rows = []
+        for unit_period in keys:
+            u = unit_idx[(unit_period['clustering_method'], unit_period['unit'])]
+            p = periods.index(unit_period['period'])
+            if not has_spikes[u]:  # no spikes found
+                rows.append({**unit_period, 'period_selectivity': 'non-selective'})
             else:
-                freq_c.append(spk_rate)
-
-        # and testing for selectivity.
-        t_stat, pval = sc_stats.ttest_ind(freq_i, freq_c, equal_var=True)
-        # try:
-        #     _stat, pval = sc_stats.mannwhitneyu(freq_i, freq_c)
-        # except ValueError:
-        #     pval = np.nan
+                rows.append({**unit_period, 'p_value': p_values[u, p],
+                             'period_selectivity': selectivity[u, p],
+                             'ipsi_firing_rate': ipsi_rates[u, p],
+                             'contra_firing_rate': contra_rates[u, p]})
 
-        freq_i_m = np.average(freq_i)
-        freq_c_m = np.average(freq_c)
-
-        pval = 1 if np.isnan(pval) else pval
-        if pval > self.alpha:
-            pref = 'non-selective'
-        else:
-            pref = ('ipsi-selective' if freq_i_m > freq_c_m
-                    else 'contra-selective')
+        self.insert(rows)
 
-        self.insert1({**key, 'p_value': pval,
-                      'period_selectivity': pref,
-                      'ipsi_firing_rate': freq_i_m,
-                      'contra_firing_rate': freq_c_m})
+    @staticmethod
+    def compute_selectivity(spikes, row_units, row_trials, period_starts, period_stops, ipsi, n_units,
+                            alpha=0.05):
+        '''
+        Selectivity of every unit x period, from the per-trial spikes of all units
+        - counting all spikes in all periods at once into a unit x trial x period firing rate tensor,
+        then t-testing all units x periods at once (ipsi vs contra trials)
+        :param spikes: spike times (relative to the go-cue) of each (unit, trial) TrialSpikes row
+        :param row_units: unit (index) of each row
+        :param row_trials: trial (index) of each row
+        :param period_starts, period_stops: (trial x period) period boundaries, relative to the go-cue
+        :param ipsi: (trial,) True for the ipsi trials
+        :param n_units: number of units
+        :return: (unit x period) arrays: p_value, ipsi_firing_rate, contra_firing_rate, period_selectivity
+        '''
+        n_trials, n_periods = period_starts.shape
+
+        lengths = np.array([len(s) for s in spikes], dtype=int)
+        spike_times = np.concatenate([np.asarray(s, dtype=float).ravel() for s in spikes] + [np.empty(0)])
+        spike_rows = np.repeat(np.arange(len(spikes)), lengths)
+
+        # spike counts of each row in each period - [start, stop): searchsorted over the spikes sorted by
+        # (row, spike time), as complex numbers row + 1j * spike time (complex are sorted lexicographically)
+        spike_keys = spike_rows + 1j * spike_times
+        if not ((np.diff(spike_times) >= 0) | (np.diff(spike_rows) > 0)).all():
+            spike_keys = spike_keys[np.lexsort((spike_times, spike_rows))]
+        rows = np.arange(len(spikes))[:, None]
+        counts = (np.searchsorted(spike_keys, rows + 1j * period_stops[row_trials])
+                  - np.searchsorted(spike_keys, rows + 1j * period_starts[row_trials]))
+
+        # unit x trial x period firing rates - NaN for the (unit, trial) without TrialSpikes
+        rates = np.full((n_units, n_trials, n_periods), np.nan)
+        rates[row_units, row_trials] = counts / (period_stops - period_starts)[row_trials]
+
+        # t-tests along the trials - omitting the missing trials of the units without all trials
+        p_values = np.full((n_units, n_periods), np.nan)
+        all_trials = ~np.isnan(rates).any(axis=(1, 2))
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for units, nan_policy in ((all_trials, 'propagate'), (~all_trials, 'omit')):
+                if units.any():
+                    p_values[units] = sc_stats.ttest_ind(rates[units][:, ipsi], rates[units][:, ~ipsi], axis=1,
+                                                         equal_var=True, nan_policy=nan_policy).pvalue
+            ipsi_rates = np.nanmean(rates[:, ipsi], axis=1)
+            contra_rates = np.nanmean(rates[:, ~ipsi], axis=1)
+
+        p_values = np.where(np.isnan(p_values), 1, p_values)
+        selectivity = np.where(p_values > alpha, 'non-selective',
+                               np.where(ipsi_rates > contra_rates, 'ipsi-selective', 'contra-selective'))
+
+        return p_values, ipsi_rates, contra_rates, selectivity.astype(object)
 
 
 @schema
@@ -448,33 +961,48 @@ class UnitSelectivity(dj.Computed):
 
     # Unit Selectivity is computed only for units
     # that has PeriodSelectivity computed for "sample" and "delay" and "response"
-    key_source = (ephys.Unit
-                  & (PeriodSelectivity & 'period = "sample"')
-                  & (PeriodSelectivity & 'period = "delay"')
-                  & (PeriodSelectivity & 'period = "response"'))
+    unit_source = (ephys.Unit
+                   & (PeriodSelectivity & 'period = "sample"')
+                   & (PeriodSelectivity & 'period = "delay"')
+                   & (PeriodSelectivity & 'period = "response"'))
+
+    @property
+    def key_source(self):
+        """ Probe insertions with units of unit_source not computed yet """
+        return ephys.ProbeInsertion & (self.unit_source - self)
 
     def make(self, key):
         '''
-        calculate 'global' selectivity for a unit -
+        calculate 'global' selectivity for the units of the probe insertion of "key" not computed yet -
+        from the PeriodSelectivity of the insertion, fetched once
         '''
         log.debug('UnitSelectivity.make(): key: {}'.format(key))
 
+        keys = ((self.unit_source & key) - self).fetch('KEY', order_by='KEY')
+
         # fetch region selectivity,
-        sels = (PeriodSelectivity & key).fetch('period_selectivity')
+        period_sels = pd.DataFrame((PeriodSelectivity & key).fetch(
+            'clustering_method', 'unit', 'period', 'period_selectivity',
+            'contra_firing_rate', 'ipsi_firing_rate', as_dict=True))
+        period_sels = dict(list(period_sels.groupby(['clustering_method', 'unit'])))
 
-        if (sels == 'non-selective').all():
-            log.debug('... no UnitSelectivity for unit')
-            self.insert1({**key, 'unit_selectivity': 'non-selective'})
-            return
+        rows = []
+        for unit in keys:
+            sels = period_sels[(unit['clustering_method'], unit['unit'])]
 
-        contra_frate, ipsi_frate = (PeriodSelectivity & key & 'period in ("sample", "delay", "response")').fetch(
-            'contra_firing_rate', 'ipsi_firing_rate')
+            if (sels['period_selectivity'] == 'non-selective').all():
+                log.debug('... no UnitSelectivity for unit')
+                rows.append({**unit, 'unit_selectivity': 'non-selective'})
+                continue
 
-        pref = ('ipsi-selective' if ipsi_frate.mean() > contra_frate.mean() else 'contra-selective')
+            sels = sels[sels['period'].isin(['sample', 'delay', 'response'])]
+            pref = ('ipsi-selective' if sels['ipsi_firing_rate'].to_numpy().mean()
+                    > sels['contra_firing_rate'].to_numpy().mean() else 'contra-selective')
 
-        log.debug('... prefers: {}'.format(pref))
+            log.debug('... prefers: {}'.format(pref))
+            rows.append({**unit, 'unit_selectivity': pref})
 
-        self.insert1({**key, 'unit_selectivity': pref})
+        self.insert(rows)
 
 
 def compute_unit_psth(unit_key, trial_keys, per_trial=False):
@@ -484,23 +1012,11 @@ def compute_unit_psth(unit_key, trial_keys, per_trial=False):
     :param unit_key: key of a single unit to compute the PSTH for
     :param trial_keys: list of all the trial keys to compute the PSTH over
     """
-    q = (ephys.Unit.TrialSpikes & unit_key & trial_keys)
-    if not q:
-        return None
-
-    xmin, xmax, bin_size = UnitPsth.psth_params.values()
-    binning = np.arange(xmin, xmax, bin_size)
-
-    spikes = q.fetch('spike_times')
-
-    if per_trial:
-        trial_psth = np.vstack(np.histogram(spike, bins=binning)[0] / bin_size for spike in spikes)
-        return trial_psth, binning[1:]
-    else:
-        spikes = np.concatenate(spikes)
-        psth, edges = np.histogram(spikes, bins=binning)
-        psth = psth / len(q) / bin_size
-        return psth, edges[1:]
+    # only the spikes of the unit are fetched and binned - not those of its whole insertion
+    unit = (unit_key['clustering_method'], unit_key['unit'])
+    spikes, trials = (ephys.Unit.TrialSpikes & unit_key & trial_keys).fetch('spike_times', 'trial')
+    binned = BinnedSpikes.from_trial_spikes(spikes, [unit] * len(spikes), trials)
+    return binned.psth(unit, per_trial=per_trial)
 
 
 def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
@@ -512,22 +1028,50 @@ def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
     :param ipsi_psths: unit# x (trial-ave psth, psth_edge)
     :param time_period: (time_from, time_to) in seconds, relative to go-cue
     """
+    contra_rates, contra_edges = (np.array(x, dtype=float) for x in zip(*contra_psths))
+    ipsi_rates, ipsi_edges = (np.array(x, dtype=float) for x in zip(*ipsi_psths))
+
     if not time_period:
-        contra_tmin, contra_tmax = zip(*((k[1].min(), k[1].max()) for k in contra_psths))
-        ipsi_tmin, ipsi_tmax = zip(*((k[1].min(), k[1].max()) for k in ipsi_psths))
-        time_period = max(min(contra_tmin), min(ipsi_tmin)), min(max(contra_tmax), max(ipsi_tmax))
+        time_period = (max(contra_edges.min(), ipsi_edges.min()), min(contra_edges.max(), ipsi_edges.max()))
 
     p_start, p_end = time_period
 
-    contra_ave_spk_rate = np.array([spk_rate[np.logical_and(spk_edge >= p_start, spk_edge < p_end)].mean()
-                                    for spk_rate, spk_edge in contra_psths])
-    ipsi_ave_spk_rate = np.array([spk_rate[np.logical_and(spk_edge >= p_start, spk_edge < p_end)].mean()
-                                  for spk_rate, spk_edge in ipsi_psths])
+    def period_mean(rates, edges):  # unit# mean rate over the psth bins in the time period
+        in_period = np.logical_and(edges >= p_start, edges < p_end)
+        return np.where(in_period, rates, 0).sum(axis=1) / in_period.sum(axis=1)
 
-    cd_vec = contra_ave_spk_rate - ipsi_ave_spk_rate
+    cd_vec = period_mean(contra_rates, contra_edges) - period_mean(ipsi_rates, ipsi_edges)
     return cd_vec / np.linalg.norm(cd_vec)
 
 
+def compute_CD_projections(contra_trial_psths, ipsi_trial_psths, time_stamps, time_period=None):
+    """
+    Coding direction of the units and the per-trial projections of their psths on it,
+    as matrix products over all units and trials
+    :param contra_trial_psths: (unit# x trial# x time) contra-trials psths
+    :param ipsi_trial_psths: (unit# x trial# x time) ipsi-trials psths
+    :param time_stamps: psth time-stamps (time,)
+    :param time_period: (time_from, time_to) in seconds, relative to go-cue
+    :return: coding direction unit-vector, contra-trials (trial# x time) and ipsi-trials (trial# x time)
+             CD projected trial-psth
+    """
+    contra_trial_psths = np.asarray(contra_trial_psths, dtype=float)
+    ipsi_trial_psths = np.asarray(ipsi_trial_psths, dtype=float)
+
+    # trial-ave unit psth - unit# x time
+    contra_psths = contra_trial_psths.mean(axis=1)
+    ipsi_psths = ipsi_trial_psths.mean(axis=1)
+
+    cd_vec = compute_coding_direction(zip(contra_psths, repeat(time_stamps)),
+                                      zip(ipsi_psths, repeat(time_stamps)), time_period=time_period)
+
+    # coding projection per trial - trial# x time
+    proj_contra_trial = np.tensordot(cd_vec, contra_trial_psths, axes=(0, 0))
+    proj_ipsi_trial = np.tensordot(cd_vec, ipsi_trial_psths, axes=(0, 0))
+
+    return cd_vec, proj_contra_trial, proj_ipsi_trial
+
+
 def compute_CD_projected_psth(units, time_period=None):
     """
     Routine for Coding Direction computation on all the units in the specified unit_keys
@@ -546,36 +1090,44 @@ def compute_CD_projected_psth(units, time_period=None):
         raise Exception('Units from multiple sessions found')
 
     # -- the computation part
-    # get units and trials - ensuring they have trial-spikes
-    contra_trials = (TrialCondition().get_trials(
-        'good_noearlylick_right_hit' if unit_hemi == 'left' else 'good_noearlylick_left_hit')
-                     & session_key & ephys.Unit.TrialSpikes).fetch('KEY')
-    ipsi_trials = (TrialCondition().get_trials(
-        'good_noearlylick_left_hit' if unit_hemi == 'left' else 'good_noearlylick_right_hit')
-                     & session_key & ephys.Unit.TrialSpikes).fetch('KEY')
-
-    # get per-trial unit psth for all units - unit# x (trial# x time)
-    contra_trial_psths, contra_edges = zip(*(compute_unit_psth(unit, contra_trials, per_trial=True)
-                                             for unit in units))
-    ipsi_trial_psths, ipsi_edges = zip(*(compute_unit_psth(unit, ipsi_trials, per_trial=True)
-                                         for unit in units))
-
-    # compute trial-ave unit psth
-    contra_psths = zip((p.mean(axis=0) for p in contra_trial_psths), contra_edges)
-    ipsi_psths = zip((p.mean(axis=0) for p in ipsi_trial_psths), ipsi_edges)
-
-    # compute coding direction
-    cd_vec = compute_coding_direction(contra_psths, ipsi_psths, time_period=time_period)
-
-    # get time vector, relying on all units PSTH shares the same time vector
-    time_stamps = contra_edges[0]
-
-    # get coding projection per trial - trial# x unit# x time
-    contra_psth_per_trial = np.dstack(contra_trial_psths)
-    ipsi_psth_per_trial = np.dstack(ipsi_trial_psths)
-
-    proj_contra_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in contra_psth_per_trial)  # trial# x time
-    proj_ipsi_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in ipsi_psth_per_trial)    # trial# x time
+    # get units and trials - ensuring all units have trial-spikes in all trials
+    session_key = session_key.fetch1('KEY')
+    units = units.fetch('KEY') if isinstance(units, dj.expression.QueryExpression) else list(units)
+    insertions = [tuple(unit[k] for k in ephys.ProbeInsertion.primary_key) for unit in units]
+
+    # binned spikes of the units of each insertion
+    binned_units = []
+    for insertion in sorted(set(insertions)):
+        unit_pos = [i for i, u in enumerate(insertions) if u == insertion]
+        binned_units.append((get_binned_spikes(dict(zip(ephys.ProbeInsertion.primary_key, insertion))), unit_pos,
+                             [(units[i]['clustering_method'], units[i]['unit']) for i in unit_pos]))
+
+    spike_trials = None
+    for binned, _, unit_ids in binned_units:
+        trials = binned.common_trials(unit_ids)
+        spike_trials = trials if spike_trials is None else np.intersect1d(spike_trials, trials)
+
+    contra_cond, ipsi_cond = (('good_noearlylick_right_hit', 'good_noearlylick_left_hit') if unit_hemi == 'left'
+                              else ('good_noearlylick_left_hit', 'good_noearlylick_right_hit'))
+    condition_trials = TrialCondition.get_session_condition_trials(session_key, [contra_cond, ipsi_cond])
+    contra_trials = [t for t in condition_trials[contra_cond] if t in spike_trials]
+    ipsi_trials = [t for t in condition_trials[ipsi_cond] if t in spike_trials]
+    if not contra_trials or not ipsi_trials:
+        raise Exception('No contra/ipsi trials with trial-spikes for all units')
+
+    # get per-trial unit psth for all units - unit# x trial# x time
+    xmin, xmax, bin_size = UnitPsth.psth_params.values()
+    time_stamps = np.arange(xmin, xmax, bin_size)[1:]
+    contra_trial_psths = np.empty((len(units), len(contra_trials), len(time_stamps)))
+    ipsi_trial_psths = np.empty((len(units), len(ipsi_trials), len(time_stamps)))
+
+    for binned, unit_pos, unit_ids in binned_units:
+        contra_trial_psths[unit_pos] = binned.trial_rates(unit_ids, contra_trials)
+        ipsi_trial_psths[unit_pos] = binned.trial_rates(unit_ids, ipsi_trials)
+
+    # compute coding direction and the CD projected trial-psth
+    cd_vec, proj_contra_trial, proj_ipsi_trial = compute_CD_projections(
+        contra_trial_psths, ipsi_trial_psths, time_stamps, time_period=time_period)
 
     return cd_vec, proj_contra_trial, proj_ipsi_trial, time_stamps, unit_hemi
 
@@ -209,6 +209,12 @@ def load_insertion_location(excel_fp, sheet_name='Sheet1'):
 def load_ccf(*args):
     ccf.CCFBrainRegion.load_regions()
     ccf.CCFAnnotation.load_ccf_annotation()
+    build_ccf_volume()
+
+
+def build_ccf_volume(*args):
+    ''' (re)build the local annotation volume cache of the annotation version (default: configured version) '''
+    ccf.get_annotation_volume(*args[:1], refresh=True)
 
 
 def load_meta_foraging():  
@@ -571,6 +577,7 @@ actions = {
     'shell': (shell, 'interactive shell'),
     'erd': (erd, 'write DataJoint ERDs to files'),
     'load-ccf': (load_ccf, 'load CCF reference atlas'),
+    'build-ccf-volume': (build_ccf_volume, 'build local CCF annotation volume cache'),
     'automate-computation': (automate_computation, 'run report worker job'),
     'automate-sync-and-cleanup': (sync_and_external_cleanup,
                                   'run report cleanup job'),
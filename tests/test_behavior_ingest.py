@@ -0,0 +1,460 @@
+import os
+import time
+import json
+import decimal
+import logging
+import pathlib
+import tempfile
+from datetime import date, datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.io as spio
+
+from pipeline.ingest import behavior as behavior_ingest
+from pipeline.ingest import util as ingest_util
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+state_names = ['TrigTrialStart', 'PreSamplePeriod', 'SamplePeriod', 'DelayPeriod',
+               'EarlyLickDelay', 'ResponseCue', 'Reward', 'TimeOut', 'NoResponse',
+               'StopLicking', 'TrialEnd']
+
+
+def make_mock_delay_response_matfile(fpath, n_trials=50, seed=0, padding=True):
+    ''' minimal delay-response .mat behavior file (padded to pass the 1000 KB size filter) '''
+    rng = np.random.RandomState(seed)
+
+    trial_settings, state_data, state_times, event_data, event_times, raw_events = [], [], [], [], [], []
+    for _ in range(n_trials):
+        gui = {'ProtocolType': rng.choice([3, 4, 5, 5, 5]), 'Reversal': rng.choice([1, 2]),
+               'Autolearn': rng.choice([1, 4, 4]), 'Autowater': rng.choice([1, 2]),
+               'randomID': rng.randint(1, 2 ** 20)}
+        trial_settings.append({'GUI': gui, 'GaveFreeReward': rng.choice([0, 1], 3, p=[0.9, 0.1]).astype(float)})
+
+        outcome = rng.choice(['Reward', 'TimeOut', 'NoResponse'])
+        states = ['TrigTrialStart', 'PreSamplePeriod', 'SamplePeriod', 'DelayPeriod',
+                  'ResponseCue', outcome, 'StopLicking', 'TrialEnd']
+        delay = rng.choice([1.2, 1.2, 2.0])
+        onsets = np.array([0, 0.125, 0.25, 0.75, 0.75 + delay, 0.85 + delay, 1.85 + delay, 2.85 + delay, 2.9 + delay])
+        state_data.append(np.array([state_names.index(s) + 1 for s in states], dtype=float))
+        state_times.append(onsets.astype(float))
+        raw_events.append({'States': {s: np.array([onsets[i], onsets[i + 1]]) for i, s in enumerate(states)}})
+
+        n_licks = rng.randint(2, 10)
+        event_data.append(rng.choice([69, 70, 71, 72], n_licks).astype(float))
+        event_times.append(np.sort(rng.rand(n_licks) * onsets[-1]))
+
+    session_data = {
+        'Info': {'SessionDate': '04-Jan-2018', 'SessionStartTime_UTC': '13:28:13'},
+        'SettingsFile': {'GUI': {'SamplePeriod': 1.3, 'DelayPeriod': 1.2, 'ProtocolType': 5}},
+        'TrialTypes': rng.choice([0, 1], n_trials).astype(float),
+        'StimTrials': rng.choice([0, 4, 5, 6], n_trials).astype(float),
+        'TrialSettings': np.array(trial_settings, dtype=object),
+        'TrialStartTimestamp': np.cumsum(rng.rand(n_trials) * 5 + 5),
+        'RawData': {
+            'OriginalStateNamesByNumber': np.array([np.array(state_names, dtype=object)
+                                                    for _ in range(n_trials)] + [None], dtype=object)[:-1],
+            'OriginalStateData': np.array(state_data + [None], dtype=object)[:-1],
+            'OriginalEventData': np.array(event_data + [None], dtype=object)[:-1],
+            'OriginalStateTimestamps': np.array(state_times + [None], dtype=object)[:-1],
+            'OriginalEventTimestamps': np.array(event_times + [None], dtype=object)[:-1]},
+        'RawEvents': {'Trial': np.array(raw_events, dtype=object)}}
+
+    mat = {'SessionData': session_data}
+    if padding:
+        mat['padding'] = rng.rand(140000)
+    spio.savemat(fpath, mat)
+    return pathlib.Path(fpath)
+
+
+def make_session_key(seed=0):
+    return {'subject_id': 1000 + seed, 'session_date': date(2018, 1, 4),
+            'username': 'mock', 'rig': 'RRig', 'h2o': 'dl{}'.format(seed)}
+
+
+def load_behavior_file(skey, path):
+    ''' the per-file parsing of BehaviorIngest.make() - loading the .mat file twice '''
+    task_type = behavior_ingest.detect_task_type(path)
+    assert task_type == 'delay-response'
+    return behavior_ingest.load_delay_response_matfile(skey, path)
+
+
+def make_mock_bpod_csv(fpath, n_trials=60, seed=0, start_time=datetime(2019, 9, 5, 10, 0, 0)):
+    ''' minimal pybpod session csv of a 2 lick ports foraging task '''
+    rng = np.random.RandomState(seed)
+
+    csv_rows = []
+    t = start_time
+
+    def row(row_type, msg, info='', dt=0.01):
+        nonlocal t
+        t += timedelta(seconds=dt)
+        csv_rows.append(';'.join((row_type, t.strftime('%Y-%m-%d %H:%M:%S.%f'), '', '', str(msg), str(info))))
+
+    variables = {'reward_probabilities_L': [0.1, 0.5, 0.5, 0.9], 'reward_probabilities_R': [0.9, 0.5, 0.5, 0.1],
+                 'WaterPort_L_ch_in': 'Port1In', 'WaterPort_R_ch_in': 'Port2In',
+                 'ValveOpenTime_L': 0.05, 'ValveOpenTime_R': 0.05, 'lickport_number': 2}
+    motors = {'LickPort_Lateral_pos': 5000, 'LickPort_RostroCaudal_pos': 1000, 'LickPort_DorsoVentral_pos': 200}
+
+    row('INFO', 'CREATOR-NAME', '["mock-user"]')
+    row('INFO', 'SUBJECT-NAME', "['dl{}', 'b6a1fc1e']".format(seed))
+    row('stdout', 'Random seed:')
+    row('stdout', rng.randint(1e6))
+    row('stdout', 'Variables:')
+    row('stdout', repr(variables))
+    row('stdout', 'LickportMotors:')
+    row('stdout', repr(motors))
+
+    block = 1
+    for trial in range(n_trials):
+        row('TRIAL', 'New trial', dt=rng.rand() * 3)
+        row('stdout', 'Trialnumber:')
+        row('stdout', trial + 1)
+        if rng.rand() < 0.8:  # not all trials log their block number
+            block = min(block + (rng.rand() < 0.15), 4)
+            row('stdout', 'Blocknumber:')
+            row('stdout', block)
+        for port in ('L', 'R'):
+            row('stdout', 'reward_{}_accumulated:'.format(port))
+            row('stdout', rng.rand() < 0.3)
+        if trial and rng.rand() < 0.1:
+            variables['ValveOpenTime_L'] = round(rng.rand() * 0.1, 3)
+            row('stdout', 'Variables updated:')
+            row('stdout', repr(variables))
+        if rng.rand() < 0.2:
+            row('STATE', 'Auto_Water_{}'.format(rng.choice(['L', 'R'])), rng.choice([0, 0.05]))
+
+        for _ in range(rng.randint(3)):  # early licks
+            row('EVENT', 68, rng.choice(['Port1In', 'Port2In']), dt=rng.rand() * 0.5)
+        if rng.rand() < 0.9:  # trials without GoCue are skipped
+            row('TRANSITION', 'GoCue')
+        choice = rng.choice(['L', 'R', None])
+        for _ in range(rng.randint(5)):
+            row('EVENT', 68, {'L': 'Port1In', 'R': 'Port2In', None: rng.choice(['Port1In', 'Port2In'])}[choice],
+                dt=rng.rand() * 0.5)
+        if choice:
+            row('TRANSITION', 'Choice_{}'.format(choice))
+            if rng.rand() < 0.5:
+                row('TRANSITION', 'Reward_{}'.format(choice))
+        row('TRANSITION', 'End')
+
+    return write_bpod_csv(fpath, '\n'.join(csv_rows) + '\n')
+
+
+def write_bpod_csv(fpath, csv_rows):
+    ''' pybpod session csv of the "csv_rows" (text) - after the header lines '''
+    with open(fpath, 'w') as f:
+        f.write('\n' * 6)
+        f.write(';'.join(('TYPE', 'PC-TIME', 'BPOD-INITIAL-TIME', 'BPOD-FINAL-TIME', 'MSG', '+INFO')) + '\n')
+        f.write(csv_rows)
+
+    return pathlib.Path(fpath)
+
+
+# 3 trials of a 2 lick ports foraging session: a hit (with autowater), an ignore (with an early lick,
+# a new block and a variable update) and a trial without GoCue - its start time missing the microseconds
+bpod_csv_fixture = '''\
+INFO;2019-09-05 10:00:00.000000;;;CREATOR-NAME;["mock-user"]
+INFO;2019-09-05 10:00:00.010000;;;SUBJECT-NAME;['dl0', 'b6a1fc1e']
+stdout;2019-09-05 10:00:00.020000;;;Random seed:;
+stdout;2019-09-05 10:00:00.030000;;;1234;
+stdout;2019-09-05 10:00:00.040000;;;Variables:;
+stdout;2019-09-05 10:00:00.050000;;;{'reward_probabilities_L': [0.1, 0.5], 'reward_probabilities_R': [0.9, 0.5], 'WaterPort_L_ch_in': 'Port1In', 'WaterPort_R_ch_in': 'Port2In', 'ValveOpenTime_L': 0.05, 'ValveOpenTime_R': 0.05, 'lickport_number': 2};
+stdout;2019-09-05 10:00:00.060000;;;LickportMotors:;
+stdout;2019-09-05 10:00:00.070000;;;{'LickPort_Lateral_pos': 5000, 'LickPort_RostroCaudal_pos': 1000, 'LickPort_DorsoVentral_pos': 200};
+TRIAL;2019-09-05 10:00:01.000000;;;New trial;
+stdout;2019-09-05 10:00:01.010000;;;Trialnumber:;
+stdout;2019-09-05 10:00:01.020000;;;1;
+stdout;2019-09-05 10:00:01.030000;;;Blocknumber:;
+stdout;2019-09-05 10:00:01.040000;;;1;
+stdout;2019-09-05 10:00:01.050000;;;reward_L_accumulated:;
+stdout;2019-09-05 10:00:01.060000;;;False;
+stdout;2019-09-05 10:00:01.070000;;;reward_R_accumulated:;
+stdout;2019-09-05 10:00:01.080000;;;False;
+STATE;2019-09-05 10:00:01.090000;;;Auto_Water_L;0.05
+TRANSITION;2019-09-05 10:00:01.500000;;;GoCue;
+EVENT;2019-09-05 10:00:01.750000;;;68;Port1In
+TRANSITION;2019-09-05 10:00:01.760000;;;Choice_L;
+TRANSITION;2019-09-05 10:00:01.770000;;;Reward_L;
+TRANSITION;2019-09-05 10:00:01.800000;;;End;
+TRIAL;2019-09-05 10:00:03.000000;;;New trial;
+stdout;2019-09-05 10:00:03.010000;;;Trialnumber:;
+stdout;2019-09-05 10:00:03.020000;;;2;
+stdout;2019-09-05 10:00:03.030000;;;Blocknumber:;
+stdout;2019-09-05 10:00:03.040000;;;2;
+stdout;2019-09-05 10:00:03.050000;;;reward_L_accumulated:;
+stdout;2019-09-05 10:00:03.060000;;;True;
+stdout;2019-09-05 10:00:03.070000;;;reward_R_accumulated:;
+stdout;2019-09-05 10:00:03.080000;;;False;
+stdout;2019-09-05 10:00:03.090000;;;Variables updated:;
+stdout;2019-09-05 10:00:03.100000;;;{'reward_probabilities_L': [0.1, 0.5], 'reward_probabilities_R': [0.9, 0.5], 'WaterPort_L_ch_in': 'Port1In', 'WaterPort_R_ch_in': 'Port2In', 'ValveOpenTime_L': 0.02, 'ValveOpenTime_R': 0.05, 'lickport_number': 2};
+EVENT;2019-09-05 10:00:03.200000;;;68;Port2In
+TRANSITION;2019-09-05 10:00:03.500000;;;GoCue;
+EVENT;2019-09-05 10:00:03.700000;;;68;Port2In
+TRANSITION;2019-09-05 10:00:05.000000;;;End;
+TRIAL;2019-09-05 10:00:06;;;New trial;
+stdout;2019-09-05 10:00:06.010000;;;Trialnumber:;
+stdout;2019-09-05 10:00:06.020000;;;3;
+stdout;2019-09-05 10:00:06.030000;;;reward_L_accumulated:;
+stdout;2019-09-05 10:00:06.040000;;;True;
+stdout;2019-09-05 10:00:06.050000;;;reward_R_accumulated:;
+stdout;2019-09-05 10:00:06.060000;;;True;
+TRANSITION;2019-09-05 10:00:06.500000;;;End;
+'''
+
+# the parse_bpod_session_trials() rows of bpod_csv_fixture: {table: (attributes, rows)}
+bpod_fixture_trials = {
+    'sess_trial': (('trial', 'start_time', 'stop_time'), [(1, 0.0, 3.0), (2, 3.0, 6.0)]),
+    'behavior_trial': (('trial', 'task', 'task_protocol', 'trial_instruction', 'early_lick', 'outcome',
+                        'auto_water', 'free_water'),
+                       [(1, 'foraging', 100, 'none', 'no early', 'hit', True, False),
+                        (2, 'foraging', 100, 'none', 'early', 'ignore', False, False)]),
+    'trial_note': (('trial', 'trial_note_type', 'trial_note'),
+                   [(1, 'autowater', 'left'), (1, 'random_seed_start', '1234')]),
+    'sess_block': (('block', 'block_start_time', 'reward_probability'),
+                   [(1, 0.0, {'left': decimal.Decimal('0.100'), 'right': decimal.Decimal('0.900')}),
+                    (2, 3.0, {'left': decimal.Decimal('0.500'), 'right': decimal.Decimal('0.500')})]),
+    'sess_block_trial': (('trial', 'block'), [(1, 1), (2, 2)]),
+    'trial_choice': (('trial', 'water_port'), [(1, 'left'), (2, None)]),
+    'trial_event': (('trial', 'trial_event_id', 'trial_event_type', 'trial_event_time', 'duration'),
+                    [(1, 0, 'go', 1.5, 0), (2, 0, 'go', 0.5, 0)]),
+    'action_event': (('trial', 'action_event_id', 'action_event_type', 'action_event_time'),
+                     [(1, 0, 'left lick', 1.75), (2, 0, 'right lick', 0.2), (2, 1, 'right lick', 0.7)]),
+    'photostim': ((), []),
+    'photostim_location': ((), []),
+    'photostim_trial': ((), []),
+    'photostim_trial_event': ((), []),
+    'valve_setting': (('trial', 'water_port_lateral_pos', 'water_port_rostrocaudal_pos',
+                       'water_port_dorsoventral_pos'), [(1, 5000, 1000, 200), (2, 5000, 1000, 200)]),
+    'valve_open_dur': (('trial', 'water_port', 'open_duration'),
+                       [(1, 'left', 0.05), (1, 'right', 0.05), (2, 'left', 0.05), (2, 'right', 0.05)]),
+    'available_reward': (('trial', 'water_port', 'reward_available'),
+                         [(1, 'left', False), (1, 'right', False), (2, 'left', True), (2, 'right', False)])}
+
+
+def make_mock_bpod_projects(root, n_projects=2, n_experiments=2, n_setups=2, n_subjects=50, n_days=5):
+    ''' BPod project tree: <project>/experiments/<experiment>/setups/<setup>/sessions/<session>/session.json '''
+    project_paths = []
+    for project_no in range(n_projects):
+        project_path = pathlib.Path(root, 'project{}'.format(project_no))
+        for experiment_no in range(n_experiments):
+            for setup_no in range(n_setups):
+                sessions_dir = pathlib.Path(project_path, 'experiments', 'foraging{}'.format(experiment_no),
+                                            'setups', 'tower-{}'.format(setup_no), 'sessions')
+                for subject_no in range(project_no * 1000 + experiment_no * 100 + setup_no,
+                                        project_no * 1000 + n_subjects * n_setups * n_experiments, n_setups):
+                    for day in range(n_days):
+                        add_mock_bpod_session(sessions_dir, 'dl{}'.format(subject_no),
+                                              datetime(2020, 1, 1 + day, 10, subject_no % 60))
+        project_paths.append(project_path)
+    return project_paths
+
+
+def add_mock_bpod_session(sessions_dir, subject, started):
+    session_dir = pathlib.Path(sessions_dir, '{}-{}'.format(started.strftime('%Y%m%d-%H%M%S'), subject))
+    session_dir.mkdir(parents=True)
+    with open(session_dir / 'session.json', 'w') as f:
+        json.dump({'subjects': ["['{}', 'b6a1fc1e']".format(subject)], 'started': started.isoformat()}, f)
+
+
+def load_mock_bpod_project_sessions(project_path):
+    ''' load_bpod_project_sessions() of a mock BPod project '''
+    sessions = []
+    for session_json in sorted(pathlib.Path(project_path).glob('experiments/*/setups/*/sessions/*/session.json')):
+        with open(session_json) as f:
+            session = json.load(f)
+        session_dir = session_json.parent
+        sessions.append(behavior_ingest.BPodSession(
+            session_dir.as_posix(), session_dir.name, session['subjects'],
+            datetime.fromisoformat(session['started']), session_dir.parents[1].name,
+            session_dir.parents[3].name))
+    return sessions
+
+
+def find_bpod_sessions(projects, subject, date_str):
+    ''' the per-key walk of the BPod projects in BehaviorBpodIngest.make() '''
+    return [session for sessions in projects for session in sessions
+            if session.subjects and session.subjects[0].find(subject) > -1 and session.name.startswith(date_str)]
+
+
+#
+# Actual Tests
+#
+
+def test_parallel_behavior_parsing():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = {seed: make_mock_delay_response_matfile(
+            pathlib.Path(tmpdir, 'dl{}_TW_autoTrain_20180104_132813.mat'.format(seed)), seed=seed)
+            for seed in range(4)}
+
+        serial = [load_behavior_file(make_session_key(seed), f) for seed, f in files.items()]
+
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(behavior_ingest.parse_behavior_file, make_session_key(seed), f)
+                       for seed, f in files.items()]
+            parallel = [future.result() for future in futures]
+
+    assert any(len(rows['photostim_trial_event']) for rows in serial)
+
+    for serial_rows, (task_type, skey, parallel_rows) in zip(serial, parallel):
+        assert task_type == 'delay-response'
+        assert 'h2o' not in skey and skey['session_time'].isoformat() == '13:28:13'
+        for tbl in ('trial', 'behavior_trial', 'trial_note', 'trial_event', 'action_event',
+                    'photostim_trial', 'photostim_trial_event'):
+            assert len(serial_rows[tbl]) == len(parallel_rows[tbl])
+            for serial_row, parallel_row in zip(serial_rows[tbl], parallel_rows[tbl]):
+                assert serial_row.keys() == parallel_row.keys()
+                for k, v in serial_row.items():
+                    np.testing.assert_array_equal(v, parallel_row[k])
+
+
+def test_small_behavior_file_skipped():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        f = make_mock_delay_response_matfile(
+            pathlib.Path(tmpdir, 'dl0_TW_autoTrain_20180104_132813.mat'), padding=False)
+        task_type, _, rows = behavior_ingest.parse_behavior_file(make_session_key(), f)
+
+    assert task_type == 'delay-response' and rows is None
+
+
+def test_bpod_csv_loading():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        df = ingest_util.load_and_parse_a_csv_file(write_bpod_csv(pathlib.Path(tmpdir, 'mock.csv'),
+                                                                  bpod_csv_fixture))
+
+    assert len(df) == 46 and (df['experimenter'] == 'mock-user').all() and (df['subject'] == 'dl0').all()
+    assert df['PC-TIME'][38] == pd.Timestamp('2019-09-05 10:00:06')
+    assert df['Trial_number_in_session'].tolist() == [0.] * 8 + [1.] * 15 + [2.] * 15 + [3.] * 8
+
+    # per trial values, from their trial start row
+    pd.testing.assert_frame_equal(
+        df.loc[df['TYPE'] == 'TRIAL', ['Trial_number', 'Block_number',
+                                       'reward_L_accumulated', 'reward_R_accumulated']],
+        pd.DataFrame({'Trial_number': [1., 2., 3.], 'Block_number': [1., 2., np.nan],
+                      'reward_L_accumulated': np.array([False, True, True], dtype=object),
+                      'reward_R_accumulated': np.array([False, False, True], dtype=object)}, index=[8, 23, 38]))
+
+    # variables: updated from their update row, or on the first row only (if never updated)
+    assert df['var:ValveOpenTime_L'].tolist() == [0.05] * 32 + [0.02] * 14
+    assert (df['var:ValveOpenTime_R'] == 0.05).all() and (df['var:lickport_number'] == 2).all()
+    assert df['var:reward_probabilities_L'].tolist() == [[0.1, 0.5]] + [None] * 45
+    assert df['var:WaterPort_R_ch_in'].tolist() == ['Port2In'] + [None] * 45
+    assert (df['var_motor:LickPort_Lateral_pos'] == 5000).all()
+
+
+def test_bpod_trial_parsing():
+    lick_ports = ['left', 'right']
+    water_port_channels = {'left': 'Port1In', 'right': 'Port2In'}
+    sess_key = {'subject_id': 1000, 'session': 1, 'session_date': date(2019, 9, 5),
+                'session_time': datetime(2019, 9, 5, 10).time()}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        df = ingest_util.load_and_parse_a_csv_file(write_bpod_csv(pathlib.Path(tmpdir, 'mock.csv'),
+                                                                  bpod_csv_fixture))
+
+    rows = behavior_ingest.parse_bpod_session_trials(df, sess_key, lick_ports, water_port_channels, 'foraging', 100)
+    assert rows.keys() == bpod_fixture_trials.keys()
+    for tbl, (attrs, expected) in bpod_fixture_trials.items():
+        assert [tuple(row[a] for a in attrs) for row in rows[tbl]] == expected, tbl
+        assert all(sess_key.items() <= row.items() for row in rows[tbl]), tbl
+    assert [row['trial_uid'] for row in rows['sess_trial']] == [1, 2]
+
+    # as the second bpod session of a datajoint session, after 10 trials in 2 blocks
+    rows = behavior_ingest.parse_bpod_session_trials(df, sess_key, lick_ports, water_port_channels, 'foraging', 100,
+                                                     first_trial=11, first_block=3, trial_uid_start=101)
+    assert [(row['trial'], row['trial_uid']) for row in rows['sess_trial']] == [(11, 111), (12, 112)]
+    assert [row['block'] for row in rows['sess_block']] == [3, 4]
+    assert [(row['trial'], row['block']) for row in rows['sess_block_trial']] == [(11, 3), (12, 4)]
+
+
+def test_bpod_trial_parsing_benchmark():
+    lick_ports = ['left', 'right']
+    water_port_channels = {'left': 'Port1In', 'right': 'Port2In'}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        f = make_mock_bpod_csv(pathlib.Path(tmpdir, 'mock.csv'), n_trials=700)
+
+        start = time.time()
+        df = ingest_util.load_and_parse_a_csv_file(f)
+        load_time = time.time() - start
+
+    sess_key = {'subject_id': 1000, 'session': 1, 'session_date': date(2019, 9, 5),
+                'session_time': df['PC-TIME'][0].time()}
+
+    start = time.time()
+    rows = behavior_ingest.parse_bpod_session_trials(df, sess_key, lick_ports, water_port_channels, 'foraging', 100)
+    parse_time = time.time() - start
+
+    log.info('700 trials - csv loading: {:.2f}s, trial parsing: {:.2f}s'.format(load_time, parse_time))
+
+    # trials without GoCue are skipped
+    assert len(rows['sess_trial']) == (df['MSG'] == 'GoCue').sum()
+
+
+def test_bpod_session_catalog():
+    loaded = []
+
+    def load_project(project_path):
+        loaded.append(project_path)
+        return load_mock_bpod_project_sessions(project_path)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        project_paths = make_mock_bpod_projects(pathlib.Path(tmpdir, 'projects'), n_subjects=10, n_days=3)
+        snapshot_path = pathlib.Path(tmpdir, 'catalog.pickle')
+
+        catalog = behavior_ingest.BPodSessionCatalog(project_paths, snapshot_path, load_project)
+        assert len(loaded) == 2
+
+        projects = [load_mock_bpod_project_sessions(p) for p in project_paths]
+        for subject in ('dl0', 'dl1', 'dl1003', 'dl42'):
+            for date_str in ('20200101', '20200103', '20200104'):
+                assert catalog.sessions(subject, date_str) == find_bpod_sessions(projects, subject, date_str)
+
+        # from the snapshot
+        catalog = behavior_ingest.BPodSessionCatalog(project_paths, snapshot_path, load_project)
+        assert len(loaded) == 2
+        assert catalog.sessions('dl1', '20200102') == find_bpod_sessions(projects, 'dl1', '20200102')
+
+        # a new session - only its project is reloaded
+        add_mock_bpod_session(pathlib.Path(project_paths[1], 'experiments', 'foraging0', 'setups', 'tower-1',
+                                           'sessions'), 'dl1001', datetime(2020, 2, 1, 9))
+        os.utime(pathlib.Path(project_paths[1], 'experiments', 'foraging0', 'setups', 'tower-1', 'sessions'),
+                 (time.time() + 10, time.time() + 10))
+        catalog = behavior_ingest.BPodSessionCatalog(project_paths, snapshot_path, load_project)
+        assert loaded[2:] == [project_paths[1].as_posix()]
+        assert [s.name for s in catalog.sessions('dl1001', '20200201')] == ['20200201-090000-dl1001']
+
+
+def test_bpod_session_catalog_benchmark():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        project_paths = make_mock_bpod_projects(pathlib.Path(tmpdir, 'projects'), n_subjects=100, n_days=5)
+        snapshot_path = pathlib.Path(tmpdir, 'catalog.pickle')
+        keys = [('dl{}'.format(s), '2020010{}'.format(d)) for s in range(0, 2000, 7) for d in range(1, 6)]
+
+        start = time.time()
+        projects = [load_mock_bpod_project_sessions(p) for p in project_paths]
+        walked = [find_bpod_sessions(projects, *k) for k in keys]
+        walk_time = time.time() - start
+
+        start = time.time()
+        catalog = behavior_ingest.BPodSessionCatalog(project_paths, snapshot_path, load_mock_bpod_project_sessions)
+        catalog_build_time = time.time() - start
+
+        start = time.time()
+        catalog = behavior_ingest.BPodSessionCatalog(project_paths, snapshot_path, load_mock_bpod_project_sessions)
+        indexed = [catalog.sessions(*k) for k in keys]
+        catalog_time = time.time() - start
+
+    log.info('{} sessions, {} keys - project walk: {:.2f}s, catalog build: {:.2f}s, '
+             'catalog from snapshot + lookups: {:.2f}s'.format(
+                 sum(len(p) for p in projects), len(keys), walk_time, catalog_build_time, catalog_time))
+
+    assert indexed == walked
@@ -0,0 +1,154 @@
+import time
+import logging
+import pathlib
+import tempfile
+
+import numpy as np
+
+from pipeline import ccf
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+def make_labeled_volume(shape=(132, 80, 114), n_regions=800, block=4, seed=0):
+    ''' synthetic annotation volume: blocks of random region labels, with background (0) blocks '''
+    rng = np.random.RandomState(seed)
+    region_ids = np.sort(rng.choice(np.arange(1, 20000), n_regions, replace=False)).astype(np.uint32)
+    coarse_shape = [-(-s // block) for s in shape]
+    coarse = np.where(rng.rand(*coarse_shape) < 0.4, 0, rng.choice(region_ids, coarse_shape))
+    stack = coarse.repeat(block, 0).repeat(block, 1).repeat(block, 2)[:shape[0], :shape[1], :shape[2]]
+    return np.ascontiguousarray(stack, dtype=np.uint32), region_ids
+
+
+def region_voxels_loop(stack, region_ids):
+    ''' the per-region scan replaced by ccf.region_voxels() '''
+    for region_id in region_ids:
+        yield region_id, np.array(np.where(stack == region_id)).T[:, [2, 1, 0]]
+
+
+#
+# Actual Tests
+#
+
+def test_region_voxels():
+    stack, region_ids = make_labeled_volume((40, 30, 20), n_regions=50, block=3)
+    # unlabeled region & background
+    region_ids = np.concatenate([region_ids, [25000]])
+
+    for with_background in (False, True):
+        ids = np.concatenate([[0], region_ids]) if with_background else region_ids
+        voxels = list(ccf.region_voxels(stack, ids))
+        expected = list(region_voxels_loop(stack, ids))
+        assert [r for r, _ in voxels] == list(ids)
+        for (_, vox), (_, expected_vox) in zip(voxels, expected):
+            np.testing.assert_array_equal(vox, expected_vox)
+
+        assert voxels[-1][1].shape == (0, 3)
+        assert sum(len(v) for _, v in voxels) == (stack.size if with_background else np.count_nonzero(stack))
+
+
+def test_region_voxels_benchmark():
+    stack, region_ids = make_labeled_volume()
+
+    start = time.time()
+    n_loop = sum(len(v) for _, v in region_voxels_loop(stack, region_ids))
+    loop_time = time.time() - start
+
+    start = time.time()
+    n_voxels = sum(len(v) for _, v in ccf.region_voxels(stack, region_ids))
+    single_pass_time = time.time() - start
+
+    log.info('{} regions, {} voxels - per-region scan: {:.2f}s, single pass: {:.2f}s'.format(
+        len(region_ids), stack.size, loop_time, single_pass_time))
+
+    assert n_voxels == n_loop == np.count_nonzero(stack)
+
+
+def make_annotation(shape=(30, 20, 40), n_regions=25, seed=0):
+    ''' synthetic CCFAnnotation rows (20um voxels, ~30% not annotated) and CCFBrainRegion attributes '''
+    rng = np.random.RandomState(seed)
+    regions = {'region_name': np.array(['region {}'.format(i) for i in rng.permutation(n_regions)]),
+               'region_id': rng.choice(np.arange(1, 2000), n_regions, replace=False),
+               'color_code': np.array(['{:06X}'.format(c) for c in rng.randint(0, 0xFFFFFF, n_regions)])}
+
+    voxels = np.array(np.unravel_index(np.arange(np.prod(shape)), shape)).T
+    voxels = voxels[rng.rand(len(voxels)) < 0.7]
+    ccf_x, ccf_y, ccf_z = (voxels * 20).T
+    annotation = regions['region_name'][rng.randint(0, n_regions, len(voxels))]
+    return ccf_x, ccf_y, ccf_z, annotation, regions
+
+
+def join_annotation(xyz, ccf_x, ccf_y, ccf_z, annotation, regions, field):
+    ''' the join of coordinates with CCFAnnotation * CCFBrainRegion replaced by AnnotationVolume.lookup() '''
+    annotated = {(x, y, z): a for x, y, z, a in zip(ccf_x, ccf_y, ccf_z, annotation)}
+    region_fields = dict(zip(regions['region_name'], regions[field]))
+    return [region_fields[annotated[tuple(c)]] if tuple(c) in annotated else None for c in xyz]
+
+
+def test_annotation_volume():
+    ccf_x, ccf_y, ccf_z, annotation, regions = make_annotation()
+    rng = np.random.RandomState(1)
+
+    # grid points (inside and outside of the volume) and off-grid points
+    xyz = np.vstack([rng.randint(-2, 45, (2000, 3)) * 20, rng.randint(-40, 900, (200, 3))])
+
+    volume = ccf.AnnotationVolume.from_annotations(ccf_x, ccf_y, ccf_z, annotation, regions, 'CCF_test',
+                                                   fingerprint='fp')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        volume.save(*ccf.AnnotationVolume.get_cache_paths('CCF_test', tmpdir))
+        cached = ccf.AnnotationVolume.load('CCF_test', tmpdir, fingerprint='fp')
+        assert isinstance(cached.labels, np.memmap)
+        assert cached.fingerprint == 'fp'
+
+        # outdated cache (other database content)
+        assert ccf.AnnotationVolume.load_cached('CCF_test', tmpdir, fingerprint='other') is None
+        assert ccf.AnnotationVolume.load_cached('CCF_other', tmpdir) is None
+
+        for field in ('region_name', 'region_id', 'color_code'):
+            expected = join_annotation(xyz, ccf_x, ccf_y, ccf_z, annotation, regions, field)
+            if field == 'region_id':
+                expected = [-1 if v is None else v for v in expected]
+            assert list(volume.lookup(xyz, field)) == expected
+            assert list(cached.lookup(xyz, field)) == expected
+
+        # coronal slice
+        xy = np.array(np.meshgrid(np.arange(30), np.arange(20), indexing='ij')).reshape(2, -1).T * 20
+        expected = join_annotation(np.column_stack([xy, np.full(len(xy), 200)]),
+                                   ccf_x, ccf_y, ccf_z, annotation, regions, 'region_name')
+        assert list(cached.slice(ccf_z=200).ravel()) == expected
+        assert cached.slice(ccf_z=5000).shape == (30, 20)
+        assert set(cached.slice(ccf_z=5000).ravel()) == {None}
+
+    # snapped off-grid points
+    np.testing.assert_array_equal(volume.lookup(xyz[:2000] + 7, snap=True), volume.lookup(xyz[:2000]))
+
+
+def test_annotation_volume_build(monkeypatch):
+    ccf_x, ccf_y, ccf_z, annotation, regions = make_annotation()
+    fetched = []
+
+    def fetch(annotation_version, fingerprint=None):
+        fetched.append(fingerprint)
+        return ccf.AnnotationVolume.from_annotations(ccf_x, ccf_y, ccf_z, annotation, regions,
+                                                     annotation_version, fingerprint)
+
+    # the CCFAnnotation/CCFBrainRegion tables are fetched from the database
+    monkeypatch.setattr(ccf.AnnotationVolume, 'fetch', fetch)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # built once, then loaded from the cache - until the database content changes
+        for fingerprint in ('fp', 'fp', 'fp2'):
+            volume = ccf.AnnotationVolume.load('CCF_test', tmpdir, fingerprint=fingerprint)
+            assert volume.fingerprint == fingerprint
+        assert fetched == ['fp', 'fp2']
+
+        assert ccf.AnnotationVolume.load('CCF_test', tmpdir, fingerprint='fp2', refresh=True).fingerprint == 'fp2'
+        assert fetched == ['fp', 'fp2', 'fp2']
+
+        # no temporary files left over
+        assert sorted(p.suffix for p in pathlib.Path(tmpdir).iterdir()) == ['.lock', '.npy', '.npz']
@@ -0,0 +1,213 @@
+import time
+import logging
+import decimal
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+from scipy.stats import poisson
+
+from pipeline import ephys
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+def make_unit_trial_spikes(n_units=100, n_trials=300, seed=0):
+    ''' mock Unit.TrialSpikes * SessionTrial rows of an insertion: (spike_times, unit, trial duration) '''
+    rng = np.random.RandomState(seed)
+    trial_durations = np.array([decimal.Decimal(int(d)).scaleb(-4) for d in rng.randint(40000, 100000, n_trials)],
+                               dtype=object)
+
+    spikes, row_units, row_durations = [], [], []
+    for unit in range(n_units):
+        rate = rng.uniform(0.1, 30) if unit % 10 else 0.05  # some units with a few spikes only
+        for trial in range(n_trials):
+            if rng.rand() < 0.05:
+                continue
+            spike_times = np.sort(rng.uniform(-4, 4, rng.poisson(rate * 8)))
+            if len(spike_times) and rng.rand() < 0.1:  # duplicated spikes, and ISI violations
+                spike_times = np.sort(np.concatenate([spike_times, spike_times[:2], spike_times[:1] + 0.001]))
+            spikes.append(spike_times)
+            row_units.append(unit)
+            row_durations.append(trial_durations[trial])
+
+    spikes_arr = np.empty(len(spikes), dtype=object)
+    spikes_arr[:] = spikes
+    return spikes_arr, np.array(row_units), np.array(row_durations, dtype=object)
+
+
+def compute_unit_stats_loop(trial_spikes, row_units, trial_durations, isi_threshold=0.002, min_isi=0):
+    ''' the per unit UnitStat.make() computation, replaced by UnitStat.compute_unit_stats() '''
+    stats = {}
+    for unit in np.unique(row_units):
+        unit_spikes, unit_durations = trial_spikes[row_units == unit], trial_durations[row_units == unit]
+        isis = np.hstack([np.diff(spks) for spks in unit_spikes])
+
+        if isis.size > 0:
+            processed_trial_spikes = []
+            for spike_train in unit_spikes:
+                duplicate_spikes = np.where(np.diff(spike_train) <= min_isi)[0]
+                processed_trial_spikes.append(np.delete(spike_train, duplicate_spikes + 1))
+
+            num_spikes = len(np.hstack(processed_trial_spikes))
+            avg_firing_rate = num_spikes / float(sum(unit_durations))
+
+            num_violations = sum(isis < isi_threshold)
+            violation_time = 2 * num_spikes * (isi_threshold - min_isi)
+            violation_rate = num_violations / violation_time
+            fpRate = violation_rate / avg_firing_rate
+
+            stats[unit] = (fpRate, avg_firing_rate)
+        else:
+            stats[unit] = (None, None)
+
+    return stats
+
+
+def make_unit_waveforms(n_units=200, seed=0):
+    ''' mock average waveforms (trough then peak, of different trough-to-peak widths) and sampling rates '''
+    rng = np.random.RandomState(seed)
+    waveforms, sampling_rates = [], []
+    for unit in range(n_units):
+        fs, n_samples = (30000, 82) if unit % 4 else (25000, 61)
+        t = np.arange(n_samples) / fs * 1000  # ms
+        trough, width = rng.uniform(0.6, 1.0), rng.uniform(0.15, 0.9)
+        waveform = (-rng.uniform(50, 200) * np.exp(-(t - trough) ** 2 / (2 * 0.08 ** 2))
+                    + rng.uniform(10, 60) * np.exp(-(t - trough - width) ** 2 / (2 * 0.2 ** 2))
+                    + rng.randn(n_samples))
+        waveforms.append(waveform)
+        sampling_rates.append(fs)
+
+    return waveforms, np.array(sampling_rates)
+
+
+def classify_waveform_loop(ave_waveform, fs, upsample_factor=100):
+    ''' the per unit UnitCellType.make() computation, replaced by UnitCellType.classify_waveforms() '''
+    cs = CubicSpline(range(len(ave_waveform)), ave_waveform)
+    ave_waveform = cs(np.linspace(0, len(ave_waveform) - 1, (len(ave_waveform))*upsample_factor))
+
+    fs = fs * upsample_factor
+    x_min = np.argmin(ave_waveform) / fs
+    x_max = np.argmax(ave_waveform) / fs
+    waveform_width = abs(x_max-x_min) * 1000  # convert to ms
+
+    return 'FS' if waveform_width < 0.4 else 'Pyr'
+
+
+def make_unit_trial_counts(n_units=300, n_trials=400, seed=0):
+    ''' mock (unit, trial) spike counts and trial durations, of drifting units - some with fewer trials '''
+    rng = np.random.RandomState(seed)
+    trial_durations = rng.uniform(4, 10, n_trials)
+
+    counts, row_units, row_durations = [], [], []
+    for unit in range(n_units):
+        unit_trials = n_trials if unit % 5 else rng.randint(1, n_trials)
+        rate = rng.uniform(0.5, 30) * np.linspace(1, rng.uniform(0.2, 3), unit_trials)  # drift
+        counts.append(rng.poisson(rate * trial_durations[:unit_trials]))
+        row_units.append(np.full(unit_trials, unit))
+        row_durations.append(trial_durations[:unit_trials])
+
+    return np.concatenate(counts), np.concatenate(row_durations), np.concatenate(row_units)
+
+
+def compute_drift_metric_loop(trial_spike_counts, trial_durations):
+    ''' the per unit MAPClusterMetric.make() computation, replaced by compute_drift_metrics() '''
+    trial_spike_rates = trial_spike_counts / trial_durations.astype(float)  # spikes/sec
+    mean_spike_rate = np.mean(trial_spike_rates)
+    window_size = 6  # sample
+    kernel = np.ones(window_size) / window_size
+    processed_trial_spike_rates = np.convolve(trial_spike_rates, kernel, 'same')
+    ds_factor = 6
+    processed_trial_spike_rates = processed_trial_spike_rates[::ds_factor]
+    poisson_cdf = poisson.cdf(processed_trial_spike_rates, mean_spike_rate)
+    return np.logical_or(poisson_cdf > 0.95, poisson_cdf < 0.05).sum() / len(poisson_cdf)
+
+
+#
+# Actual Tests
+#
+
+def test_compute_unit_stats():
+    spikes, row_units, row_durations = make_unit_trial_spikes(n_units=30, n_trials=50)
+
+    # shuffled rows, and a unit without TrialSpikes
+    order = np.random.RandomState(1).permutation(len(spikes))
+    isi_violations, avg_firing_rates = ephys.UnitStat.compute_unit_stats(
+        spikes[order], row_units[order], row_durations[order], 31)
+    expected = compute_unit_stats_loop(spikes, row_units, row_durations)
+
+    assert any(v == (None, None) for v in expected.values())
+    for unit, (isi_violation, avg_firing_rate) in expected.items():
+        if isi_violation is None:
+            assert np.isnan(isi_violations[unit]) and np.isnan(avg_firing_rates[unit])
+        else:  # exactly equal
+            assert isi_violations[unit] == isi_violation and avg_firing_rates[unit] == avg_firing_rate
+
+    assert np.isnan(isi_violations[30]) and np.isnan(avg_firing_rates[30])
+
+
+def test_compute_unit_stats_benchmark():
+    spikes, row_units, row_durations = make_unit_trial_spikes()
+
+    start = time.time()
+    expected = compute_unit_stats_loop(spikes, row_units, row_durations)
+    loop_time = time.time() - start
+
+    start = time.time()
+    isi_violations, avg_firing_rates = ephys.UnitStat.compute_unit_stats(
+        spikes, row_units, row_durations, len(expected))
+    batch_time = time.time() - start
+
+    log.info('{} units stats - per unit: {:.2f}s, probe batch: {:.2f}s'.format(
+        len(expected), loop_time, batch_time))
+
+    assert all(isi_violations[u] == v[0] and avg_firing_rates[u] == v[1]
+               for u, v in expected.items() if v[0] is not None)
+
+
+def test_classify_waveforms():
+    waveforms, sampling_rates = make_unit_waveforms()
+
+    cell_types = ephys.UnitCellType.classify_waveforms(waveforms, sampling_rates)
+    expected = [classify_waveform_loop(w, fs) for w, fs in zip(waveforms, sampling_rates)]
+
+    assert {'FS', 'Pyr'} == set(expected)
+    assert list(cell_types) == expected
+    assert len(ephys.UnitCellType.classify_waveforms([], [])) == 0
+
+
+def test_compute_drift_metrics():
+    counts, durations, row_units = make_unit_trial_counts(n_units=60, n_trials=100)
+    assert (np.bincount(row_units) < 6).any()  # units with less trials than the moving-average window
+
+    # shuffled units - the rows of each unit ordered by trial, and a unit without rows
+    order = np.concatenate([np.flatnonzero(row_units == u) for u in np.random.RandomState(1).permutation(60)])
+    drift_metrics = ephys.MAPClusterMetric.compute_drift_metrics(counts[order], durations[order],
+                                                                 row_units[order], 61)
+
+    for unit in range(60):
+        rows = row_units == unit
+        assert drift_metrics[unit] == compute_drift_metric_loop(counts[rows], durations[rows])
+    assert np.isnan(drift_metrics[60])
+
+
+def test_compute_drift_metrics_benchmark():
+    counts, durations, row_units = make_unit_trial_counts()
+
+    start = time.time()
+    expected = [compute_drift_metric_loop(counts[row_units == u], durations[row_units == u])
+                for u in np.unique(row_units)]
+    loop_time = time.time() - start
+
+    start = time.time()
+    drift_metrics = ephys.MAPClusterMetric.compute_drift_metrics(counts, durations, row_units, len(expected))
+    batch_time = time.time() - start
+
+    log.info('{} units drift metrics - per unit: {:.2f}s, probe batch: {:.2f}s'.format(
+        len(expected), loop_time, batch_time))
+
+    assert np.array_equal(drift_metrics, expected)
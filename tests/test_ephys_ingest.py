@@ -0,0 +1,122 @@
+import pathlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from pipeline.ingest import ephys as ephys_ingest
+from pipeline.ingest import ProbeInsertionError
+
+
+#
+# Utilities
+#
+
+def make_mock_kilosort_dir(ks_dir, n_units=20, n_spikes=50000, n_channels=32, n_samples=82, seed=0):
+    ''' minimal kilosort2 output, with metrics.csv and mean_waveforms.npy (no ap.bin required) '''
+    rng = np.random.RandomState(seed)
+    ks_dir = pathlib.Path(ks_dir)
+    ks_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(ks_dir / 'params.py', 'w') as f:
+        f.write('dat_path = mock.ap.bin\nn_channels_dat = {}\ndtype = int16\nsample_rate = 30000.0\n'.format(
+            n_channels + 1))
+
+    spike_clusters = rng.randint(0, n_units, n_spikes)
+    np.save(ks_dir / 'spike_times.npy', np.sort(rng.randint(0, 30000 * 600, n_spikes)).astype(np.uint64))
+    np.save(ks_dir / 'spike_clusters.npy', spike_clusters.astype(np.int32))
+    np.save(ks_dir / 'spike_templates.npy', spike_clusters.astype(np.uint32))
+    np.save(ks_dir / 'amplitudes.npy', rng.rand(n_spikes))
+    np.save(ks_dir / 'templates.npy', rng.randn(n_units, n_samples, n_channels).astype(np.float32))
+    np.save(ks_dir / 'channel_map.npy', np.arange(n_channels, dtype=np.int32))
+    np.save(ks_dir / 'channel_positions.npy', np.column_stack([np.tile([16, 48], n_channels // 2),
+                                                               np.repeat(np.arange(n_channels // 2) * 20, 2)]))
+    np.save(ks_dir / 'pc_features.npy', rng.randn(n_spikes, 3, 8).astype(np.float32))
+    np.save(ks_dir / 'pc_feature_ind.npy', np.array([rng.choice(n_channels, 8, replace=False)
+                                                     for _ in range(n_units)], dtype=np.uint32))
+    np.save(ks_dir / 'whitening_mat_inv.npy', np.eye(n_channels))
+    np.save(ks_dir / 'mean_waveforms.npy', rng.randn(n_units, n_channels, n_samples))
+
+    pd.DataFrame({'cluster_id': np.arange(n_units),
+                  'KSLabel': rng.choice(['good', 'mua'], n_units)}).to_csv(
+        ks_dir / 'cluster_KSLabel.tsv', sep='\t', index=False)
+    pd.DataFrame({'cluster_id': np.arange(n_units),
+                  'peak_channel': rng.randint(0, n_channels, n_units),
+                  'amplitude': rng.rand(n_units) * 100,
+                  'snr': rng.rand(n_units) * 5}).to_csv(ks_dir / 'metrics.csv', index=False)
+
+    return ks_dir
+
+
+def make_mock_bitcode(n_trials=100, seed=0):
+    ''' (sync_behav, sync_ephys, trial_fix, trial_go, trial_start) - as returned by read_bitcode() '''
+    rng = np.random.RandomState(seed)
+    trial_start = np.sort(rng.choice(np.arange(30000 * 600), n_trials, replace=False))
+    sync = np.arange(n_trials)
+    return sync, sync, None, trial_start + 3000, trial_start
+
+
+#
+# Actual Tests
+#
+
+def test_parallel_probe_loading(monkeypatch):
+    sinfo = {'subject_id': 0, 'session': 1, 'water_restriction_number': 'mock'}
+    bitcode = make_mock_bitcode()
+    # the bitcode files are read from the database session
+    monkeypatch.setattr(ephys_ingest, 'read_bitcode', lambda bitcode_dir, h2o, skey: bitcode)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        clustering_files = {probe_no: ((make_mock_kilosort_dir(pathlib.Path(tmpdir, str(probe_no), 'ks'),
+                                                               seed=probe_no),
+                                        pathlib.Path(tmpdir, str(probe_no))), 'kilosort2', None)
+                            for probe_no in (3, 1, 4, 2)}
+
+        serial = list(ephys_ingest.load_clustering_results(sinfo, clustering_files, n_workers=1))
+        parallel = list(ephys_ingest.load_clustering_results(sinfo, clustering_files, n_workers=4))
+
+    # same data, yielded in the order of clustering_files
+    assert len(serial) == len(parallel) == len(clustering_files)
+    for probe_no, serial_data, parallel_data in zip(clustering_files, serial, parallel):
+        assert serial_data['ef_path'] == parallel_data['ef_path'] == clustering_files[probe_no][0][0]
+        assert serial_data.keys() == parallel_data.keys()
+        for k, v in serial_data.items():
+            if isinstance(v, pd.DataFrame):
+                pd.testing.assert_frame_equal(v, parallel_data[k])
+            elif isinstance(v, np.ndarray):
+                np.testing.assert_array_equal(v, parallel_data[k])
+            else:
+                assert v == parallel_data[k]
+
+
+def test_insert_clustering_results_probe_error(monkeypatch):
+    sinfo = {'subject_id': 0, 'session': 1, 'water_restriction_number': 'mock'}
+    bitcode = make_mock_bitcode()
+    monkeypatch.setattr(ephys_ingest, 'read_bitcode', lambda bitcode_dir, h2o, skey: bitcode)
+
+    inserted = []
+
+    def insert_probe(data, probe_no, npx_meta):
+        if probe_no == 1:
+            raise ProbeInsertionError('mock')
+        inserted.append(probe_no)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        clustering_files = {probe_no: ((make_mock_kilosort_dir(pathlib.Path(tmpdir, str(probe_no), 'ks'),
+                                                               seed=probe_no),
+                                        pathlib.Path(tmpdir, str(probe_no))), 'kilosort2', None)
+                            for probe_no in (3, 1, 4, 2)}
+
+        for n_workers in (1, 4):
+            inserted.clear()
+            probe_data = ephys_ingest.load_clustering_results(sinfo, clustering_files, n_workers=n_workers)
+            assert not ephys_ingest.insert_clustering_results(probe_data, clustering_files, insert_probe)
+
+            # the probes after the error are neither inserted nor loaded
+            assert inserted == [3]
+            assert next(probe_data, None) is None
+
+        inserted.clear()
+        probe_data = ephys_ingest.load_clustering_results(sinfo, {3: clustering_files[3]}, n_workers=1)
+        assert ephys_ingest.insert_clustering_results(probe_data, {3: clustering_files[3]}, insert_probe)
+        assert inserted == [3]
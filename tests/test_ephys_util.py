@@ -0,0 +1,279 @@
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from pipeline.ingest import ephys_util
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+def _make_spike_train(n_spikes=20000, n_trials=50, seed=0):
+    rng = np.random.RandomState(seed)
+    trial_start = np.sort(rng.choice(np.arange(1000, 10000000), n_trials, replace=False))
+    trial_go = trial_start + rng.randint(100, 5000, n_trials)
+    spikes = np.sort(rng.randint(0, 10100000, n_spikes))
+    # make sure some spikes fall on the trial boundaries
+    spikes[rng.choice(n_spikes, n_trials, replace=False)] = trial_start
+    spikes.sort()
+    units = rng.randint(1, 30, n_spikes)
+    return spikes, units, trial_start, trial_go
+
+
+def _trialize_loop(spikes, units, trial_start, trial_go):
+    ''' reference implementation - the original per-trial loop from EphysIngest._load '''
+    t, trial_spikes, trial_units = 0, [], []
+    while t < len(trial_start) - 1:
+        s0, s1 = trial_start[t], trial_start[t+1]
+        trial_idx = np.where((spikes > s0) & (spikes < s1))
+        trial_spikes.append(spikes[trial_idx] - trial_go[t])
+        trial_units.append(units[trial_idx])
+        t += 1
+    trial_idx = np.where((spikes > s1))
+    trial_spikes.append(spikes[trial_idx] - trial_go[t])
+    trial_units.append(units[trial_idx])
+    return trial_spikes, trial_units
+
+
+#
+# Actual Tests
+#
+
+def test_trialize_spikes():
+    spikes, units, trial_start, trial_go = _make_spike_train()
+
+    spike_trial_idx, spike_trial_times = ephys_util.trialize_spikes(spikes, trial_start, trial_go)
+    trial_spikes, trial_units = ephys_util.split_by_trial(
+        spike_trial_idx, len(trial_start), spike_trial_times, units)
+
+    ref_spikes, ref_units = _trialize_loop(spikes, units, trial_start, trial_go)
+
+    assert len(trial_spikes) == len(ref_spikes) == len(trial_start)
+    for t in range(len(trial_start)):
+        np.testing.assert_array_equal(trial_spikes[t], ref_spikes[t])
+        np.testing.assert_array_equal(trial_units[t], ref_units[t])
+
+    assert np.all(np.isnan(spike_trial_times[spike_trial_idx < 0]))
+    assert not np.any(np.isin(spikes[spike_trial_idx >= 0], trial_start))
+
+
+def test_trialize_spikes_no_go_cue():
+    spikes, units, trial_start, trial_go = _make_spike_train()
+    trial_go = trial_go.astype(float)
+    trial_go[::3] = np.nan
+
+    spike_trial_idx, spike_trial_times = ephys_util.trialize_spikes(spikes, trial_start, trial_go)
+
+    no_go = np.isin(spike_trial_idx, np.arange(0, len(trial_start), 3))
+    assert np.all(np.isnan(spike_trial_times[no_go]))
+
+
+def test_group_by_unit():
+    spikes, units, trial_start, trial_go = _make_spike_train()
+    depths = np.random.RandomState(1).rand(len(spikes))
+
+    unit_ids, unit_spikes, unit_depths = ephys_util.group_by_unit(units, spikes, depths)
+
+    np.testing.assert_array_equal(unit_ids, np.unique(units))
+    for i, u in enumerate(unit_ids):
+        np.testing.assert_array_equal(unit_spikes[i], spikes[units == u])
+        np.testing.assert_array_equal(unit_depths[i], depths[units == u])
+
+
+def test_group_by_unit_and_trial():
+    spikes, units, trial_start, trial_go = _make_spike_train()
+
+    spike_trial_idx, spike_trial_times = ephys_util.trialize_spikes(spikes, trial_start, trial_go)
+    unit_ids, unit_trial_spikes = ephys_util.group_by_unit_and_trial(
+        units, spike_trial_idx, len(trial_start), spike_trial_times)
+
+    ref_spikes, ref_units = _trialize_loop(spikes, units, trial_start, trial_go)
+
+    assert len(unit_trial_spikes) == len(unit_ids)
+    for i, u in enumerate(unit_ids):
+        assert len(unit_trial_spikes[i]) == len(trial_start)
+        for t in range(len(trial_start)):
+            np.testing.assert_array_equal(unit_trial_spikes[i][t], ref_spikes[t][ref_units[t] == u])
+
+
+def _make_ap_bin(bin_fp, channel_num=40, sample_count=600000, n_units=30, n_spikes=30000, seed=0):
+    ''' synthetic int16 raw data (sample x channel) with a spike train '''
+    rng = np.random.RandomState(seed)
+    data = np.memmap(bin_fp, dtype='int16', mode='w+', shape=(sample_count, channel_num))
+    data[:] = rng.randint(-50, 50, (sample_count, channel_num))
+    data.flush()
+    spike_times = np.sort(rng.randint(0, sample_count, n_spikes)).astype(np.uint64)
+    spike_units = rng.randint(0, n_units, n_spikes)
+    return spike_times, spike_units
+
+
+def _extract_waveforms_loop(bin_fp, channel_num, spike_times, spike_units, unit_ids, chan_map,
+                            n_wf=500, wf_win=(-41, 41), bit_volts=1):
+    ''' reference implementation - the original per-unit loop from ephys.extract_ks_waveforms '''
+    raw_data = np.memmap(bin_fp, dtype='int16', mode='r')
+    data = np.reshape(raw_data, (int(raw_data.size / channel_num), channel_num))
+
+    def calculate_wf_snr(W):
+        W_bar = np.nanmean(W, axis=0)
+        A = np.max(W_bar) - np.min(W_bar)
+        e = W - np.tile(W_bar, (np.shape(W)[0], 1))
+        snr = A / (2 * np.nanstd(e.flatten()))
+        return snr if not np.isinf(snr) else 0
+
+    unit_wfs = {}
+    for unit in unit_ids:
+        spikes = spike_times[spike_units == unit].astype(np.int64)
+        np.random.shuffle(spikes)
+        spikes = spikes[:n_wf]
+        spikes = spikes[np.logical_and(spikes + wf_win[0] >= 0, spikes < data.shape[0] - wf_win[-1])]
+        unit_wfs[unit] = {}
+        spike_wfs = np.dstack([data[int(spk+wf_win[0]):int(spk+wf_win[-1]), chan_map] for spk in spikes])
+        spike_wfs = spike_wfs * bit_volts
+        unit_wfs[unit]['snr'] = [calculate_wf_snr(chn_wfs) for chn_wfs in spike_wfs.transpose((1, 2, 0))]
+        unit_wfs[unit]['mean_wf'] = np.nanmean(spike_wfs, axis=2)
+    return unit_wfs
+
+
+def _make_probe_electrodes(shank_count=4, site_count=1280, col_count=2):
+    ''' electrode table as in lab.ProbeType.create_neuropixels_probe() (1-indexed) '''
+    row_count = site_count // col_count
+    electrode = np.arange(shank_count * site_count) + 1
+    shank = np.repeat(np.arange(shank_count), site_count) + 1
+    shank_col = np.tile(np.tile(np.arange(col_count), row_count), shank_count) + 1
+    shank_row = np.tile(np.repeat(np.arange(row_count), col_count), shank_count) + 1
+    return electrode, shank, shank_col, shank_row
+
+
+def test_probe_geometry():
+    electrode, shank, shank_col, shank_row = _make_probe_electrodes()
+    rng = np.random.RandomState(0)
+
+    # a 384-site recording, as in NeuropixelsMeta.shankmap['data'] (0-indexed)
+    sites = rng.choice(len(electrode), 384, replace=False)
+    shankmap_data = [[shank[i] - 1, shank_col[i] - 1, shank_row[i] - 1, 1] for i in sites]
+
+    resolved = ephys_util.ProbeGeometry(electrode, shank, shank_col, shank_row).resolve(shankmap_data)
+
+    # reference: one restriction per recorded site
+    for e, (s, c, r, _) in zip(resolved, shankmap_data):
+        match = electrode[(shank == s + 1) & (shank_col == c + 1) & (shank_row == r + 1)]
+        assert len(match) == 1 and match[0] == e
+
+    try:
+        ephys_util.ProbeGeometry(electrode, shank, shank_col, shank_row).resolve([[99, 0, 0, 1]])
+    except ValueError:
+        pass
+    else:
+        raise Exception("unknown electrode position didn't yield exception")
+
+
+def test_extract_waveforms():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bin_fp = os.path.join(tmpdir, 'mock_g0_t0.imec.ap.bin')
+        spike_times, spike_units = _make_ap_bin(bin_fp)
+        unit_ids, chan_map = np.arange(30), np.arange(0, 40, 2)
+
+        np.random.seed(0)
+        ref_wfs = _extract_waveforms_loop(bin_fp, 40, spike_times, spike_units, unit_ids, chan_map, bit_volts=2.34375)
+
+        for n_workers in (1, 2):
+            np.random.seed(0)
+            unit_wfs = ephys_util.extract_waveforms(bin_fp, 40, spike_times, spike_units, unit_ids, chan_map,
+                                                    bit_volts=2.34375, chunk_size=256, n_workers=n_workers)
+            for u in unit_ids:
+                np.testing.assert_allclose(unit_wfs[u]['mean_wf'], ref_wfs[u]['mean_wf'])
+                np.testing.assert_allclose(unit_wfs[u]['snr'], ref_wfs[u]['snr'])
+
+        # unit without spikes
+        unit_wfs = ephys_util.extract_waveforms(bin_fp, 40, spike_times, spike_units, [999], chan_map)
+        assert np.all(np.isnan(unit_wfs[999]['mean_wf']))
+
+
+def _make_pc_features(npy_fp, n_spikes, n_templates=50, n_pc_channels=32, n_channels=384, seed=0):
+    rng = np.random.RandomState(seed)
+    pc_features = np.lib.format.open_memmap(npy_fp, mode='w+', dtype=np.float32, shape=(n_spikes, 3, n_pc_channels))
+    for start in range(0, n_spikes, 100000):
+        pc_features[start:start + 100000] = rng.randn(min(100000, n_spikes - start), 3, n_pc_channels)
+    pc_features.flush()
+    pc_feature_ind = np.array([rng.choice(n_channels, n_pc_channels, replace=False)
+                               for _ in range(n_templates)], dtype=np.uint32)
+    spike_templates = rng.randint(0, n_templates, n_spikes).astype(np.uint32)
+    ycoords = np.repeat(np.arange(n_channels // 2) * 20., 2)
+    return np.load(npy_fp, mmap_mode='r'), pc_feature_ind, spike_templates, ycoords
+
+
+def test_compute_spike_depths():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pc_features, pc_feature_ind, spike_templates, ycoords = _make_pc_features(
+            os.path.join(tmpdir, 'pc_features.npy'), 250000)
+
+        # reference: the original one-shot computation from Kilosort.extract_spike_depths
+        pc = np.where(pc_features[:, 0, :] < 0, 0, pc_features[:, 0, :])
+        spk_feature_ycoord = ycoords[pc_feature_ind[spike_templates, :]]
+        ref_depths = np.sum(spk_feature_ycoord * pc**2, axis=1) / np.sum(pc**2, axis=1)
+
+        for chunk_size in (100000, 7777):
+            spike_depths = ephys_util.compute_spike_depths(
+                pc_features, pc_feature_ind, spike_templates, ycoords, chunk_size=chunk_size)
+            np.testing.assert_array_equal(spike_depths, ref_depths)
+
+
+def test_compute_spike_depths_memory():
+    chunk_size = 50000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n_spikes in (200000, 1000000):
+            pc_features, pc_feature_ind, spike_templates, ycoords = _make_pc_features(
+                os.path.join(tmpdir, 'pc_features_{}.npy'.format(n_spikes)), n_spikes)
+
+            tracemalloc.start()
+            ephys_util.compute_spike_depths(pc_features, pc_feature_ind, spike_templates, ycoords,
+                                            chunk_size=chunk_size)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            # output (8 bytes / spike) + a bounded per-chunk working set, regardless of spike count
+            chunk_bytes = chunk_size * pc_features.shape[2] * 8
+            assert peak < n_spikes * 8 + 8 * chunk_bytes, (n_spikes, peak)
+
+
+def test_trialize_spikes_benchmark():
+    spikes, units, trial_start, trial_go = _make_spike_train(n_spikes=2000000, n_trials=400)
+
+    t0 = time.time()
+    _trialize_loop(spikes, units, trial_start, trial_go)
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    spike_trial_idx, spike_trial_times = ephys_util.trialize_spikes(spikes, trial_start, trial_go)
+    ephys_util.split_by_trial(spike_trial_idx, len(trial_start), spike_trial_times, units)
+    t_sorted = time.time() - t0
+
+    log.info('trialization of {} spikes / {} trials: loop {:.3f}s - sorted pass {:.3f}s'.format(
+        len(spikes), len(trial_start), t_loop, t_sorted))
+
+
+def test_extract_waveforms_benchmark():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bin_fp = os.path.join(tmpdir, 'mock_g0_t0.imec.ap.bin')
+        spike_times, spike_units = _make_ap_bin(bin_fp, channel_num=385, sample_count=600000,
+                                                n_units=20, n_spikes=20000)
+        unit_ids, chan_map = np.arange(20), np.arange(384)
+
+        t0 = time.time()
+        _extract_waveforms_loop(bin_fp, 385, spike_times, spike_units, unit_ids, chan_map)
+        t_loop = time.time() - t0
+
+        t0 = time.time()
+        ephys_util.extract_waveforms(bin_fp, 385, spike_times, spike_units, unit_ids, chan_map)
+        t_chunked = time.time() - t0
+
+    log.info('waveform extraction of {} units: per-unit loop {:.3f}s - chunked {:.3f}s'.format(
+        len(unit_ids), t_loop, t_chunked))
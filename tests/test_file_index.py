@@ -0,0 +1,115 @@
+import os
+import re
+import time
+import pathlib
+import logging
+import tempfile
+
+from pipeline.ingest.file_index import FileIndex
+from pipeline.ingest import file_index
+
+
+log = logging.getLogger(__name__)
+
+rexp = '^[a-zA-Z]{2}.*_.*_[0-9]{8}_[0-9]{6}.mat$'
+
+
+#
+# Utilities
+#
+
+def make_rig_tree(rigpath, n_h2os=40, n_protocols=5, n_sessions=25):
+    ''' rig-like tree: <h2o>/<protocol>/Session Data/<h2o>_<protocol>_<date>_<time>.mat (+ non-matching files) '''
+    for h2o_no in range(n_h2os):
+        h2o = 'dl{}'.format(h2o_no)
+        for protocol_no in range(n_protocols):
+            protocol = 'protocol{}'.format(protocol_no)
+            session_dir = pathlib.Path(rigpath, h2o, protocol, 'Session Data')
+            session_dir.mkdir(parents=True)
+            for session_no in range(n_sessions):
+                fname = '{}_{}_201901{:02d}_12{:04d}'.format(h2o, protocol, session_no % 28 + 1, session_no)
+                (session_dir / (fname + '.mat')).write_bytes(b'\0' * 16)
+                (session_dir / (fname + '.txt')).touch()
+
+
+def walk_rig_tree(rigpath):
+    ''' the os.walk() scan replaced by FileIndex '''
+    return sorted(pathlib.Path(root, f).relative_to(rigpath)
+                  for root, dirs, files in os.walk(rigpath)
+                  for f in files if re.match(rexp, f))
+
+
+#
+# Actual Tests
+#
+
+def test_file_index():
+    file_index._mtime_settle_time = 0
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rigpath = pathlib.Path(tmpdir, 'rig')
+        make_rig_tree(rigpath)
+        index = FileIndex(pathlib.Path(tmpdir, 'index.sqlite'), rexp)
+
+        indexed = index.refresh(rigpath)
+        assert len(indexed) == 40 * 5 * 25
+        assert [p for p, _, _ in indexed] == walk_rig_tree(rigpath)
+        assert all(size == 16 for _, _, size in indexed)
+
+        # unchanged tree
+        assert index.refresh(rigpath) == indexed
+
+        # added file
+        new_file = rigpath / 'dl0' / 'protocol0' / 'Session Data' / 'dl0_protocol0_20190301_120000.mat'
+        new_file.write_bytes(b'\0' * 32)
+        os.utime(new_file.parent, (time.time() + 10, time.time() + 10))
+        assert [p for p, _, _ in index.refresh(rigpath)] == walk_rig_tree(rigpath)
+
+        # new directory
+        new_dir = rigpath / 'dl99' / 'protocol0' / 'Session Data'
+        new_dir.mkdir(parents=True)
+        (new_dir / 'dl99_protocol0_20190301_120000.mat').touch()
+        assert [p for p, _, _ in index.refresh(rigpath)] == walk_rig_tree(rigpath)
+
+        # removed directory
+        for f in new_dir.iterdir():
+            f.unlink()
+        new_dir.rmdir()
+        os.utime(new_dir.parent, (time.time() + 20, time.time() + 20))
+        assert [p for p, _, _ in index.refresh(rigpath)] == walk_rig_tree(rigpath)
+
+        # index persisted across instances
+        assert FileIndex(pathlib.Path(tmpdir, 'index.sqlite'), rexp).refresh(rigpath) == index.refresh(rigpath)
+
+        # symlinked directories are not followed, as with os.walk() - including symlink cycles
+        os.symlink(rigpath, rigpath / 'dl0' / 'loop')
+        os.symlink(rigpath / 'dl1', rigpath / 'dl1_link')
+        os.utime(rigpath, (time.time() + 30, time.time() + 30))
+        os.utime(rigpath / 'dl0', (time.time() + 30, time.time() + 30))
+        assert [p for p, _, _ in index.refresh(rigpath)] == walk_rig_tree(rigpath)
+
+
+def test_file_index_benchmark():
+    file_index._mtime_settle_time = 0
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rigpath = pathlib.Path(tmpdir, 'rig')
+        make_rig_tree(rigpath, n_h2os=60, n_protocols=5, n_sessions=40)
+        index = FileIndex(pathlib.Path(tmpdir, 'index.sqlite'), rexp)
+
+        start = time.time()
+        walked = walk_rig_tree(rigpath)
+        walk_time = time.time() - start
+
+        start = time.time()
+        index.refresh(rigpath)
+        full_time = time.time() - start
+
+        start = time.time()
+        indexed = index.refresh(rigpath)
+        rescan_time = time.time() - start
+
+    log.info('os.walk: {:.3f}s, full index: {:.3f}s, incremental rescan: {:.3f}s ({} files)'.format(
+        walk_time, full_time, rescan_time, len(walked)))
+
+    assert [p for p, _, _ in indexed] == walked
@@ -0,0 +1,115 @@
+import time
+import logging
+
+import numpy as np
+
+from pipeline import ccf, histology
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+def make_annotation_volume(shape=(114, 80, 132), block=4, n_regions=300, seed=0):
+    ''' synthetic 20um annotation volume: blocks of random regions, with ~20% of the blocks not annotated '''
+    rng = np.random.RandomState(seed)
+    regions = {'region_name': np.array(['region {}'.format(i) for i in range(n_regions)]),
+               'region_id': np.arange(1, n_regions + 1),
+               'color_code': np.array(['{:06X}'.format(c) for c in rng.randint(0, 0xFFFFFF, n_regions)])}
+
+    coarse_shape = [-(-s // block) for s in shape]
+    coarse = np.where(rng.rand(*coarse_shape) < 0.2, -1, rng.randint(0, n_regions, coarse_shape))
+    labels = coarse.repeat(block, 0).repeat(block, 1).repeat(block, 2)[:shape[0], :shape[1], :shape[2]]
+    voxels = np.array(np.nonzero(labels >= 0))
+
+    ccf_x, ccf_y, ccf_z = voxels * 20
+    annotation = regions['region_name'][labels[tuple(voxels)]]
+    return ccf.AnnotationVolume.from_annotations(ccf_x, ccf_y, ccf_z, annotation, regions), (
+        ccf_x, ccf_y, ccf_z, annotation, regions)
+
+
+def make_shank_coords(n_points=60, seed=0):
+    ''' (AP, DV, ML) electrode/track points of a slanted shank '''
+    rng = np.random.RandomState(seed)
+    dv = np.sort(rng.uniform(200, 1400, n_points))
+    return np.column_stack([1300 + 0.3 * dv + rng.normal(0, 15, n_points), dv,
+                            1100 - 0.2 * dv + rng.normal(0, 15, n_points)])
+
+
+def retrieve_pseudocoronal_slice_query(coords, annotation_rows, dv_max, voxel_res=20):
+    '''
+    histology.retrieve_pseudocoronal_slice(), with np.matrix fits and the restriction of
+    CCFAnnotation * CCFBrainRegion by {ccf_y, ccf_z} dicts as an in-memory join
+    '''
+    ccf_x, ccf_y, ccf_z, annotation, regions = annotation_rows
+    color_code = dict(zip(regions['region_name'], regions['color_code']))
+
+    X = np.asmatrix(np.hstack((np.ones((coords.shape[0], 1)), coords[:, 1][:, np.newaxis])))  # DV
+    y = np.asmatrix(coords[:, 0]).T  # AP
+    ap_fit = np.linalg.solve(X.T * X, X.T * y)
+    y = np.asmatrix(coords[:, 2]).T  # ML
+    ml_fit = np.linalg.solve(X.T * X, X.T * y)
+
+    dv_coords = np.arange(0, dv_max, voxel_res)
+    X2 = np.asmatrix(np.hstack((np.ones((len(dv_coords), 1)), dv_coords[:, np.newaxis])))
+    ap_coords = np.array(X2 * ap_fit).flatten().astype(int)
+    ml_coords = np.array(X2 * ml_fit).flatten().astype(int)
+    ap_coords = (voxel_res * np.round(ap_coords / voxel_res)).astype(int)
+    ml_coords = (voxel_res * np.round(ml_coords / voxel_res)).astype(int)
+
+    restriction = set(zip(dv_coords, ap_coords))
+    dv_pts, lr_pts, ap_pts, color_codes = zip(*sorted(
+        (y, x, z, color_code[a]) for x, y, z, a in zip(ccf_x, ccf_y, ccf_z, annotation)
+        if (y, z) in restriction))
+
+    # as fetched
+    dv_pts, lr_pts, ap_pts = np.array(dv_pts), np.array(lr_pts), np.array(ap_pts)
+    color_codes = np.array(color_codes, dtype=object)
+
+    coronal_point_cloud = set(zip(lr_pts, dv_pts, ap_pts))  # ML, DV, AP
+    shank_ccfs = np.vstack([(ml, dv, ap)
+                            for dv, ap, ml in zip(dv_coords, ap_coords, ml_coords)
+                            if (ml, dv, ap) in coronal_point_cloud])
+
+    return np.vstack([dv_pts, lr_pts, ap_pts, color_codes]).T, shank_ccfs
+
+
+#
+# Actual Tests
+#
+
+def test_sample_pseudocoronal_slice():
+    volume, annotation_rows = make_annotation_volume()
+    dv_max = annotation_rows[1].max()
+
+    for seed in range(5):
+        coords = make_shank_coords(seed=seed)
+        points, shank_ccfs = histology.sample_pseudocoronal_slice(coords, volume, dv_max)
+        expected_points, expected_shank_ccfs = retrieve_pseudocoronal_slice_query(
+            coords, annotation_rows, dv_max)
+
+        assert points.shape == expected_points.shape
+        assert points.tolist() == expected_points.tolist()
+        np.testing.assert_array_equal(shank_ccfs, expected_shank_ccfs)
+
+
+def test_sample_pseudocoronal_slice_benchmark():
+    volume, annotation_rows = make_annotation_volume()
+    dv_max = annotation_rows[1].max()
+    coords = make_shank_coords()
+
+    start = time.time()
+    expected_points, _ = retrieve_pseudocoronal_slice_query(coords, annotation_rows, dv_max)
+    query_time = time.time() - start
+
+    start = time.time()
+    points, _ = histology.sample_pseudocoronal_slice(coords, volume, dv_max)
+    sample_time = time.time() - start
+
+    log.info('{} slice points - in-memory join: {:.3f}s, volume sampling: {:.4f}s'.format(
+        len(points), query_time, sample_time))
+
+    assert points.tolist() == expected_points.tolist()
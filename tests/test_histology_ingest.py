@@ -0,0 +1,110 @@
+import json
+import logging
+import pathlib
+import tempfile
+
+import numpy as np
+import scipy.io as scio
+
+from pipeline.ingest import histology as histology_ingest
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+def make_site_file(fpath, n_sites=384, seed=0):
+    ''' format 1 histology file (landmarks_..._siteInfo.mat) - a few sites without ontology '''
+    rng = np.random.RandomState(seed)
+    pos = rng.uniform(100, 500, (3, n_sites))
+    ont_id = rng.randint(1, 1000, n_sites).astype(float)
+    ont_id[rng.rand(n_sites) < 0.1] = np.nan
+    scio.savemat(fpath, {'site': {
+        'pos': {'mmPerPixel': 0.01, 'x': pos[0], 'y': pos[1], 'z': pos[2]},
+        'warp': {'x': pos[0] + 0.5, 'y': pos[1] - 0.5, 'z': pos[2] + 0.25},
+        'ont': {'id': ont_id}}})
+    return pathlib.Path(fpath)
+
+
+def make_channel_locations_file(fpath, n_channels=384, seed=0):
+    ''' format 2 histology file (channel_locations.json) - with channels not in channel order '''
+    rng = np.random.RandomState(seed)
+    cloc = {'channel_{}'.format(c): {
+        'x': float(rng.uniform(-500, 500)), 'y': float(rng.uniform(-500, 500)), 'z': float(rng.uniform(0, 4000)),
+        'axial': float(20 * (c // 2)), 'lateral': float([43, 11, 59, 27][c % 4]),
+        'brain_region_id': int(rng.randint(1, 1000)), 'brain_region': 'region'}
+        for c in rng.permutation(n_channels)}
+    cloc['origin'] = {'bregma': [5400, 332, 5700]}
+    with open(fpath, 'w') as f:
+        json.dump(cloc, f)
+    return pathlib.Path(fpath)
+
+
+def make_ccf_voxels(xyz, seed=0):
+    ''' ccf.CCF voxels: half of the (20um) voxels at "xyz" '''
+    rng = np.random.RandomState(seed)
+    voxels = np.unique(xyz[rng.rand(len(xyz)) < 0.5], axis=0)
+    return np.column_stack([np.zeros(len(voxels), dtype=int), voxels])
+
+
+#
+# Actual Tests
+#
+
+def test_load_site_positions():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        probepath = make_site_file(pathlib.Path(tmpdir, 'landmarks_dl59_20190101_1_1_siteInfo.mat'))
+        pos_xyz, ont_ids = histology_ingest.load_site_positions(probepath, 20)
+        hist = scio.loadmat(probepath, struct_as_record=False, squeeze_me=True)['site']
+
+    assert pos_xyz.shape == (384, 6)
+    assert (pos_xyz[:, :3] % 20 == 0).all()
+    np.testing.assert_allclose(pos_xyz[:, 3:], np.vstack([hist.warp.x, hist.warp.y, hist.warp.z]).T * 10)
+    np.testing.assert_array_equal(ont_ids == 0, np.isnan(hist.ont.id))
+
+
+def test_load_channel_locations():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cloc_file = make_channel_locations_file(pathlib.Path(tmpdir, 'channel_locations.json'))
+        pos_xyz, rec_electrodes = histology_ingest.load_channel_locations(cloc_file, 20)
+        with open(cloc_file) as f:
+            cloc = json.load(f)
+
+        cloc['origin']['lambda'] = [0, 0, 0]
+        with open(cloc_file, 'w') as f:
+            json.dump(cloc, f)
+        assert histology_ingest.load_channel_locations(cloc_file, 20) is None
+
+    channels = [cloc['channel_{}'.format(c)] for c in range(384)]
+    assert pos_xyz.shape == (384, 3)
+    np.testing.assert_array_equal(pos_xyz[:, 0], 20 * np.around((5400 + np.array([c['x'] for c in channels])) / 20))
+    np.testing.assert_array_equal(pos_xyz[:, 1], 20 * np.around((5700 - np.array([c['z'] for c in channels])) / 20))
+    np.testing.assert_array_equal(rec_electrodes[:, 1], [c['axial'] for c in channels])
+    assert set(rec_electrodes[:, 0]) == {32, 0, 48, 16}
+
+
+def test_partition_electrode_positions():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pos_xyz, _ = histology_ingest.load_site_positions(
+            make_site_file(pathlib.Path(tmpdir, 'landmarks_dl59_20190101_1_1_siteInfo.mat')), 20)
+
+    # with positions outside of the volume and off the voxel grid
+    pos_xyz = np.vstack([pos_xyz[:, :3], [[-20, 0, 0], [100000, 20, 20]], pos_xyz[:5, :3] + 7])
+    ccf_voxels = make_ccf_voxels(pos_xyz[:384].astype(int))
+    voxel_set = set(map(tuple, ccf_voxels.tolist()))
+
+    recs = [{'electrode': e, 'ccf_label_id': 0, 'ccf_x': int(x), 'ccf_y': int(y), 'ccf_z': int(z)}
+            for e, (x, y, z) in enumerate(pos_xyz)]
+    valid, errors = histology_ingest.partition_electrode_positions(recs, ccf_voxels)
+
+    # as with ElectrodePosition.insert1() failing on the foreign key to ccf.CCF
+    assert valid == [r for r in recs if (0, r['ccf_x'], r['ccf_y'], r['ccf_z']) in voxel_set]
+    assert errors == [r for r in recs if (0, r['ccf_x'], r['ccf_y'], r['ccf_z']) not in voxel_set]
+    assert 0 < len(valid) < len(recs) - 7
+    assert histology_ingest.partition_electrode_positions(
+        [dict(r, ccf_label_id=1) for r in valid], ccf_voxels) == ([], [dict(r, ccf_label_id=1) for r in valid])
+    assert histology_ingest.partition_electrode_positions([], ccf_voxels) == ([], [])
+    assert histology_ingest.partition_electrode_positions(recs[:3], np.empty((0, 4), dtype=int)) == ([], recs[:3])
@@ -0,0 +1,425 @@
+import time
+import logging
+import pathlib
+import tempfile
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.stats as sc_stats
+
+from pipeline import psth
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+def make_trial_spikes(n_units=100, n_trials=300, seed=0):
+    ''' mock Unit.TrialSpikes rows of an insertion: (spike_times, unit, trial) - not every unit in every trial '''
+    rng = np.random.RandomState(seed)
+    xmin, xmax, binsize = psth.UnitPsth.psth_params.values()
+    edges = np.arange(xmin, xmax, binsize)
+
+    spikes, row_units, row_trials = [], [], []
+    for unit in range(n_units):
+        rate = rng.uniform(1, 40)
+        for trial in range(1, n_trials + 1):
+            if rng.rand() < 0.05:
+                continue
+            spike_times = np.sort(rng.uniform(-4, 4, rng.poisson(rate * 8)))
+            if rng.rand() < 0.1:  # spikes on bin edges, including the last (closed) one
+                spike_times = np.sort(np.concatenate([spike_times, edges[rng.randint(0, len(edges), 3)],
+                                                      edges[-1:]]))
+            spikes.append(spike_times)
+            row_units.append(unit)
+            row_trials.append(trial)
+
+    spikes_arr = np.empty(len(spikes), dtype=object)
+    spikes_arr[:] = spikes
+    return spikes_arr, np.array(row_units), np.array(row_trials)
+
+
+def make_condition_trials(n_trials=300, n_conditions=10, seed=0):
+    rng = np.random.RandomState(seed)
+    conditions = {'condition_{}'.format(c): np.flatnonzero(rng.rand(n_trials) < 0.3) + 1
+                  for c in range(n_conditions)}
+    conditions['no_trial'] = np.array([], dtype=int)
+    return conditions
+
+
+def compute_psths_loop(spikes, row_units, row_trials, condition_trials):
+    ''' the per unit x condition UnitPsth.make() computation, replaced by UnitPsth.compute_psths() '''
+    psths = {}
+    for unit in np.unique(row_units):
+        for condition, trials in condition_trials.items():
+            rows = (row_units == unit) & np.isin(row_trials, trials)
+            if rows.any():
+                psths[(unit, condition)] = psth.UnitPsth.compute_psth(spikes[rows])
+    return psths
+
+
+behavior_attrs = {'subject_id', 'session', 'trial', 'task', 'task_protocol', 'trial_instruction',
+                  'early_lick', 'outcome', 'auto_water', 'free_water'}
+stim_attrs = {'trial', 'photostim_event_id', 'photo_stim', 'photostim_device', 'photostim_event_time', 'power',
+              'duration', 'waveform', 'stim_brain_area', 'stim_laterality'}
+
+
+def make_session_trials(n_trials=400, seed=0):
+    ''' mock BehaviorTrial and PhotostimEvent * PhotostimBrainRegion * Photostim rows of a session '''
+    rng = np.random.RandomState(seed)
+    behav_trials = pd.DataFrame({
+        'trial': np.arange(1, n_trials + 1),
+        'task': rng.choice(['audio delay', 'audio mem'], n_trials, p=[0.9, 0.1]),
+        'task_protocol': rng.choice([1, 2], n_trials, p=[0.9, 0.1]),
+        'trial_instruction': rng.choice(['left', 'right'], n_trials),
+        'early_lick': rng.choice(['no early', 'early'], n_trials, p=[0.8, 0.2]),
+        'outcome': rng.choice(['hit', 'miss', 'ignore', None], n_trials, p=[0.6, 0.2, 0.15, 0.05]),
+        'auto_water': rng.choice([0, 1], n_trials, p=[0.9, 0.1]),
+        'free_water': rng.choice([0, 1], n_trials, p=[0.9, 0.1])})
+
+    stim_trials = np.flatnonzero(rng.rand(n_trials) < 0.3) + 1
+    n_events = rng.randint(1, 3, len(stim_trials))  # some trials with several events
+    stim_events = pd.DataFrame({
+        'trial': np.repeat(stim_trials, n_events),
+        'photostim_event_id': np.concatenate([np.arange(n) for n in n_events]),
+        'stim_brain_area': rng.choice(['alm', 'midbrain'], n_events.sum(), p=[0.8, 0.2]),
+        'stim_laterality': rng.choice(['left', 'right', 'both'], n_events.sum())})
+
+    return behav_trials, stim_events
+
+
+def resolve_condition_trials_loop(condition_func, condition_arg, behav_trials, stim_events):
+    ''' row by row evaluation of the TrialCondition queries (_get_trials_exclude/include_stim) '''
+    def matched(row, attrs):
+        for k, v in condition_arg.items():
+            if k.lstrip('_') not in attrs:
+                continue
+            if k.startswith('_'):
+                if pd.isna(row[k[1:]]) or row[k[1:]] == v:
+                    return False
+            elif row[k] != v:
+                return False
+        return True
+
+    stim_trials = {row['trial'] for row in stim_events.to_dict('records') if matched(row, stim_attrs)}
+    trials = []
+    for row in behav_trials.to_dict('records'):
+        if matched(row, behavior_attrs):
+            if (row['trial'] in stim_trials) == (condition_func == '_get_trials_include_stim'):
+                trials.append(row['trial'])
+
+    return sorted(trials)
+
+
+def make_period_boundaries(n_trials=300, seed=0):
+    ''' mock (trial x period) sample/delay/response boundaries relative to the go-cue, and ipsi trials '''
+    rng = np.random.RandomState(seed)
+    sample = -rng.uniform(2.3, 2.6, n_trials)
+    delay = -rng.uniform(1.15, 1.25, n_trials)
+    period_starts = np.stack([sample, delay, np.zeros(n_trials)], axis=1)
+    period_stops = np.stack([delay, np.zeros(n_trials), np.full(n_trials, 1.2)], axis=1)
+    return period_starts, period_stops, rng.rand(n_trials) < 0.5
+
+
+def compute_selectivity_loop(spikes, row_units, row_trials, period_starts, period_stops, ipsi, alpha=0.05):
+    ''' the per unit x period PeriodSelectivity.make() computation, replaced by compute_selectivity() '''
+    selectivity = {}
+    for unit in np.unique(row_units):
+        for period in range(period_starts.shape[1]):
+            freq_i, freq_c = [], []
+            for spike_times, trial in zip(spikes[row_units == unit], row_trials[row_units == unit]):
+                start_time, stop_time = period_starts[trial, period], period_stops[trial, period]
+                spk_rate = np.logical_and(spike_times >= start_time,
+                                          spike_times < stop_time).sum() / (stop_time - start_time)
+                (freq_i if ipsi[trial] else freq_c).append(spk_rate)
+
+            t_stat, pval = sc_stats.ttest_ind(freq_i, freq_c, equal_var=True)
+            freq_i_m, freq_c_m = np.average(freq_i), np.average(freq_c)
+            pval = 1 if np.isnan(pval) else pval
+            if pval > alpha:
+                pref = 'non-selective'
+            else:
+                pref = 'ipsi-selective' if freq_i_m > freq_c_m else 'contra-selective'
+            selectivity[(unit, period)] = (pval, freq_i_m, freq_c_m, pref)
+
+    return selectivity
+
+
+def compute_unit_psth_query(spikes, per_trial=False):
+    ''' the former compute_unit_psth() computation, from the fetched TrialSpikes of a unit '''
+    xmin, xmax, bin_size = psth.UnitPsth.psth_params.values()
+    binning = np.arange(xmin, xmax, bin_size)
+    if per_trial:
+        return np.vstack([np.histogram(spike, bins=binning)[0] / bin_size for spike in spikes]), binning[1:]
+    psth_, edges = np.histogram(np.concatenate(spikes), bins=binning)
+    return psth_ / len(spikes) / bin_size, edges[1:]
+
+
+def compute_CD_projected_psth_loop(contra_trial_psths, ipsi_trial_psths, edges, time_period=None):
+    ''' the former per unit / per trial coding direction computation of compute_CD_projected_psth() '''
+    contra_psths = [(p.mean(axis=0), edges) for p in contra_trial_psths]
+    ipsi_psths = [(p.mean(axis=0), edges) for p in ipsi_trial_psths]
+
+    if not time_period:
+        contra_tmin, contra_tmax = zip(*((k[1].min(), k[1].max()) for k in contra_psths))
+        ipsi_tmin, ipsi_tmax = zip(*((k[1].min(), k[1].max()) for k in ipsi_psths))
+        time_period = max(min(contra_tmin), min(ipsi_tmin)), min(max(contra_tmax), max(ipsi_tmax))
+    p_start, p_end = time_period
+
+    contra_ave_spk_rate = np.array([spk_rate[np.logical_and(spk_edge >= p_start, spk_edge < p_end)].mean()
+                                    for spk_rate, spk_edge in contra_psths])
+    ipsi_ave_spk_rate = np.array([spk_rate[np.logical_and(spk_edge >= p_start, spk_edge < p_end)].mean()
+                                  for spk_rate, spk_edge in ipsi_psths])
+    cd_vec = contra_ave_spk_rate - ipsi_ave_spk_rate
+    cd_vec = cd_vec / np.linalg.norm(cd_vec)
+
+    proj_contra_trial = np.vstack([np.dot(tr_u, cd_vec) for tr_u in np.dstack(contra_trial_psths)])
+    proj_ipsi_trial = np.vstack([np.dot(tr_u, cd_vec) for tr_u in np.dstack(ipsi_trial_psths)])
+    return cd_vec, proj_contra_trial, proj_ipsi_trial
+
+
+#
+# Actual Tests
+#
+
+def test_compute_psths():
+    spikes, row_units, row_trials = make_trial_spikes(n_units=20, n_trials=60)
+    condition_trials = make_condition_trials(n_trials=60)
+
+    # shuffled rows
+    order = np.random.RandomState(1).permutation(len(spikes))
+    psths = psth.UnitPsth.compute_psths(spikes[order], row_units[order], row_trials[order], condition_trials)
+    expected = compute_psths_loop(spikes, row_units, row_trials, condition_trials)
+
+    assert set(psths) == set(expected)
+    for k in expected:
+        assert psths[k].dtype == expected[k].dtype and psths[k].shape == expected[k].shape
+        assert np.array_equal(psths[k], expected[k])
+
+    assert psth.UnitPsth.compute_psths(spikes[:0], row_units[:0], row_trials[:0], condition_trials) == {}
+
+
+def test_compute_psths_benchmark():
+    spikes, row_units, row_trials = make_trial_spikes()
+    condition_trials = make_condition_trials()
+
+    start = time.time()
+    expected = compute_psths_loop(spikes, row_units, row_trials, condition_trials)
+    loop_time = time.time() - start
+
+    start = time.time()
+    psths = psth.UnitPsth.compute_psths(spikes, row_units, row_trials, condition_trials)
+    batch_time = time.time() - start
+
+    log.info('{} unit x condition psths - per unit/condition: {:.2f}s, probe batch: {:.2f}s'.format(
+        len(psths), loop_time, batch_time))
+
+    assert all(np.array_equal(psths[k], expected[k]) for k in expected)
+
+
+def test_resolve_condition_trials():
+    behav_trials, stim_events = make_session_trials()
+
+    for condition in psth.TrialCondition().contents:
+        for stim in (stim_events, stim_events[:0]):  # sessions with and without photostim
+            trials = psth.resolve_condition_trials(
+                condition['trial_condition_func'], condition['trial_condition_arg'],
+                behav_trials, stim, behavior_attrs, stim_attrs)
+            expected = resolve_condition_trials_loop(
+                condition['trial_condition_func'], condition['trial_condition_arg'], behav_trials, stim)
+
+            assert np.array_equal(trials, expected), condition['trial_condition_name']
+
+
+def test_compute_selectivity():
+    n_units, n_trials = 30, 80
+    spikes, row_units, row_trials = make_trial_spikes(n_units=n_units, n_trials=n_trials)
+    row_trials = row_trials - 1
+    period_starts, period_stops, ipsi = make_period_boundaries(n_trials=n_trials)
+
+    # units with all trials (even units) and units without some trials (odd units)
+    missing = [(u, t) for u in range(0, n_units, 2) for t in range(n_trials)
+               if not ((row_units == u) & (row_trials == t)).any()]
+    if missing:
+        no_spikes = np.empty(len(missing), dtype=object)
+        no_spikes[:] = [np.empty(0)] * len(missing)
+        spikes = np.concatenate([spikes, no_spikes])
+        row_units = np.concatenate([row_units, [u for u, _ in missing]])
+        row_trials = np.concatenate([row_trials, [t for _, t in missing]])
+
+    # selective units: more spikes in the delay period of ipsi trials - not sorted
+    for i in np.flatnonzero((row_units % 3 == 0) & ipsi[row_trials]):
+        spikes[i] = np.concatenate([spikes[i], np.linspace(-1.1, -0.1, 20)])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        expected = compute_selectivity_loop(spikes, row_units, row_trials, period_starts, period_stops, ipsi)
+
+    p_values, ipsi_rates, contra_rates, selectivity = psth.PeriodSelectivity.compute_selectivity(
+        spikes, row_units, row_trials, period_starts, period_stops, ipsi, n_units + 1)
+
+    assert selectivity.shape == (n_units + 1, 3)
+    for (unit, period), (pval, freq_i_m, freq_c_m, pref) in expected.items():
+        assert np.isclose(p_values[unit, period], pval, rtol=1e-9, atol=0)
+        assert np.isclose(ipsi_rates[unit, period], freq_i_m, rtol=1e-12)
+        assert np.isclose(contra_rates[unit, period], freq_c_m, rtol=1e-12)
+        assert selectivity[unit, period] == pref
+    assert (selectivity[:n_units:3, 1] == 'ipsi-selective').all()
+
+    # a unit without spikes rows: not selective
+    assert (p_values[n_units] == 1).all() and (selectivity[n_units] == 'non-selective').all()
+
+
+def test_binned_spikes():
+    spikes, row_units, row_trials = make_trial_spikes(n_units=20, n_trials=60)
+    units = [('jrclust', u) for u in row_units]
+    binned = psth.BinnedSpikes.from_trial_spikes(spikes, units, row_trials, fingerprint='test')
+
+    trials = np.arange(1, 61, 3)
+    for unit in [('jrclust', 0), ('jrclust', 7)]:
+        rows = (row_units == unit[1]) & np.isin(row_trials, trials)
+        for per_trial in (False, True):
+            unit_psth, edges = binned.psth(unit, trials, per_trial=per_trial)
+            expected, expected_edges = compute_unit_psth_query(spikes[rows], per_trial=per_trial)
+            assert np.array_equal(unit_psth, expected) and np.array_equal(edges, expected_edges)
+
+    assert binned.psth(('jrclust', 100), trials) is None
+    assert binned.psth(('jrclust', 0), [1000]) is None
+
+    # unit/trial slicing
+    subset = binned.select(units=[('jrclust', 3), ('jrclust', 1), ('jrclust', 100)], trials=trials)
+    assert subset.units == [('jrclust', 3), ('jrclust', 1)] and np.array_equal(subset.trials, trials)
+    assert np.array_equal(subset.psth(('jrclust', 1))[0], binned.psth(('jrclust', 1), trials)[0])
+
+    # rebinning - the trailing bins not filling a rebinned bin are dropped
+    rebinned = binned.rebin(4)
+    n_bins = binned.counts.shape[-1] // 4
+    assert rebinned.counts.shape[-1] == n_bins and len(rebinned.edges) == n_bins + 1
+    assert np.array_equal(rebinned.edges, binned.edges[:n_bins * 4 + 1:4])
+    assert np.array_equal(rebinned.counts, binned.counts[..., :n_bins * 4].reshape(
+        *binned.counts.shape[:2], n_bins, 4).sum(axis=-1))
+    assert np.isclose(rebinned.binsize, binned.binsize * 4)
+
+    # local cache
+    with tempfile.TemporaryDirectory() as tmpdir:
+        binned.save(pathlib.Path(tmpdir, '1_1_1_spike_counts.npy'), pathlib.Path(tmpdir, '1_1_1_spike_index.npz'))
+        cached = psth.BinnedSpikes.load({'subject_id': 1, 'session': 1, 'insertion_number': 1}, tmpdir,
+                                        fingerprint='test')
+        assert sorted(p.name for p in pathlib.Path(tmpdir).iterdir()) == ['1_1_1_spike_counts.npy',
+                                                                          '1_1_1_spike_index.npz']
+
+        assert isinstance(cached.counts, np.memmap)
+        assert cached.units == binned.units and cached.fingerprint == 'test'
+        assert np.array_equal(cached.counts, binned.counts) and np.array_equal(cached.has_trial, binned.has_trial)
+        assert np.array_equal(cached.trials, binned.trials) and np.array_equal(cached.edges, binned.edges)
+
+        condition_trials = make_condition_trials(n_trials=60)
+        psths = cached.psths(condition_trials)
+        expected = psth.UnitPsth.compute_psths(spikes, units, row_trials, condition_trials)
+        assert set(psths) == set(expected) and all(np.array_equal(psths[k], expected[k]) for k in expected)
+
+
+def test_get_binned_spikes(monkeypatch):
+    loaded = []
+
+    def load(insertion_key, cache_dir, fingerprint=None, refresh=False):
+        loaded.append(insertion_key['insertion_number'])
+        return psth.BinnedSpikes(np.zeros((0, 0, 0)), np.zeros((0, 0)), [], [], [0, 1], 1, fingerprint)
+
+    # the fingerprint and spike counts are fetched from the database
+    fingerprints = {}
+    monkeypatch.setattr(psth.BinnedSpikes, 'get_fingerprint',
+                        lambda insertion_key: fingerprints.get(insertion_key['insertion_number'], 'fp'))
+    monkeypatch.setattr(psth.BinnedSpikes, 'load', load)
+    monkeypatch.setattr(psth, '_binned_spikes', OrderedDict())
+    monkeypatch.setattr(psth, '_binned_spikes_max', 3)
+
+    for insertion_number in (1, 2, 1, 3, 4, 1, 2):
+        psth.get_binned_spikes({'subject_id': 1, 'session': 1, 'insertion_number': insertion_number})
+
+    # the least recently used insertions are dropped
+    assert loaded == [1, 2, 3, 4, 2]
+    assert list(psth._binned_spikes) == [(1, 1, 4), (1, 1, 1), (1, 1, 2)]
+
+    # reloaded if the database content changed
+    fingerprints[1] = 'fp2'
+    assert psth.get_binned_spikes({'subject_id': 1, 'session': 1, 'insertion_number': 1}).fingerprint == 'fp2'
+    assert loaded == [1, 2, 3, 4, 2, 1]
+
+
+def test_binned_spikes_benchmark():
+    spikes, row_units, row_trials = make_trial_spikes()
+    units = [('jrclust', u) for u in row_units]
+    condition_trials = make_condition_trials()
+
+    # UnitPsth of an insertion - from the spike times (not cached) ...
+    start = time.time()
+    expected = psth.UnitPsth.compute_psths(spikes, units, row_trials, condition_trials)
+    spikes_time = time.time() - start
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        psth.BinnedSpikes.from_trial_spikes(spikes, units, row_trials, fingerprint='test').save(
+            pathlib.Path(tmpdir, '1_1_1_spike_counts.npy'), pathlib.Path(tmpdir, '1_1_1_spike_index.npz'))
+
+        # ... and from the cached spike counts
+        start = time.time()
+        binned = psth.BinnedSpikes.load({'subject_id': 1, 'session': 1, 'insertion_number': 1}, tmpdir,
+                                        fingerprint='test')
+        psths = binned.psths(condition_trials)
+        cached_time = time.time() - start
+
+    log.info('{} unit x condition psths - from spike times: {:.2f}s, from cached spike counts: {:.2f}s'.format(
+        len(psths), spikes_time, cached_time))
+
+    assert set(psths) == set(expected) and all(np.array_equal(psths[k], expected[k]) for k in expected)
+
+
+def test_compute_CD_projections():
+    n_units, n_trials = 25, 60
+    spikes, row_units, row_trials = make_trial_spikes(n_units=n_units, n_trials=n_trials)
+    units = [('jrclust', u) for u in range(n_units)]
+    binned = psth.BinnedSpikes.from_trial_spikes(spikes, [('jrclust', u) for u in row_units], row_trials)
+
+    # trials with TrialSpikes rows for all units, as compute_CD_projected_psth() requires
+    rng = np.random.RandomState(2)
+    trials = [t for t in range(1, n_trials + 1) if binned.has_trial[:, binned.trials == t].all()]
+    assert list(binned.common_trials(units)) == trials
+    assert len(binned.common_trials(units[:1])) > len(trials)
+    assert not len(binned.common_trials(units + [('jrclust', 100)]))
+    contra_trials = sorted(rng.choice(trials, len(trials) // 2, replace=False))
+    ipsi_trials = sorted(set(trials) - set(contra_trials))
+
+    # per unit psths, as the former compute_unit_psth()
+    contra_trial_psths, edges = zip(*(compute_unit_psth_query(
+        spikes[(row_units == u) & np.isin(row_trials, contra_trials)], per_trial=True) for _, u in units))
+    ipsi_trial_psths, _ = zip(*(compute_unit_psth_query(
+        spikes[(row_units == u) & np.isin(row_trials, ipsi_trials)], per_trial=True) for _, u in units))
+
+    assert np.array_equal(binned.trial_rates(units, contra_trials), np.array(contra_trial_psths))
+
+    for time_period in (None, (-1.2, 0)):
+        expected = compute_CD_projected_psth_loop(contra_trial_psths, ipsi_trial_psths, edges[0], time_period)
+        cd_vec, proj_contra_trial, proj_ipsi_trial = psth.compute_CD_projections(
+            binned.trial_rates(units, contra_trials), binned.trial_rates(units, ipsi_trials),
+            binned.edges[1:], time_period=time_period)
+
+        assert proj_contra_trial.shape == (len(contra_trials), len(edges[0]))
+        assert proj_ipsi_trial.shape == (len(ipsi_trials), len(edges[0]))
+        for result, expected_result in zip((cd_vec, proj_contra_trial, proj_ipsi_trial), expected):
+            assert np.allclose(result, expected_result, rtol=1e-12, atol=1e-12)
+
+    # (unit, trial) without TrialSpikes rows
+    for rate_units, rate_trials in (([('jrclust', 0), ('jrclust', 100)], trials[:2]),
+                                    (units, trials[:2] + [1000]),
+                                    (units, [t for t in range(1, n_trials + 1) if t not in trials][:1])):
+        try:
+            binned.trial_rates(rate_units, rate_trials)
+        except ValueError:
+            pass
+        else:
+            assert False, 'trial_rates() of (unit, trial) without TrialSpikes rows'
@@ -0,0 +1,228 @@
+import time
+import logging
+import pathlib
+import tempfile
+from collections import defaultdict
+
+import numpy as np
+
+from pipeline.ingest import tracking as tracking_ingest
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Utilities
+#
+
+features = ('nose', 'tongue', 'jaw', 'paw_left', 'paw_right', 'lickport', 'whisker')
+
+
+def make_mock_dlc_csv(fpath, n_samples=1500, seed=0):
+    ''' DeepLabCut csv, with the 3-row (scorer, bodyparts, coords) header '''
+    rng = np.random.RandomState(seed)
+    scorer = 'DeepCut_resnet50_licking-sideAug10shuffle1_1030000'
+
+    data = np.column_stack([np.arange(n_samples)] + [
+        c for _ in features for c in (rng.rand(n_samples) * 640, rng.rand(n_samples) * 480,
+                                      rng.rand(n_samples) ** 8)])
+    with open(fpath, 'w') as f:
+        f.write(','.join(['scorer'] + [scorer] * 3 * len(features)) + '\n')
+        f.write(','.join(['bodyparts'] + [p for p in features for _ in range(3)]) + '\n')
+        f.write(','.join(['coords'] + ['x', 'y', 'likelihood'] * len(features)) + '\n')
+        for row in data:
+            f.write(','.join([str(int(row[0]))] + [repr(float(v)) for v in row[1:]]) + '\n')
+
+    return pathlib.Path(fpath)
+
+
+def load_tracking_loop(trkpath):
+    ''' TrackingIngest.load_tracking(), parsing the csv line by line '''
+    res = defaultdict(lambda: defaultdict(list))
+
+    with open(trkpath, 'r') as f:
+        f.readline()  # discard 1st line
+        parts, fields = f.readline(), f.readline()
+        parts = parts.rstrip().split(',')
+        fields = fields.rstrip().split(',')
+
+        for l in f:
+            if l.strip():
+                lv = l.rstrip().split(',')
+                for i, v in enumerate(lv):
+                    v = float(v)
+                    if i == 0:
+                        res['samples']['ts'].append(v)
+                    else:
+                        res[parts[i]][fields[i]].append(v)
+
+    return res
+
+
+#
+# Actual Tests
+#
+
+def test_load_tracking():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trkpaths = [make_mock_dlc_csv(pathlib.Path(tmpdir, 'dl59_side_{}-0000.csv'.format(trial)),
+                                      n_samples=500, seed=trial) for trial in range(8)]
+
+        for trkpath, trk in zip(trkpaths, tracking_ingest.TrackingIngest.load_tracking_files(trkpaths, 4)):
+            expected = load_tracking_loop(trkpath)
+            assert list(trk) == list(expected)
+            for feature in expected:
+                assert list(trk[feature]) == list(expected[feature])
+                for attr in expected[feature]:
+                    assert trk[feature][attr].dtype == np.float32
+                    np.testing.assert_array_equal(
+                        trk[feature][attr], np.array(expected[feature][attr], dtype=np.float32))
+
+
+def test_load_tracking_benchmark():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trkpaths = [make_mock_dlc_csv(pathlib.Path(tmpdir, 'dl59_side_{}-0000.csv'.format(trial)), seed=trial)
+                    for trial in range(40)]
+
+        start = time.time()
+        expected = [load_tracking_loop(f) for f in trkpaths]
+        loop_time = time.time() - start
+
+        start = time.time()
+        loaded = [tracking_ingest.TrackingIngest.load_tracking(f) for f in trkpaths]
+        load_time = time.time() - start
+
+        start = time.time()
+        threaded = list(tracking_ingest.TrackingIngest.load_tracking_files(trkpaths, 4))
+        threaded_time = time.time() - start
+
+    log.info('{} files - line by line: {:.2f}s, vectorized: {:.2f}s, 4 threads: {:.2f}s'.format(
+        len(trkpaths), loop_time, load_time, threaded_time))
+
+    for trk, threaded_trk, expected_trk in zip(loaded, threaded, expected):
+        np.testing.assert_array_equal(trk['nose']['x'], threaded_trk['nose']['x'])
+        assert len(trk['samples']['ts']) == len(expected_trk['samples']['ts'])
+
+
+class InsertCounter:
+    ''' stand-in for a tracking table, recording the rows of each insert statement '''
+    def __init__(self, name):
+        self.__name__ = name
+        self.inserts = []
+
+    def insert(self, rows, **kwargs):
+        assert kwargs.get('allow_direct_insert')
+        self.inserts.append(list(rows))
+
+
+def test_insert_tracking_rows():
+    n_trials = 300
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trkpaths = [make_mock_dlc_csv(pathlib.Path(tmpdir, 'dl59_side_{}-0000.csv'.format(trial)),
+                                      n_samples=200, seed=trial) for trial in range(n_trials)]
+        trks = list(tracking_ingest.TrackingIngest.load_tracking_files(trkpaths, 4))
+
+    rows = {tbl: [] for tbl in tracking_ingest.tracking_tables}
+    for trial, trk in enumerate(trks, 1):
+        rec_base = {'subject_id': 1, 'session': 1, 'trial': trial, 'tracking_device': 'Camera 0'}
+        for tbl, tbl_rows in tracking_ingest.tracking_rows(rec_base, trk).items():
+            rows[tbl].extend(tbl_rows)
+
+    tracking = tracking_ingest.tracking
+    assert all(len(r) == n_trials for r in rows.values())
+    assert rows[tracking.Tracking][0]['tracking_samples'] == 200
+    assert set(rows[tracking.Tracking.LeftPawTracking][0]) == {
+        'subject_id', 'session', 'trial', 'tracking_device',
+        'left_paw_x', 'left_paw_y', 'left_paw_likelihood'}
+    assert rows[tracking.Tracking.WhiskerTracking][0]['whisker_name'] == 'whisker'
+    np.testing.assert_array_equal(rows[tracking.Tracking.NoseTracking][-1]['nose_x'], trks[-1]['nose']['x'])
+
+    def count_inserts(chunk_rows, chunk_bytes):
+        tracking_ingest._insert_chunk_rows, tracking_ingest._insert_chunk_bytes = chunk_rows, chunk_bytes
+        counters = {tbl: InsertCounter(tbl.__name__) for tbl in rows}
+        tracking_ingest.insert_tracking_rows({counters[tbl]: r for tbl, r in rows.items()})
+        for tbl, counter in counters.items():
+            assert [r for chunk in counter.inserts for r in chunk] == rows[tbl]
+        return {tbl: counter.inserts for tbl, counter in counters.items()}
+
+    chunk_rows, chunk_bytes = tracking_ingest._insert_chunk_rows, tracking_ingest._insert_chunk_bytes
+    try:
+        # one insert per table, instead of one per table per trial
+        inserts = count_inserts(500, 16 * 1024 * 1024)
+        assert sum(len(i) for i in inserts.values()) == len(tracking_ingest.tracking_tables)
+
+        # row bound
+        inserts = count_inserts(128, 16 * 1024 * 1024)
+        assert all(len(i) == 3 for i in inserts.values())
+
+        # size bound - 200 samples x 3 attributes x 4 bytes per part table row
+        inserts = count_inserts(500, 2400 * 50)
+        assert len(inserts[tracking.Tracking]) == 1
+        assert all(len(inserts[tbl]) == 6 and max(len(c) for c in inserts[tbl]) == 50
+                   for tbl in tracking_ingest.tracking_tables[1:])
+    finally:
+        tracking_ingest._insert_chunk_rows, tracking_ingest._insert_chunk_bytes = chunk_rows, chunk_bytes
+
+
+def make_tracking_dir(sess_dir, h2o='dl59', positions=('side', 'bottom', 'body'), n_trials=600):
+    ''' session tracking directory, with trial 5 missing and trial 7 duplicated for each camera position '''
+    sess_dir.mkdir(parents=True)
+    for tpos in positions:
+        for trial in range(1, n_trials + 1):
+            if trial != 5:
+                (sess_dir / '{}_{}_{}-0000.csv'.format(h2o, tpos, trial)).touch()
+                (sess_dir / '{}_{}_{}-0000.mp4'.format(h2o, tpos, trial)).touch()
+        (sess_dir / '{}DeepCut_resnet50_{}_7-0000.csv'.format(h2o, tpos)).touch()
+        (sess_dir / '{}_{}_labeled.csv'.format(h2o, tpos)).touch()
+    (sess_dir / '{}_061419_side.txt'.format(h2o)).touch()
+
+
+def glob_trial_files(sess_dir, h2o, tpos, trials):
+    ''' the per-trial glob replaced by SessionTrackingFiles '''
+    trial_files = {}
+    for t in trials:
+        paths = list(sess_dir.glob('{}*_{}_{}-*.csv'.format(h2o, tpos, t)))
+        if paths:
+            trial_files[t] = sorted(paths)
+    return trial_files
+
+
+def test_session_tracking_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sess_dir = pathlib.Path(tmpdir, 'dl59', 'dl59_061419')
+        make_tracking_dir(sess_dir)
+
+        file_index = tracking_ingest.SessionTrackingFiles(sess_dir, 'dl59')
+        assert 'dl59_061419_side.txt' in file_index
+        assert 'dl59_061419_bottom.txt' not in file_index
+
+        for tpos in ('side', 'bottom', 'body'):
+            trial_files = file_index.trial_files(tpos)
+            assert trial_files == glob_trial_files(sess_dir, 'dl59', tpos, range(1, 601))
+            assert 5 not in trial_files
+            assert len(trial_files[7]) == 2
+            assert trial_files[600] == [sess_dir / 'dl59_{}_600-0000.csv'.format(tpos)]
+
+        assert file_index.trial_files('side_face') == {}
+        assert file_index.trial_files('side', suffixed=False) == {}
+
+
+def test_session_tracking_files_benchmark():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sess_dir = pathlib.Path(tmpdir, 'dl59', 'dl59_061419')
+        make_tracking_dir(sess_dir)
+
+        start = time.time()
+        globbed = [glob_trial_files(sess_dir, 'dl59', tpos, range(1, 601)) for tpos in ('side', 'bottom', 'body')]
+        glob_time = time.time() - start
+
+        start = time.time()
+        file_index = tracking_ingest.SessionTrackingFiles(sess_dir, 'dl59')
+        indexed = [file_index.trial_files(tpos) for tpos in ('side', 'bottom', 'body')]
+        index_time = time.time() - start
+
+    log.info('{} files - per-trial glob: {:.2f}s, file index: {:.3f}s'.format(
+        len(file_index.filenames), glob_time, index_time))
+
+    assert indexed == globbed